@@ -0,0 +1,357 @@
+# Analysis.py<--Chip8Emulator
+"""
+Static analysis of Chip-8 ROMs.
+disassemble() turns an opcode into assembly. analyze() follows every path
+from 0x200 through the ROM, decoding exactly as the core does, and builds
+a control flow graph of basic blocks with their calls and returns. A
+block ends at a jump, call, return, skip, BNNN, or a halt (00XX), or just
+before another block starts.
+Bytes that no path decodes are data. Tracking I from ANNN through the
+graph finds the sprites DXYN draws, and the FX33/FX55 writes that land on
+code (self-modifying) or go where I cannot be followed. Back edges give
+the loops, the hot paths of most ROMs, and the idle loops CPU.fastForward
+skips are found up front.
+Results are cached by ROM hash, so an engine can look a ROM up as often
+as it likes. Jit.preload compiles the blocks found here before a run.
+Usage: python Analysis.py [--listing] [rom ...]
+"""
+
+import argparse
+import glob
+import os
+import time
+
+import Core
+
+UNKNOWN = -1 #I where it cannot be followed statically
+#How an instruction passes control on
+NEXT = "next"
+JUMP = "jump"
+CALL = "call"
+RETURN = "return"
+SKIP = "skip"
+INDIRECT = "indirect" #BNNN. Targets depend on V0
+HALT = "halt" #00XX. PC never moves again
+
+CACHE = {} #ROM sha256 -> Analysis
+
+def disassemble(opcode):
+    "Return the assembly for opcode, e.g. 0xD125 -> 'DRW V1, V2, 5'."
+    nibb1 = opcode >> 12
+    X = (opcode & 0x0F00) >> 8
+    Y = (opcode & 0x00F0) >> 4
+    N = opcode & 0x000F
+    NN = opcode & 0x00FF
+    NNN = opcode & 0x0FFF
+    if nibb1 == 0x0:
+        if opcode == 0x00E0: return "CLS"
+        if opcode == 0x00EE: return "RET"
+        if opcode == 0x0000 or X > 0: return "SYS #{0:03X}".format(NNN)
+        return "DW #{0:04X}".format(opcode) #Halts the core
+    if nibb1 == 0x1: return "JP #{0:03X}".format(NNN)
+    if nibb1 == 0x2: return "CALL #{0:03X}".format(NNN)
+    if nibb1 == 0x3: return "SE V{0:X}, #{1:02X}".format(X, NN)
+    if nibb1 == 0x4: return "SNE V{0:X}, #{1:02X}".format(X, NN)
+    if nibb1 == 0x5: return "SE V{0:X}, V{1:X}".format(X, Y)
+    if nibb1 == 0x6: return "LD V{0:X}, #{1:02X}".format(X, NN)
+    if nibb1 == 0x7: return "ADD V{0:X}, #{1:02X}".format(X, NN)
+    if nibb1 == 0x8:
+        name = {0x0: "LD", 0x1: "OR", 0x2: "AND", 0x3: "XOR", 0x4: "ADD",
+                0x5: "SUB", 0x6: "SHR", 0x7: "SUBN", 0xE: "SHL"}.get(N)
+        if name is None: return "DW #{0:04X}".format(opcode)
+        return "{0} V{1:X}, V{2:X}".format(name, X, Y)
+    if nibb1 == 0x9: return "SNE V{0:X}, V{1:X}".format(X, Y)
+    if nibb1 == 0xA: return "LD I, #{0:03X}".format(NNN)
+    if nibb1 == 0xB: return "JP V0, #{0:03X}".format(NNN)
+    if nibb1 == 0xC: return "RND V{0:X}, #{1:02X}".format(X, NN)
+    if nibb1 == 0xD: return "DRW V{0:X}, V{1:X}, {2}".format(X, Y, N)
+    if nibb1 == 0xE:
+        if NN == 0x9E: return "SKP V{0:X}".format(X)
+        if NN == 0xA1: return "SKNP V{0:X}".format(X)
+        return "DW #{0:04X}".format(opcode)
+    form = {0x07: "LD V{0:X}, DT", 0x0A: "LD V{0:X}, K", 0x15: "LD DT, V{0:X}",
+            0x18: "LD ST, V{0:X}", 0x1E: "ADD I, V{0:X}", 0x29: "LD F, V{0:X}",
+            0x33: "LD B, V{0:X}", 0x55: "LD [I], V{0:X}", 0x65: "LD V{0:X}, [I]"}.get(NN)
+    if form is None: return "DW #{0:04X}".format(opcode)
+    return form.format(X)
+
+def flow(address, opcode):
+    "Return (kind, [addresses control can go to next]) for the instruction at address."
+    nibb1 = opcode >> 12
+    nxt = address + 2
+    if nibb1 == 0x0:
+        if opcode == 0x00EE: return RETURN, []
+        if opcode == 0x0000 or opcode & 0x0F00 or opcode == 0x00E0: return NEXT, [nxt]
+        return HALT, []
+    if nibb1 == 0x1: return JUMP, [opcode & 0x0FFF]
+    if nibb1 == 0x2: return CALL, [opcode & 0x0FFF, nxt] #Assume the call returns
+    if nibb1 in (0x3, 0x4, 0x5, 0x9):
+        return SKIP, [nxt, nxt + 2]
+    if nibb1 == 0xB: return INDIRECT, []
+    if nibb1 == 0xE and opcode & 0xFF in (0x9E, 0xA1):
+        return SKIP, [nxt, nxt + 2]
+    return NEXT, [nxt]
+
+class BasicBlock():
+    __slots__ = ("start", "end", "kind", "successors", "predecessors", "I_in")
+    def __init__(self, start, end, kind, successors):
+        self.start = start
+        self.end = end #Address after the last instruction
+        self.kind = kind #How the last instruction passes control on
+        self.successors = successors
+        self.predecessors = []
+        self.I_in = None #I on entry: an address, UNKNOWN, or None if never reached
+
+class Analysis():
+    """
+    The control flow graph of a ROM, and what it says about the ROM's
+    code and data. Addresses are absolute, from 0x200.
+    """
+    def __init__(self, data, entry=Core.PROGRAM_START):
+        self.entry = entry
+        self.end = Core.PROGRAM_START + len(data) #First address after the ROM
+        memory = bytearray(4096)
+        memory[Core.PROGRAM_START:self.end] = data
+        self.memory = memory
+        self.instructions = {} #Address -> opcode, for every reachable instruction
+        self.code = bytearray(4096) #1 for each byte of a reachable instruction
+        self.leaders = {entry} #Addresses where blocks start
+        self.blocks = {} #Start address -> BasicBlock
+        self.subroutines = set() #Call targets
+        self.escapes = set() #Addresses outside the ROM that control reaches
+        self.indirect = [] #Addresses of BNNN jumps
+        self.sprites = set() #Addresses DXYN draws from
+        self.reads = set() #Addresses FX65 loads from
+        self.writes = set() #Addresses FX33/FX55 store to
+        self.self_modifying = [] #Addresses of writes that land on code
+        self.unknown_writes = [] #Addresses of writes through an I we cannot follow
+        self.trace()
+        self.split()
+        self.followI()
+
+    def trace(self):
+        "Find every reachable instruction."
+        memory = self.memory
+        instructions = self.instructions
+        code = self.code
+        work = [self.entry]
+        while work:
+            address = work.pop()
+            while address not in instructions:
+                if not Core.PROGRAM_START <= address < self.end - 1:
+                    self.escapes.add(address)
+                    break
+                opcode = memory[address] << 8 | memory[address + 1]
+                instructions[address] = opcode
+                code[address] = code[address + 1] = 1
+                kind, targets = flow(address, opcode)
+                if kind == NEXT:
+                    address = targets[0]
+                    continue
+                if kind == CALL:
+                    self.subroutines.add(targets[0])
+                elif kind == INDIRECT:
+                    self.indirect.append(address)
+                self.leaders.update(targets)
+                work.extend(targets)
+                break
+
+    def split(self):
+        "Cut the reachable instructions into basic blocks."
+        instructions = self.instructions
+        leaders = self.leaders
+        for start in sorted(leaders):
+            if start not in instructions:
+                continue
+            address = start
+            while True:
+                kind, targets = flow(address, instructions[address])
+                nxt = address + 2
+                if kind != NEXT or nxt in leaders or nxt not in instructions:
+                    break
+                address = nxt
+            if kind == NEXT and nxt not in instructions: #Runs off the end of the ROM
+                targets = []
+            self.blocks[start] = BasicBlock(start, address + 2, kind,
+                                            [t for t in targets if t in instructions])
+        for block in self.blocks.values():
+            for target in block.successors:
+                self.blocks[target].predecessors.append(block.start)
+
+    def transferI(self, block, I, record=False):
+        "Return I after block, given I on entry. With record, note memory accesses."
+        instructions = self.instructions
+        for address in range(block.start, block.end, 2):
+            opcode = instructions[address]
+            nibb1 = opcode >> 12
+            if nibb1 == 0xA:
+                I = opcode & 0x0FFF
+            elif nibb1 == 0xD:
+                if record and I != UNKNOWN:
+                    self.sprites.update(range(I, min(I + (opcode & 0xF), 4096)))
+            elif nibb1 == 0xF:
+                X = (opcode & 0x0F00) >> 8
+                NN = opcode & 0xFF
+                if NN in (0x1E, 0x29):
+                    I = UNKNOWN
+                elif NN in (0x33, 0x55, 0x65):
+                    size = 3 if NN == 0x33 else X + 1
+                    if record:
+                        if I == UNKNOWN:
+                            if NN != 0x65:
+                                self.unknown_writes.append(address)
+                        elif NN == 0x65:
+                            self.reads.update(range(I, min(I + size, 4096)))
+                        else:
+                            self.writes.update(range(I, min(I + size, 4096)))
+                            if any(self.code[I:I + size]):
+                                self.self_modifying.append(address)
+                    if NN != 0x33 and I != UNKNOWN:
+                        I += size
+        return I
+
+    def followI(self):
+        "Work out I on entry to every block, then note what each block reads and writes."
+        blocks = self.blocks
+        if self.entry not in blocks:
+            return
+        blocks[self.entry].I_in = 0 #I starts at 0
+        work = [self.entry]
+        while work:
+            block = blocks[work.pop()]
+            I = self.transferI(block, block.I_in)
+            for target in block.successors:
+                #After a call returns, I is whatever the subroutine left
+                out = UNKNOWN if block.kind == CALL and target == block.end else I
+                successor = blocks[target]
+                if successor.I_in is None:
+                    successor.I_in = out
+                elif successor.I_in != out and successor.I_in != UNKNOWN:
+                    successor.I_in = UNKNOWN
+                else:
+                    continue
+                work.append(target)
+        for block in blocks.values():
+            if block.I_in is not None:
+                self.transferI(block, block.I_in, record=True)
+        self.self_modifying.sort()
+        self.unknown_writes.sort()
+
+    def blockAt(self, address):
+        "Return the block holding the instruction at address, or None."
+        for block in self.blocks.values():
+            if block.start <= address < block.end:
+                return block
+        return None
+
+    def loops(self):
+        "Return the back edges [(from block, to block), ...]. Their targets head the loops."
+        return sorted((block.start, target) for block in self.blocks.values()
+                      for target in block.successors if target <= block.start)
+
+    def idleLoops(self):
+        "Return the addresses of the idle loops CPU.fastForward skips."
+        idle = []
+        instructions = self.instructions
+        for address, opcode in sorted(instructions.items()):
+            if opcode >> 12 == 0x1 and opcode & 0x0FFF == address: #Self jump
+                idle.append(address)
+            elif opcode & 0xF0FF == 0xF00A: #FX0A
+                idle.append(address)
+            elif (opcode & 0xF0FF == 0xF007 and
+                  instructions.get(address + 2, 0) & 0xFF00 == 0x3000 | opcode & 0x0F00 and
+                  instructions.get(address + 4) == 0x1000 | address): #Delay timer poll
+                idle.append(address)
+        return idle
+
+    def dataRegions(self):
+        "Return the runs of ROM bytes no path decodes, as [(start, end), ...]."
+        regions = []
+        start = None
+        for address in range(Core.PROGRAM_START, self.end):
+            if not self.code[address]:
+                if start is None:
+                    start = address
+            elif start is not None:
+                regions.append((start, address))
+                start = None
+        if start is not None:
+            regions.append((start, self.end))
+        return regions
+
+    def listing(self):
+        "Return the ROM as assembly, one line per instruction or data byte."
+        lines = []
+        address = Core.PROGRAM_START
+        while address < self.end:
+            if address in self.blocks:
+                labels = ["sub"] if address in self.subroutines else []
+                lines.append("{0:03X}:{1}".format(address, " " + " ".join(labels) if labels else ""))
+            opcode = self.instructions.get(address)
+            if opcode is not None:
+                lines.append("    {0:03X}  {1:04X}  {2}".format(address, opcode, disassemble(opcode)))
+                address += 2
+                continue
+            byte = self.memory[address]
+            lines.append("    {0:03X}  {1:02X}    DB #{1:02X}  {2}".format(
+                address, byte, "{0:08b}".format(byte).replace("0", ".").replace("1", "#")))
+            address += 1
+        return lines
+
+    def summary(self):
+        "Return the analysis as a dict for JSON."
+        return {"instructions": len(self.instructions),
+                "blocks": len(self.blocks),
+                "subroutines": sorted(self.subroutines),
+                "data": self.dataRegions(),
+                "loops": self.loops(),
+                "idle_loops": self.idleLoops(),
+                "indirect": self.indirect,
+                "escapes": sorted(self.escapes),
+                "self_modifying": self.self_modifying,
+                "unknown_writes": self.unknown_writes}
+
+def analyze(rom):
+    "Return the Analysis of rom, a ROMStore.ROM, computing it once per ROM hash."
+    analysis = CACHE.get(rom.digest)
+    if analysis is None:
+        analysis = CACHE[rom.digest] = Analysis(rom.data)
+    return analysis
+
+def analyzeFile(path, store=None):
+    "Return the Analysis of the ROM at path, loaded through store (default: Batch's)."
+    if store is None:
+        from Batch import STORE as store
+    return analyze(store.load(path))
+
+def main():
+    from Batch import PROGRAMS
+    parser = argparse.ArgumentParser(description="Disassemble and analyze Chip-8 ROMs.")
+    parser.add_argument("roms", nargs="*", help="ROM files. Default: programs/*.ch8")
+    parser.add_argument("--listing", action="store_true", help="print the disassembly")
+    args = parser.parse_args()
+    roms = args.roms or sorted(glob.glob(os.path.join(PROGRAMS, "*.ch8")))
+    start = time.perf_counter()
+    analyses = [analyzeFile(path) for path in roms]
+    elapsed = time.perf_counter() - start
+    print("{0:<18}{1:>7}{2:>7}{3:>6}{4:>6}{5:>6}{6:>6}{7:>6}  {8}".format(
+        "ROM", "instrs", "blocks", "subs", "data", "loops", "idle", "smc", "notes"))
+    for path, analysis in zip(roms, analyses):
+        notes = []
+        if analysis.indirect:
+            notes.append("BNNN")
+        if analysis.escapes:
+            notes.append("leaves ROM")
+        if analysis.unknown_writes:
+            notes.append("{0} untracked writes".format(len(analysis.unknown_writes)))
+        print("{0:<18}{1:>7}{2:>7}{3:>6}{4:>6}{5:>6}{6:>6}{7:>6}  {8}".format(
+            os.path.basename(path), len(analysis.instructions), len(analysis.blocks),
+            len(analysis.subroutines), sum(end - start for start, end in analysis.dataRegions()),
+            len(analysis.loops()), len(analysis.idleLoops()), len(analysis.self_modifying),
+            ", ".join(notes)))
+        if args.listing:
+            print("\n".join(analysis.listing()))
+    print("{0} ROMs in {1:.3f}s".format(len(roms), elapsed))
+
+if __name__ == "__main__":
+    main()
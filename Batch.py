@@ -0,0 +1,120 @@
+# Batch.py<--Chip8Emulator
+"""
+Headless batch runner. Runs ROMs with no display and no clock throttling,
+spread across a multiprocessing pool, and reports the final state of each.
+Usage: python Batch.py [-c cycles] [-j processes] [--json] [rom ...]
+With no ROMs given, every ROM in programs/ is run.
+"""
+
+import argparse
+import contextlib
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+
+import Core
+from ROMStore import ROMStore
+
+PROGRAMS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "programs")
+STORE = ROMStore() #Each process reads each ROM once
+
+def loadCPU(path, seed=0):
+    """
+    Return a fresh CPU with the ROM at path loaded. The default fixed seed
+    makes every run of a ROM give the same result.
+    """
+    cpu = Core.CPU(seed=seed)
+    STORE.boot(cpu, path)
+    return cpu
+
+def hashFramebuffer(cpu):
+    "Return a hex digest of cpu's framebuffer."
+    return hashlib.sha1(cpu.framebuffer()).hexdigest()
+
+def runCPU(cpu, cycles, fast_forward=True):
+    """
+    Run cpu for up to cycles instructions, or until it halts. Returns
+    (cycles executed, reason), where reason is "budget", "exit", "halt"
+    (PC stopped moving: a self jump, or FX0A with no input) or an error.
+    Delay timer polling loops are fast-forwarded (see CPU.fastForward),
+    unless fast_forward is False: a Profiler or Tracer attached to cpu
+    only sees instructions that go through emulateCycle.
+    """
+    step = cpu.emulateCycle
+    executed = 0
+    while executed < cycles:
+        PC = cpu.PC
+        try:
+            state = step()
+        except Exception as error: #A crashing ROM is a result, not a failure
+            return executed, "error: {0!r}".format(error)
+        executed += 1
+        if state == "Exit":
+            return executed, "exit"
+        if cpu.PC == PC:
+            return executed, "halt"
+        if fast_forward and cpu.PC < PC and not cpu.stuck(): #Jumped back. Maybe into an idle loop
+            executed += cpu.fastForward(cycles - executed)
+    return executed, "budget"
+
+def runROM(path, cycles=100000):
+    "Run the ROM at path headlessly. Returns a result dict."
+    try:
+        cpu = loadCPU(path)
+    except ValueError as error: #Too big to load. Reported like a crash
+        cpu = Core.CPU()
+        executed, reason, elapsed = 0, "error: {0!r}".format(error), 0.0
+    else:
+        with open(os.devnull, "w") as null, contextlib.redirect_stdout(null):
+            start = time.perf_counter()
+            executed, reason = runCPU(cpu, cycles)
+            elapsed = time.perf_counter() - start
+    return {
+        "rom": path,
+        "cycles": executed,
+        "stopped": reason,
+        "seconds": elapsed,
+        "framebuffer": hashFramebuffer(cpu),
+        "V": bytes(cpu.V).hex(),
+        "I": cpu.I,
+        "PC": cpu.PC,
+        "stack": list(cpu.stack[:cpu.SP]),
+        "delay_timer": cpu.delay_timer,
+        "sound_timer": cpu.sound_timer,
+    }
+
+def _runROM(job):
+    return runROM(*job)
+
+def runBatch(paths, cycles=100000, processes=None):
+    "Run every ROM in paths across a process pool. Returns results in order."
+    jobs = [(path, cycles) for path in paths]
+    with multiprocessing.Pool(processes) as pool:
+        return pool.map(_runROM, jobs, chunksize=max(1, len(jobs) // (4 * (processes or os.cpu_count() or 1))))
+
+def main():
+    parser = argparse.ArgumentParser(description="Run Chip-8 ROMs headlessly.")
+    parser.add_argument("roms", nargs="*", help="ROM files. Default: programs/*.ch8")
+    parser.add_argument("-c", "--cycles", type=int, default=100000, help="cycle budget per ROM")
+    parser.add_argument("-j", "--processes", type=int, default=None, help="pool size. Default: one per core")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+    roms = args.roms or sorted(glob.glob(os.path.join(PROGRAMS, "*.ch8")))
+    start = time.perf_counter()
+    results = runBatch(roms, args.cycles, args.processes)
+    elapsed = time.perf_counter() - start
+    if args.json:
+        print(json.dumps(results, indent=1))
+        return
+    for result in results:
+        print("{0:<18}{1:>9} {2:<8}{3:>8.3f}s  {4:.12}  PC={5:03X} I={6:03X} V={7}".format(
+            os.path.basename(result["rom"]), result["cycles"], result["stopped"][:8],
+            result["seconds"], result["framebuffer"], result["PC"], result["I"], result["V"]))
+    total = sum(result["cycles"] for result in results)
+    print("{0} ROMs, {1} cycles in {2:.2f}s".format(len(results), total, elapsed))
+
+if __name__ == "__main__":
+    main()
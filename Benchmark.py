@@ -0,0 +1,187 @@
+# Benchmark.py<--Chip8Emulator
+"""
+Throughput benchmarks for the Chip-8 core.
+The suite runs every ROM in programs/ headlessly for a fixed number of
+cycles through CPU.emulateCycle and reports instructions per second, then
+runs it again under a timing Profiler for the time spent per opcode family
+and the cost of a DXYN. Results are written as JSON, and a saved run can
+be compared with a new one to catch regressions.
+--engines instead compares the DISPATCH table engine and the block
+compiler (Jit.py) with the original if/elif interpreter (interpretCycle).
+Usage: python Benchmark.py [-c cycles] [-o out.json] [--compare old.json] [--engines] [rom ...]
+"""
+
+import argparse
+import contextlib
+import glob
+import json
+import os
+import platform
+import sys
+import time
+
+import Core
+from Batch import PROGRAMS, loadCPU
+from Profile import Profiler
+
+TOLERANCE = 0.10 #Slowdown reported as a regression by compareRuns
+REPEATS = 3 #Timed runs per ROM. The fastest counts, the rest is noise
+
+def timeEngine(path, engine, cycles):
+    """
+    Run cycles instructions of the ROM at path through engine (a CPU method
+    name). Returns (cycles executed, seconds).
+    """
+    cpu = loadCPU(path)
+    step = getattr(cpu, engine)
+    executed = 0
+    with open(os.devnull, "w") as null, contextlib.redirect_stdout(null):
+        start = time.perf_counter()
+        try:
+            for executed in range(1, cycles+1):
+                if step() == "Exit":
+                    break
+        except Exception: #Some ROMs crash the core. Time what ran.
+            executed -= 1
+        elapsed = time.perf_counter() - start
+    return executed, elapsed
+
+def timeJit(path, cycles):
+    """
+    As timeEngine, for the block compiler in Jit.py. The ROM's blocks are
+    compiled from its Analysis before the clock starts.
+    """
+    from Analysis import analyzeFile
+    from Jit import Jit
+    jit = Jit(loadCPU(path))
+    jit.preload(analyzeFile(path))
+    executed = 0
+    with open(os.devnull, "w") as null, contextlib.redirect_stdout(null):
+        start = time.perf_counter()
+        try:
+            executed = jit.run(cycles)[0]
+        except Exception:
+            executed = jit.cycles
+        elapsed = time.perf_counter() - start
+    return executed, elapsed
+
+def compareEngines(cycles=20000, roms=None):
+    """
+    Print cycles per second of interpretCycle, emulateCycle and the JIT
+    per ROM, with the speedup of each over interpretCycle.
+    """
+    debugging = Core.DEBUGGING
+    Core.DEBUGGING = 0 #Printing would swamp both engines
+    try:
+        roms = roms or sorted(glob.glob(os.path.join(PROGRAMS, "*.ch8")))
+        print("{0:<18}{1:>14}{2:>14}{3:>9}{4:>14}{5:>9}".format(
+            "ROM", "interpret/s", "dispatch/s", "speedup", "jit/s", "speedup"))
+        for path in roms:
+            n_old, t_old = timeEngine(path, "interpretCycle", cycles)
+            n_new, t_new = timeEngine(path, "emulateCycle", cycles)
+            n_jit, t_jit = timeJit(path, cycles)
+            old = n_old / t_old if t_old else 0
+            new = n_new / t_new if t_new else 0
+            jit = n_jit / t_jit if t_jit else 0
+            print("{0:<18}{1:>14.0f}{2:>14.0f}{3:>8.2f}x{4:>14.0f}{5:>8.2f}x".format(
+                os.path.basename(path), old, new, new / old if old else 0,
+                jit, jit / old if old else 0))
+    finally:
+        Core.DEBUGGING = debugging
+
+def benchmarkROM(path, cycles=20000, repeats=REPEATS):
+    """
+    Benchmark the ROM at path. Returns a result dict: the best throughput
+    of emulateCycle over repeats runs, then the profile of one more run.
+    """
+    executed, elapsed = min((timeEngine(path, "emulateCycle", cycles)
+                             for i in range(repeats)), key=lambda run: run[1])
+    cpu = loadCPU(path)
+    profiler = Profiler(timing=True)
+    profiler.attach(cpu)
+    step = cpu.emulateCycle
+    with open(os.devnull, "w") as null, contextlib.redirect_stdout(null):
+        try:
+            for i in range(cycles):
+                if step() == "Exit":
+                    break
+        except Exception:
+            pass
+    result = {"rom": os.path.basename(path),
+              "cycles": executed,
+              "seconds": elapsed,
+              "ips": executed / elapsed if elapsed else 0}
+    result.update(profiler.report(cpu))
+    return result
+
+def runSuite(cycles=20000, roms=None, repeats=REPEATS):
+    "Benchmark every ROM in roms. Returns the run as a dict for JSON."
+    debugging = Core.DEBUGGING
+    Core.DEBUGGING = 0
+    try:
+        roms = roms or sorted(glob.glob(os.path.join(PROGRAMS, "*.ch8")))
+        results = [benchmarkROM(path, cycles, repeats) for path in roms]
+    finally:
+        Core.DEBUGGING = debugging
+    return {"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "machine": platform.machine(),
+            "cycles": cycles,
+            "repeats": repeats,
+            "results": results}
+
+def compareRuns(old, new, tolerance=TOLERANCE):
+    """
+    Print the speed of each ROM in run new relative to run old. Returns
+    the ROMs that got slower by more than tolerance.
+    """
+    before = {result["rom"]: result for result in old["results"]}
+    slower = []
+    for result in new["results"]:
+        previous = before.get(result["rom"])
+        if previous is None or not previous["ips"]:
+            continue
+        ratio = result["ips"] / previous["ips"]
+        flag = ""
+        if ratio < 1 - tolerance:
+            slower.append(result["rom"])
+            flag = "  REGRESSION"
+        print("{0:<18}{1:>12.0f}{2:>12.0f}{3:>8.2f}x{4}".format(
+            result["rom"], previous["ips"], result["ips"], ratio, flag))
+    return slower
+
+def printSuite(run):
+    print("{0:<18}{1:>10}{2:>12}{3:>8}{4:>10}  {5}".format(
+        "ROM", "cycles", "ips", "draws", "DXYN us", "slowest families"))
+    for result in run["results"]:
+        slowest = list(result.get("family_seconds", {}))[:3]
+        print("{0:<18}{1:>10}{2:>12.0f}{3:>8}{4:>10.2f}  {5}".format(
+            result["rom"], result["cycles"], result["ips"], result["draws"],
+            result.get("DXYN_microseconds", 0), " ".join(slowest)))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Chip-8 core.")
+    parser.add_argument("roms", nargs="*", help="ROM files. Default: programs/*.ch8")
+    parser.add_argument("-c", "--cycles", type=int, default=20000, help="cycles per ROM")
+    parser.add_argument("-o", "--output", help="write the run as JSON to this file")
+    parser.add_argument("--compare", help="JSON file of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE, help="slowdown that counts as a regression")
+    parser.add_argument("--engines", action="store_true", help="compare the engines instead")
+    args = parser.parse_args()
+    if args.engines:
+        compareEngines(args.cycles, args.roms)
+        return
+    run = runSuite(args.cycles, args.roms)
+    printSuite(run)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(run, file, indent=1)
+    if args.compare:
+        with open(args.compare) as file:
+            old = json.load(file)
+        if compareRuns(old, run, args.tolerance):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
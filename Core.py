@@ -12,41 +12,449 @@ http://s4.zetaboards.com/wow/topic/9663604/1/
 http://stackoverflow.com/questions/6619882/decoding-and-matching-chip-8-opcodes-in-c-c
 """
 
-from random import randint
-import pygame
-from pygame.locals import *
+from array import array
+import random
+try:
+    import pygame
+except ImportError: #Headless. Only main() needs pygame
+    pygame = None
 
-DEBUGGING = 1
+DEBUGGING = 0
+STACK_SIZE = 16 #Return addresses the stack can hold
+#The framebuffer is 32 rows, each a 64 bit int. Pixel x is bit (63 - x)
+ROW_MASK = (1 << 64) - 1
+BLANK_SCREEN = (0,) * 32
+NO_KEY = -1 #key_pressed when no key went down this cycle. 0 is a key
+PROGRAM_START = 0x200 #ROMs load here, above the interpreter's memory
+MAX_ROM_SIZE = 4096 - PROGRAM_START #0xE00 bytes
 def DEBUG(string):
     "Print Verbose data for debugging. Disable with DEBUGGING flag."
     if DEBUGGING:
         print(string)
 
+#Opcode dispatch table
+#Every opcode is decoded once, the first time it is fetched, into a handler
+# with its operands already bound. emulateCycle then only has to fetch and
+# call. Each handler
+# takes the CPU and returns None, or "Exit" to stop emulation. The decoding
+# rules (including the odd ones) match interpretCycle exactly.
+def op_NULL(cpu): #0000
+    cpu.PC += 2
+
+def op_0NNN(cpu): #0NNN: Execute System Code. Not used
+    cpu.PC += 2
+
+def op_00E0(cpu): #00E0: Clear the screen
+    cpu.graphics[:] = BLANK_SCREEN
+    cpu.draw_graphics = 1
+    cpu.PC += 2
+
+def op_00EE(cpu): #00EE: Return from subroutine
+    if not cpu.SP:
+        DEBUG("ERROR: Attempt to return from subroutine when no call was made.")
+        return "Exit"
+    cpu.SP -= 1
+    cpu.PC = cpu.stack[cpu.SP]
+
+def op_00XX(cpu): #Unknown 00XX. Like interpretCycle, PC is not advanced
+    pass
+
+def op_1NNN(NNN): #Jumps to NNN
+    def op(cpu):
+        cpu.PC = NNN
+    return op
+
+def op_2NNN(NNN): #Call subroutine at NNN
+    def op(cpu):
+        if cpu.SP == STACK_SIZE:
+            DEBUG("ERROR: Stack overflow.")
+            return "Exit"
+        cpu.stack[cpu.SP] = cpu.PC + 2
+        cpu.SP += 1
+        cpu.PC = NNN
+    return op
+
+def op_3XNN(X, NN): #Skip NI if VX == NN
+    def op(cpu):
+        if cpu.V[X] == NN: cpu.PC += 4
+        else: cpu.PC += 2
+    return op
+
+def op_4XNN(X, NN): #Skip NI if VX != NN
+    def op(cpu):
+        if cpu.V[X] != NN: cpu.PC += 4
+        else: cpu.PC += 2
+    return op
+
+def op_5XY0(X, Y): #Skip NI if VX == VY
+    def op(cpu):
+        if cpu.V[X] == cpu.V[Y]: cpu.PC += 4
+        else: cpu.PC += 2
+    return op
+
+def op_6XNN(X, NN): #Set VX to NN
+    def op(cpu):
+        cpu.V[X] = NN
+        cpu.PC += 2
+    return op
+
+def op_7XNN(X, NN): #Adds NN to VX. No flag is set
+    def op(cpu):
+        VX = cpu.V[X]
+        if VX + NN > 0xFF:
+            cpu.V[X] = NN - (0xFF - VX)
+        else:
+            cpu.V[X] = VX + NN
+        cpu.PC += 2
+    return op
+
+def op_8XY0(X, Y): #VX = VY
+    def op(cpu):
+        cpu.V[X] = cpu.V[Y]
+        cpu.PC += 2
+    return op
+
+def op_8XY1(X, Y): #VX = VX or VY
+    def op(cpu):
+        V = cpu.V
+        V[X] = V[X] | V[Y]
+        cpu.PC += 2
+    return op
+
+def op_8XY2(X, Y): #VX = VX and VY
+    def op(cpu):
+        V = cpu.V
+        V[X] = V[X] & V[Y]
+        cpu.PC += 2
+    return op
+
+def op_8XY3(X, Y): #VX = VX xor VY
+    def op(cpu):
+        V = cpu.V
+        V[X] = V[X] ^ V[Y]
+        cpu.PC += 2
+    return op
+
+def op_8XY4(X, Y): #VX += VY. VF is set on carry
+    def op(cpu):
+        V = cpu.V
+        total = V[X] + V[Y]
+        if total > 255:
+            V[0xF] = 1
+            total -= 255
+        else: V[0xF] = 0
+        V[X] = total
+        cpu.PC += 2
+    return op
+
+def op_8XY5(X, Y): #VX -= VY. VF is unset on borrow
+    def op(cpu):
+        V = cpu.V
+        total = V[X] - V[Y]
+        if total < 0:
+            V[0xF] = 0
+            total += 255
+        else: V[0xF] = 1
+        V[X] = total
+        cpu.PC += 2
+    return op
+
+def op_8XY6(X, Y): #Shift right. See interpretCycle for legacy/modern
+    def op(cpu):
+        V = cpu.V
+        if cpu.legacy:
+            VY = V[Y]
+            V[0xF] = VY & 1
+            V[X] = VY >> 1
+        else:
+            V[0xF] = V[X] & 1
+            V[X] >>= 1
+        cpu.PC += 2
+    return op
+
+def op_8XY7(X, Y): #VX = VY - VX. VF is unset on borrow
+    def op(cpu):
+        V = cpu.V
+        total = V[Y] - V[X]
+        if total < 0:
+            V[0xF] = 0
+            total += 255
+        else: V[0xF] = 1
+        V[X] = total
+        cpu.PC += 2
+    return op
+
+def op_8XYE(X, Y): #Shift left. See interpretCycle for legacy/modern
+    def op(cpu):
+        V = cpu.V
+        #interpretCycle reads the "MSB" as int(bin(V)[0]), which is always 0
+        if cpu.legacy:
+            VY = V[Y]
+            V[0xF] = 0
+            V[X] = VY << 1
+        else:
+            V[0xF] = 0
+            V[X] <<= 1
+        cpu.PC += 2
+    return op
+
+def op_9XY0(X, Y): #Skip NI if VX != VY
+    def op(cpu):
+        if cpu.V[X] != cpu.V[Y]: cpu.PC += 4
+        else: cpu.PC += 2
+    return op
+
+def op_ANNN(NNN): #I = NNN
+    def op(cpu):
+        cpu.I = NNN
+        cpu.PC += 2
+    return op
+
+def op_BNNN(NNN): #Jump to NNN plus V0
+    def op(cpu):
+        address = NNN + cpu.V[0x0]
+        if address > 0xFFF: address -= 0xFFF
+        cpu.PC = address
+    return op
+
+def op_CXNN(X, NN): #VX = RandomNumber & NN
+    def op(cpu):
+        cpu.V[X] = cpu.rng.getrandbits(8) & NN
+        cpu.PC += 2
+    return op
+
+def drawSprite(cpu, VX, VY, I, N):
+    """
+    XOR the N row sprite at memory[I] onto the framebuffer at (VX, VY).
+    Returns 1 if any lit pixel was turned off, else 0.
+    """
+    #Each sprite row is shifted into place and XORed onto its framebuffer
+    # row in one go. Any overlap with the row before is a collision.
+    sprite = cpu.memory[I:I+N]
+    if len(sprite) < N:
+        raise IndexError("sprite runs off the end of memory")
+    graphics = cpu.graphics
+    collision = 0
+    if cpu.wrap: #Sprites wrap around the edges of the screen
+        VX &= 63
+        for yline in range(N):
+            bits = sprite[yline] << 56
+            bits = (bits >> VX | bits << (64 - VX)) & ROW_MASK
+            y = (VY + yline) & 31
+            row = graphics[y]
+            if row & bits: collision = 1
+            graphics[y] = row ^ bits
+    else: #Sprites are clipped at the right and bottom edges
+        shift = 56 - VX
+        for yline in range(min(N, 32 - VY)):
+            if shift >= 0: bits = sprite[yline] << shift
+            else: bits = sprite[yline] >> -shift
+            row = graphics[VY + yline]
+            if row & bits: collision = 1
+            graphics[VY + yline] = row ^ bits
+    return collision
+
+def op_DXYN(X, Y, N): #Draw sprite data at (VX,VY) starting from I
+    def op(cpu):
+        V = cpu.V
+        V[0xF] = drawSprite(cpu, V[X], V[Y], cpu.I, N)
+        cpu.draw_graphics = 1
+        cpu.PC += 2
+    return op
+
+def op_EX9E(X): #Skip NI if key stored in VX is pressed
+    def op(cpu):
+        if cpu.key_states[cpu.V[X]]: cpu.PC += 4
+        else: cpu.PC += 2
+    return op
+
+def op_EXA1(X): #Skip NI if key stored in VX is not pressed
+    def op(cpu):
+        if not cpu.key_states[cpu.V[X]]: cpu.PC += 4
+        else: cpu.PC += 2
+    return op
+
+def op_FX07(X): #VX = DelayTimer
+    def op(cpu):
+        cpu.V[X] = cpu.delay_timer
+        cpu.PC += 2
+    return op
+
+def op_FX0A(X): #Await keypress, then store result in VX
+    def op(cpu):
+        if cpu.key_pressed != NO_KEY:
+            cpu.V[X] = cpu.key_pressed
+            cpu.PC += 2
+    return op
+
+def op_FX15(X): #DelayTimer = VX
+    def op(cpu):
+        cpu.delay_timer = cpu.V[X]
+        cpu.PC += 2
+    return op
+
+def op_FX18(X): #SoundTimer = VX
+    def op(cpu):
+        cpu.sound_timer = cpu.V[X]
+        cpu.PC += 2
+    return op
+
+def op_FX1E(X): #I += VX
+    def op(cpu):
+        VX = cpu.V[X]
+        if cpu.I + VX > 0xFFF:
+            cpu.I = (VX - (0xFFF - cpu.I)) #rollover
+            cpu.V[0xF] = 1
+        else:
+            cpu.I += VX
+        cpu.PC += 2
+    return op
+
+def op_FX29(X): #I = fontset sprite for VX
+    def op(cpu):
+        cpu.I = cpu.V[X] * 5
+        cpu.PC += 2
+    return op
+
+def op_FX33(X): #Store VX at [I,I+1,I+2] as BCD
+    def op(cpu):
+        VX = cpu.V[X]
+        memory = cpu.memory
+        I = cpu.I
+        memory[I] = VX // 100
+        memory[I + 1] = VX // 10 % 10
+        memory[I + 2] = VX % 10
+        cpu.PC += 2
+    return op
+
+def op_FX55(X): #Store V0-VX in memory starting at I. I += (X + 1)
+    def op(cpu):
+        I = cpu.I
+        memory = cpu.memory
+        if I + X + 1 > len(memory): #Raise the same IndexError as a loop would
+            for i in range(X+1):
+                memory[I + i] = cpu.V[i]
+        memory[I:I+X+1] = cpu.V[:X+1]
+        cpu.I = I+X+1
+        cpu.PC += 2
+    return op
+
+def op_FX65(X): #Fill V0-VX from memory starting at I. I += (X + 1)
+    def op(cpu):
+        I = cpu.I
+        memory = cpu.memory
+        if I + X + 1 > len(memory):
+            for i in range(X+1):
+                cpu.V[i] = memory[I + i]
+        cpu.V[:X+1] = memory[I:I+X+1]
+        cpu.I = I+X+1
+        cpu.PC += 2
+    return op
+
+def op_UNKNOWN(cpu): #Unknown opcode. Skipped
+    cpu.PC += 2
+
+def decodeOpcode(opcode):
+    "Return the handler for opcode, with its operands bound."
+    nibb1 = (opcode & 0xF000) >> 12
+    X = (opcode & 0x0F00) >> 8
+    Y = (opcode & 0x00F0) >> 4
+    N = (opcode & 0x000F)
+    NNN = (opcode & 0x0FFF)
+    NN = (opcode & 0x00FF)
+    if nibb1 == 0x0:
+        if opcode == 0x0000: return op_NULL
+        elif X > 0x0: return op_0NNN
+        elif N == 0x0: return op_00E0
+        elif N == 0xE: return op_00EE
+        else: return op_00XX
+    elif nibb1 == 0x1: return op_1NNN(NNN)
+    elif nibb1 == 0x2: return op_2NNN(NNN)
+    elif nibb1 == 0x3: return op_3XNN(X, NN)
+    elif nibb1 == 0x4: return op_4XNN(X, NN)
+    elif nibb1 == 0x5: return op_5XY0(X, Y)
+    elif nibb1 == 0x6: return op_6XNN(X, NN)
+    elif nibb1 == 0x7: return op_7XNN(X, NN)
+    elif nibb1 == 0x8:
+        family = {0x0: op_8XY0, 0x1: op_8XY1, 0x2: op_8XY2, 0x3: op_8XY3,
+                  0x4: op_8XY4, 0x5: op_8XY5, 0x6: op_8XY6, 0x7: op_8XY7,
+                  0xE: op_8XYE}.get(N)
+        if family is None: return op_UNKNOWN
+        return family(X, Y)
+    elif nibb1 == 0x9: return op_9XY0(X, Y)
+    elif nibb1 == 0xA: return op_ANNN(NNN)
+    elif nibb1 == 0xB: return op_BNNN(NNN)
+    elif nibb1 == 0xC: return op_CXNN(X, NN)
+    elif nibb1 == 0xD: return op_DXYN(X, Y, N)
+    elif nibb1 == 0xE:
+        if NN == 0x9E: return op_EX9E(X)
+        elif NN == 0xA1: return op_EXA1(X)
+        else: return op_UNKNOWN
+    else:
+        family = {0x07: op_FX07, 0x0A: op_FX0A, 0x15: op_FX15, 0x18: op_FX18,
+                  0x1E: op_FX1E, 0x29: op_FX29, 0x33: op_FX33, 0x55: op_FX55,
+                  0x65: op_FX65}.get(NN)
+        if family is None: return op_UNKNOWN
+        return family(X)
+
+class DispatchTable(dict):
+    """
+    opcode -> handler. Filled on demand: building all 64K closures up front
+    costs ~30MB for opcodes no ROM uses.
+    """
+    def __missing__(self, opcode):
+        handler = self[opcode] = decodeOpcode(opcode)
+        return handler
+
+DISPATCH = DispatchTable()
+
 class CPU():
-    #There are 2 versions of opcode 8XY6 and 8XYE. Set this flag
-    # for the legacy version
-    legacy = 0
-    instructions_executed = 0 #Timer counts down every 14 instructions
-    #The variables that will be used
-    opcode = 0x0000
-    memory = bytearray(4095)
-    #Graphics
-    graphics = [[0]*64 for i in range(32)] #64x32 pixels, for graphics.
-    draw_graphics = 0
-    V = bytearray(16) #Registers V0..VF
-    #Index and preogram counter. Both store 0x000..0xFFF
-    I = 0x000
-    PC = 0x200
-    #Timers
-    delay_timer = 0
-    sound_timer = 0
-    #Stack
-    stack = []
-    #Key States
-    key_states = [0]*16
-    key_pressed = 0 #Set to a key if a key has been pressed this cycle
+    """
+    One Chip-8 machine. All state belongs to the instance, so any number of
+    CPUs can run side by side in one process. Per instance this is the
+    4096 byte memory, 16 registers, a 16 entry stack and the framebuffer.
+    """
+    __slots__ = ("legacy", "wrap", "clock_rate", "timer_phase", "memory", "graphics",
+                 "draw_graphics", "V", "I", "PC", "delay_timer", "sound_timer",
+                 "stack", "SP", "key_states", "key_pressed", "rng", "dispatch")
+
+    def __init__(self, legacy=0, wrap=0, clock_rate=840, seed=None):
+        #There are 2 versions of opcode 8XY6 and 8XYE. Set this flag
+        # for the legacy version
+        self.legacy = legacy
+        #DXYN clips sprites at the screen edge. Set this flag to wrap them
+        self.wrap = wrap
+        #Instructions per second of emulated time. The timers count down
+        # once every clock_rate/60 instructions, carrying the remainder in
+        # timer_phase, so they run at 60Hz whatever speed the host runs at.
+        self.clock_rate = clock_rate
+        self.timer_phase = 0
+        self.memory = bytearray(4096)
+        #Graphics
+        self.graphics = list(BLANK_SCREEN) #64x32 pixels, one int per row
+        self.draw_graphics = 0
+        self.V = bytearray(16) #Registers V0..VF
+        #Index and program counter. Both store 0x000..0xFFF
+        self.I = 0x000
+        self.PC = 0x200
+        #Timers
+        self.delay_timer = 0
+        self.sound_timer = 0
+        #Stack. SP is the number of return addresses held
+        self.stack = array("H", bytes(2 * STACK_SIZE))
+        self.SP = 0
+        #Key States
+        self.key_states = bytearray(16)
+        self.key_pressed = NO_KEY #Set to a key if a key has been pressed this cycle
+        #CXNN draws from this CPU's own generator. Give a seed for runs
+        # that can be reproduced exactly
+        self.rng = random.Random(seed)
+        #opcode -> handler table used by emulateCycle. A Trace.Tracer swaps in
+        # its own recording table, so tracing costs nothing when it is off.
+        self.dispatch = DISPATCH
+
     #The FontSet. Has a sprite for every HEX character
-    font_set = [
+    font_set = bytes([
         0xF0, 0x90, 0x90, 0x90, 0xF0, #0
         0x20, 0x60, 0x20, 0x20, 0x70, #1
         0xF0, 0x10, 0xF0, 0x80, 0xF0, #2
@@ -62,19 +470,208 @@ class CPU():
         0xF0, 0x80, 0x80, 0x80, 0xF0, #C
         0xE0, 0x90, 0x90, 0x90, 0xE0, #D
         0xF0, 0x80, 0xF0, 0x80, 0xF0, #E
-        0xF0, 0x80, 0xF0, 0x80, 0x80] #F
+        0xF0, 0x80, 0xF0, 0x80, 0x80]) #F
 
     def initialize(self):
         #Load Fontset
-        for i in range(0x00, 0x4F):
-            self.memory[i] = self.font_set[i]
+        self.memory[:len(self.font_set)] = self.font_set
+
+    def snapshot(self):
+        "Return a copy of the machine state, for restore()."
+        return (bytes(self.memory), bytes(self.V), self.I, self.PC,
+                self.stack.tobytes(), self.SP, self.delay_timer, self.sound_timer,
+                tuple(self.graphics), self.timer_phase)
+
+    def restore(self, state):
+        "Return the machine to a state taken by snapshot()."
+        (memory, V, self.I, self.PC, stack, self.SP, self.delay_timer,
+         self.sound_timer, graphics, self.timer_phase) = state
+        self.memory[:] = memory
+        self.V[:] = V
+        self.stack[:] = array("H", stack)
+        self.graphics[:] = graphics
+
+    def getPixel(self, x, y):
+        "Return 1 if pixel (x, y) is lit."
+        return self.graphics[y] >> (63 - x) & 1
+
+    def framebuffer(self):
+        "Return the framebuffer packed into 256 bytes, row by row."
+        return b"".join(row.to_bytes(8, "big") for row in self.graphics)
+
+    def keyDown(self, key):
+        self.key_states[key] = 1
+        self.key_pressed = key
+
+    def keyUp(self, key):
+        self.key_states[key] = 0
+
+    def waitingForKey(self):
+        "Return True if the CPU is stopped on FX0A with no key pressed."
+        PC = self.PC
+        return (PC < 4095 and self.memory[PC] & 0xF0 == 0xF0 and
+                self.memory[PC+1] == 0x0A and self.key_pressed == NO_KEY)
+
+    def stuck(self):
+        """
+        Return True if nothing but the timers can change until a key is
+        pressed: FX0A waiting, or a jump to itself.
+        """
+        PC = self.PC
+        return (PC < 4095 and (self.memory[PC] & 0xF) << 8 | self.memory[PC+1] == PC and
+                self.memory[PC] & 0xF0 == 0x10) or self.waitingForKey()
+
+    def timerTicks(self, cycles):
+        "Return how often the timers tick in the next cycles instructions. Needs clock_rate > 60."
+        #Ticks fall where phase + 60*i passes a multiple of rate
+        phase = self.timer_phase
+        return (phase + 60*cycles - 60) // self.clock_rate - (phase - 60) // self.clock_rate
+
+    def idle(self, cycles):
+        """
+        Account for cycles instructions that change nothing but the clock,
+        such as FX0A waiting for a key, without running them. The timers
+        end exactly as emulateCycle would leave them.
+        """
+        if cycles <= 0:
+            return
+        self.draw_graphics = 0
+        self.key_pressed = NO_KEY
+        rate = self.clock_rate
+        phase = self.timer_phase
+        if rate <= 60: #More than one tick per instruction. Count them out
+            ticks = 0
+            for i in range(cycles):
+                if phase < 60:
+                    ticks += 1
+                phase += 60
+                if phase >= rate:
+                    phase -= rate
+        else:
+            ticks = self.timerTicks(cycles)
+            phase = (phase + 60*cycles) % rate
+        self.timer_phase = phase
+        self.delay_timer = max(0, self.delay_timer - ticks)
+        self.sound_timer = max(0, self.sound_timer - ticks)
+
+    def fastForward(self, limit):
+        """
+        If the CPU is in an idle loop, skip up to limit instructions of it
+        and return how many were skipped, else return 0. The state after is
+        exactly what running them would leave. Idle loops are FX0A waiting,
+        a jump to itself, and polling the delay timer:
+            A:   FX07     VX = DelayTimer
+            A+2: 3XNN     Skip NI if VX == NN
+            A+4: 1A       Jump back to A
+        Skipped instructions do not go through the dispatch table, so a
+        Trace.Tracer or Profile.Profiler never sees them.
+        """
+        PC = self.PC
+        if limit <= 0 or PC > 4090:
+            return 0
+        memory = self.memory
+        high = memory[PC]
+        if high & 0xF0 != 0xF0 and high & 0xF0 != 0x10: #Not an idle loop. The common case
+            return 0
+        if self.stuck():
+            self.idle(limit)
+            return limit
+        if (high & 0xF0 == 0xF0 and memory[PC+1] == 0x07 and memory[PC+2] == 0x30 | high & 0xF and
+                memory[PC+4] == 0x10 | PC >> 8 and memory[PC+5] == PC & 0xFF and self.clock_rate > 60):
+            return self.skipDelayPoll(high & 0xF, memory[PC+3], limit)
+        return 0
+
+    def skipDelayPoll(self, X, NN, limit):
+        "fastForward for the delay timer polling loop at PC, which waits for VX == NN."
+        delay = self.delay_timer
+        def seen(i): #The delay timer as FX07 reads it on pass i of the loop
+            return max(0, delay - self.timerTicks(3*i))
+        #The timer only counts down, so find the first pass that reads NN or
+        # less. If it read less, the loop missed NN and never ends
+        exit = None
+        if delay >= NN:
+            low, high = -1, 1 #seen(low) > NN >= seen(high)
+            while seen(high) > NN:
+                low, high = high, high * 2
+            while high - low > 1:
+                middle = (low + high) // 2
+                if seen(middle) > NN: low = middle
+                else: high = middle
+            if seen(high) == NN:
+                exit = 3*high + 2 #FX07 and the skip of the last pass
+        if exit is not None and exit <= limit:
+            cycles = exit
+            VX = NN
+            PC = self.PC + 6
+        else: #Stop partway through a pass
+            cycles = limit
+            VX = seen((limit - 1) // 3)
+            PC = self.PC + 2 * (limit % 3)
+        self.V[X] = VX
+        self.idle(cycles)
+        self.PC = PC
+        return cycles
+
+    def run(self, cycles):
+        """
+        Run cycles instructions through emulateCycle, or until it exits,
+        fast-forwarding idle loops. Returns (instructions executed, state).
+        Tracers and Profilers miss the fast-forwarded instructions. Step
+        emulateCycle to trace or profile every one.
+        """
+        step = self.emulateCycle
+        executed = 0
+        while executed < cycles:
+            PC = self.PC
+            state = step()
+            if state is not None:
+                return executed, state
+            executed += 1
+            if self.PC <= PC: #Jumped back. Maybe into an idle loop
+                executed += self.fastForward(cycles - executed)
+        return executed, None
 
     def loadFile(self, name):
-        file = open(name, "rb", buffering=0)
-        data = file.readall()
-        self.memory[0x200:len(data)+0x200] = data
+        with open(name, "rb") as file:
+            data = file.read()
+        if len(data) > MAX_ROM_SIZE:
+            raise ValueError("{0} is {1} bytes. A ROM can be at most {2}".format(
+                name, len(data), MAX_ROM_SIZE))
+        self.memory[PROGRAM_START:PROGRAM_START+len(data)] = data
+
+    def boot(self, image):
+        """
+        Load a boot image: all 4096 bytes of memory, with the fontset and a
+        ROM in place (see ROMStore.py). Does initialize() and loadFile() in
+        one copy.
+        """
+        if len(image) != 4096:
+            raise ValueError("a boot image is 4096 bytes, not {0}".format(len(image)))
+        self.memory[:] = image
 
     def emulateCycle(self):
+        "Run one instruction through the opcode dispatch table."
+        self.draw_graphics = 0
+        state = self.dispatch[self.memory[self.PC] << 8 | self.memory[self.PC+1]](self)
+        if state is not None:
+            return state
+        #Timers count down at 60Hz of emulated time
+        if self.timer_phase < 60:
+            if self.delay_timer > 0:
+                self.delay_timer -= 1
+            if self.sound_timer > 0:
+                self.sound_timer -= 1
+        self.timer_phase += 60
+        if self.timer_phase >= self.clock_rate:
+            self.timer_phase -= self.clock_rate
+        #key_pressed flag is reset
+        self.key_pressed = NO_KEY
+
+    def interpretCycle(self):
+        """
+        The original decode-and-execute interpreter. Kept as the reference
+        implementation that emulateCycle is measured and checked against.
+        """
         #Fetch opcode
         self.draw_graphics = 0
         opcode = self.memory[self.PC] << 8 | self.memory[self.PC+1]
@@ -92,50 +689,55 @@ class CPU():
         #MSB = Most Significan Bit
         if nibb1 == 0x0:
             if opcode == 0x0000:
-                DEBUG("NULL")
+                if DEBUGGING: DEBUG("NULL")
                 self.PC += 2
             elif nibb2 > 0x0: #0NNN: Execute System Code. Not used
-                DEBUG("The confusing opcode was executed")
+                if DEBUGGING: DEBUG("The confusing opcode was executed")
                 self.PC += 2
             elif nibb4 == 0x0: #00E0: Clear the screen
-                DEBUG("ClearScreen") ##Debug
-                self.graphics = [[0]*64 for i in range(32)]
-                self.draw_screen = 1
+                if DEBUGGING: DEBUG("ClearScreen") ##Debug
+                self.graphics[:] = BLANK_SCREEN
+                self.draw_graphics = 1
                 self.PC += 2
             elif nibb4 == 0xE: #00EE: Return from subroutine
-                DEBUG("Return from subroutine") ##Debug
-                try:
-                    self.PC = self.stack.pop()
-                except IndexError:
-                    DEBUG("ERROR: Attempt to return from subroutine when no \
+                if DEBUGGING: DEBUG("Return from subroutine") ##Debug
+                if not self.SP:
+                    if DEBUGGING: DEBUG("ERROR: Attempt to return from subroutine when no \
                             call was made.")
                     return "Exit"
-            else: DEBUG("unknown opcode")
+                self.SP -= 1
+                self.PC = self.stack[self.SP]
+            else:
+                if DEBUGGING: DEBUG("unknown opcode")
         elif nibb1 == 0x1: #1NNN: Jumps to NNN
-            DEBUG("Jump to {0}".format(NNN)) ##Debug
+            if DEBUGGING: DEBUG("Jump to {0}".format(NNN)) ##Debug
             self.PC = NNN
         elif nibb1 == 0x2: #2NNN: call subroutine at NNN
-            DEBUG("Call {0}".format(hex(NNN))) ##Debug
-            self.stack.append(self.PC + 2)
+            if DEBUGGING: DEBUG("Call {0}".format(hex(NNN))) ##Debug
+            if self.SP == STACK_SIZE:
+                if DEBUGGING: DEBUG("ERROR: Stack overflow.")
+                return "Exit"
+            self.stack[self.SP] = self.PC + 2
+            self.SP += 1
             self.PC = NNN
         elif nibb1 == 0x3: #3XNN: skip NI if VX == NN
-            DEBUG("Skip NI if V{0} == {1}".format(hex(X),hex(NN))) ##Debug
+            if DEBUGGING: DEBUG("Skip NI if V{0} == {1}".format(hex(X),hex(NN))) ##Debug
             if VX == NN: self.PC += 4 #skip
             else: self.PC += 2
         elif nibb1 == 0x4: #4XNN: skip NI if VX != NN
-            DEBUG("Skip NI if V{0} != {1}".format(hex(X),hex(NN))) ##Debug
+            if DEBUGGING: DEBUG("Skip NI if V{0} != {1}".format(hex(X),hex(NN))) ##Debug
             if VX != NN: self.PC += 4 #skip
             else: self.PC += 2
         elif nibb1 == 0x5: #5XY0: skip NI if VX == VY
-            DEBUG("Skip NI if V{0}[{1}] == V{2}[{3}]".format(hex(X),hex(VX),hex(Y),hex(VY)))
+            if DEBUGGING: DEBUG("Skip NI if V{0}[{1}] == V{2}[{3}]".format(hex(X),hex(VX),hex(Y),hex(VY)))
             if VX == VY: self.PC += 4 #skip
             else: self.PC += 2
         elif nibb1 == 0x6: #6XNN: set VX to NN
-            DEBUG("Set V{0} to {1}".format(hex(X), hex(NN))) ##Debug
+            if DEBUGGING: DEBUG("Set V{0} to {1}".format(hex(X), hex(NN))) ##Debug
             self.V[X] = NN
             self.PC += 2
         elif nibb1 == 0x7: #7XNN: Adds NN to VX
-            DEBUG("Add {0} to V{1}".format(hex(NN), hex(X))) ##Debug
+            if DEBUGGING: DEBUG("Add {0} to V{1}".format(hex(NN), hex(X))) ##Debug
             if VX + NN > 0xFF:
                 self.V[X] = NN - (0xFF - VX) #Carry. No flag is set
             else:
@@ -143,23 +745,23 @@ class CPU():
             self.PC += 2
         elif nibb1 == 0x8:
             if nibb4 == 0x0: #8XY0: sets VX to VY
-                DEBUG("Set V{0} to V{1}[{2}]".format(hex(X),hex(Y),hex(VY))) ##Debug
+                if DEBUGGING: DEBUG("Set V{0} to V{1}[{2}]".format(hex(X),hex(Y),hex(VY))) ##Debug
                 self.V[X] = VY
                 self.PC += 2
             elif nibb4 == 0x1: #8XY1: set VX to (VX or VY)
-                DEBUG("Set V{0} to (V{0}[{1}] or V{2}[{3}])".format(hex(X),hex(VX),hex(Y),hex(VY))) ##Debug
+                if DEBUGGING: DEBUG("Set V{0} to (V{0}[{1}] or V{2}[{3}])".format(hex(X),hex(VX),hex(Y),hex(VY))) ##Debug
                 self.V[X] = VX | VY
                 self.PC += 2
             elif nibb4 == 0x2: #8XY2: set VX to (VX and VY)
-                DEBUG("Set V{0} to (V{0}[{1}] and V{2}[{3}])".format(hex(X),hex(VX),hex(Y),hex(VY))) ##Debug
+                if DEBUGGING: DEBUG("Set V{0} to (V{0}[{1}] and V{2}[{3}])".format(hex(X),hex(VX),hex(Y),hex(VY))) ##Debug
                 self.V[X] = VX & VY
                 self.PC += 2
             elif nibb4 == 0x3: #8XY3: set VX to (VX xor VY)
-                DEBUG("Set V{0} to (V{0}[{1}] xor V{2}[{3}])".format(hex(X),hex(VX),hex(Y),hex(VY))) ##Debug
+                if DEBUGGING: DEBUG("Set V{0} to (V{0}[{1}] xor V{2}[{3}])".format(hex(X),hex(VX),hex(Y),hex(VY))) ##Debug
                 self.V[X] = VX ^ VY
                 self.PC += 2
             elif nibb4 == 0x4: #8XY4: add VY to VX. Sets VF for carry
-                DEBUG("Add V{0}[{1}] to V{2}[{3}]".format(hex(Y),hex(VY),hex(X),hex(VX))) ##Debug
+                if DEBUGGING: DEBUG("Add V{0}[{1}] to V{2}[{3}]".format(hex(Y),hex(VY),hex(X),hex(VX))) ##Debug
                 total = VX + VY
                 if total > 255:
                     self.V[0xF] = 1 # carry
@@ -168,7 +770,7 @@ class CPU():
                 self.V[X] = total
                 self.PC += 2
             elif nibb4 == 0x5: #8XY5: minus VY from VX. Unsets VF when borrow
-                DEBUG("Minus V{0}[{1}] from V{2}[{3}]".format(hex(Y),hex(VY),hex(X),hex(VX))) ##Debug
+                if DEBUGGING: DEBUG("Minus V{0}[{1}] from V{2}[{3}]".format(hex(Y),hex(VY),hex(X),hex(VX))) ##Debug
                 #This code may be wrong, but most likely isn't
                 total = VX - VY
                 if total < 0:
@@ -182,17 +784,17 @@ class CPU():
                 #Modern: VF = LSB of VX. VX = (VX >> 1)
                 #Set the legacy flag for the legacy version
                 if self.legacy:
-                    DEBUG("Shift V{0} to the right. Store in V{1}".format(hex(Y),hex(X)))
+                    if DEBUGGING: DEBUG("Shift V{0} to the right. Store in V{1}".format(hex(Y),hex(X)))
                     self.V[0xF] = int(bin(VY)[-1]) #getting LSB. Tricky in Python.
                     self.V[X] = VY >> 1
                 else: #Use the modern version
-                    DEBUG("Shift V{0} to the right. Store in V{0}".format(hex(X)))
+                    if DEBUGGING: DEBUG("Shift V{0} to the right. Store in V{0}".format(hex(X)))
                     self.V[0xF] = int(bin(VX)[-1])
                     self.V[X] >>= 1
                 self.PC += 2
             elif nibb4 == 0x7: #8XY7: VX = (VY-VX). VF = 0 when borrow
                 #This code may be wrong, but likely isn't
-                DEBUG("V{0} = V{1}[{2}] - V{0}[{3}]".format(hex(X),hex(Y),hex(VY),hex(VX)))
+                if DEBUGGING: DEBUG("V{0} = V{1}[{2}] - V{0}[{3}]".format(hex(X),hex(Y),hex(VY),hex(VX)))
                 total = VY - VX
                 if total < 0:
                     self.V[0xF] = 0 #borrow
@@ -205,48 +807,53 @@ class CPU():
                 #Modern: VF = MSB of VX. VX = (VX << 1)
                 #Set the legacy flag for the legacy version
                 if self.legacy:
-                    DEBUG("Shift V{0} to the left. Store in V{1}".format(hex(Y),hex(X)))
+                    if DEBUGGING: DEBUG("Shift V{0} to the left. Store in V{1}".format(hex(Y),hex(X)))
                     self.V[0xF] = int(bin(VY)[0])
                     self.V[X] = VY << 1
                 else: #Modern version
-                    DEBUG("Shift V{0} to the left. Store in V{0}".format(hex(X)))
+                    if DEBUGGING: DEBUG("Shift V{0} to the left. Store in V{0}".format(hex(X)))
                     self.V[0xF] = int(bin(VX)[0])
                     self.V[X] <<= 1
                 self.PC += 2
             else:
-                DEBUG("unknown Opcode")
+                if DEBUGGING: DEBUG("unknown Opcode")
                 self.PC += 2
         elif nibb1 == 0x9: #9XY0: Skips NI if VX != VY
-            DEBUG("Skip NI if V{0}[{1}] != V{2}[{3}]".format(hex(X),hex(VX),hex(Y),hex(VY)))
+            if DEBUGGING: DEBUG("Skip NI if V{0}[{1}] != V{2}[{3}]".format(hex(X),hex(VX),hex(Y),hex(VY)))
             if VX != VY: self.PC += 4 #skip
             else: self.PC += 2
         elif nibb1 == 0xA: #ANNN: Sets I to address NNN
-            DEBUG("Set I to {0}".format(hex(NNN))) ##Debug
+            if DEBUGGING: DEBUG("Set I to {0}".format(hex(NNN))) ##Debug
             self.I = NNN
             self.PC += 2
         elif nibb1 == 0xB: #BNNN: Jumps to NNN plus V0
-            DEBUG("Jump to {0} plus V0[{1}]".format(hex(NNN),hex(self.V[0x0])))
+            if DEBUGGING: DEBUG("Jump to {0} plus V0[{1}]".format(hex(NNN),hex(self.V[0x0])))
             address = NNN + self.V[0x0]
             if address > 0xFFF: address -= 0xFFF
             self.PC = address
         elif nibb1 == 0xC: #CXNN: VX = (RandomNumber & NN)
-            DEBUG("Set V{0} to RandNumber masked by {1}".format(hex(X),hex(NN)))
-            r = randint(0x00, 0xFF) & NN
+            if DEBUGGING: DEBUG("Set V{0} to RandNumber masked by {1}".format(hex(X),hex(NN)))
+            r = self.rng.getrandbits(8) & NN
             self.V[X] = r
             self.PC += 2
         elif nibb1 == 0xD: #DXYN: Draw sprite data at (VX,VY) starting from I
-            DEBUG("Draw sprite at V{0}[{3}], V{1}[{4}] :: {2} rows high".format(hex(X),hex(Y),N,VX,VY)) ##Debug
+            if DEBUGGING: DEBUG("Draw sprite at V{0}[{3}], V{1}[{4}] :: {2} rows high".format(hex(X),hex(Y),N,VX,VY)) ##Debug
             self.V[0xF] = 0
             for yline in range(N): #N is the height
                 pixel = self.memory[self.I + yline]
                 for xline in range(8):
                     if pixel & (0x80 >> xline) != 0:
-                        try:
-                            if self.graphics[VY+yline][VX+xline] == 1:
-                                self.V[0xF] = 1
-                        except IndexError:
-                            continue
-                        self.graphics[VY+yline][VX+xline] ^= 1
+                        x = VX + xline
+                        y = VY + yline
+                        if self.wrap:
+                            x %= 64
+                            y %= 32
+                        elif x >= 64 or y >= 32:
+                            continue #Clipped
+                        bit = 1 << (63 - x)
+                        if self.graphics[y] & bit:
+                            self.V[0xF] = 1
+                        self.graphics[y] ^= bit
             self.draw_graphics = 1
             self.PC += 2
             #Old Code:
@@ -266,44 +873,44 @@ class CPU():
             """
         elif nibb1 == 0xE:
             if NN == 0x9E: #EX9E: Skip NI if key stored in VX is pressed
-                DEBUG("Skip NI if key V{0}[{1}] is pressed - {2}".format(hex(X),hex(VX),self.key_states[VX]))
+                if DEBUGGING: DEBUG("Skip NI if key V{0}[{1}] is pressed - {2}".format(hex(X),hex(VX),self.key_states[VX]))
                 if self.key_states[VX]:
                     self.PC += 4
                 else:
                     self.PC += 2
             elif NN == 0xA1: #EXA1: Skip NI if key stored in VX is not pressed
-                DEBUG("Skip NI if key V{0}[{1}] is not pressed - {2}".format(hex(X),hex(VX),self.key_states[VX]))
+                if DEBUGGING: DEBUG("Skip NI if key V{0}[{1}] is not pressed - {2}".format(hex(X),hex(VX),self.key_states[VX]))
                 if not self.key_states[VX]:
                     self.PC += 4
                 else:
                     self.PC += 2
             else:
-                DEBUG("Opcode Unknown")
+                if DEBUGGING: DEBUG("Opcode Unknown")
                 self.PC += 2
         elif nibb1 == 0xF:
             if NN == 0x07: #FX07: Store DelayTimer in VX
-                DEBUG("Store DelayTimer[{0}] in V{1}".format(self.delay_timer,hex(X))) ##Debug
+                if DEBUGGING: DEBUG("Store DelayTimer[{0}] in V{1}".format(self.delay_timer,hex(X))) ##Debug
                 self.V[X] = self.delay_timer
                 self.PC += 2
             elif NN == 0x0A: #FX0A: Await keypress, then store result in VX
                 #Possibly buggy. Reacts if key has been pressed the same
                 # cycle as this instruction. Maybe it should react to keypresses
                 # after the cycle this runs.
-                DEBUG("Await Keypress")
-                if self.key_pressed:
+                if DEBUGGING: DEBUG("Await Keypress")
+                if self.key_pressed != NO_KEY:
                     self.V[X] = self.key_pressed
                     self.PC += 2
                 #Execution is halted until keypress, so nothing else happens.                    
             elif NN == 0x15: #FX15: Set DelayTimer to VX
-                DEBUG("Set Delay Timer to V{0}[{1}]".format(hex(X),hex(VX))) ##Debug
+                if DEBUGGING: DEBUG("Set Delay Timer to V{0}[{1}]".format(hex(X),hex(VX))) ##Debug
                 self.delay_timer = VX
                 self.PC += 2
             elif NN == 0x18: #FX18: Set SoundTimer to VX
-                DEBUG("Set Sound Timer to V{0}[{1}]".format(hex(X),hex(VX))) ##Debug
+                if DEBUGGING: DEBUG("Set Sound Timer to V{0}[{1}]".format(hex(X),hex(VX))) ##Debug
                 self.sound_timer = VX
                 self.PC += 2
             elif NN == 0x1E: #FX1E: I += VX
-                DEBUG("I += V{0}[{1}]".format(hex(X),hex(VX)))
+                if DEBUGGING: DEBUG("I += V{0}[{1}]".format(hex(X),hex(VX)))
                 if self.I + VX > 0xFFF:
                     self.I = (VX - (0xFFF - self.I)) #rollover
                     self.V[0xF] = 1 #set the carry flag
@@ -311,11 +918,11 @@ class CPU():
                     self.I += VX
                 self.PC += 2
             elif NN == 0x29: #FX29: Set I to fontset data at VX
-                DEBUG("Set I to sprite V{0}[{1}]".format(hex(X),hex(VX))) ##Debug
+                if DEBUGGING: DEBUG("Set I to sprite V{0}[{1}]".format(hex(X),hex(VX))) ##Debug
                 self.I = VX * 5
                 self.PC += 2
             elif NN == 0x33: #FX33: Stores VX at [I,I+1,I+2] as BCD
-                DEBUG("Store BCD of V{0}[{1}][{2}]".format(hex(X),hex(VX),VX)) ##Debug
+                if DEBUGGING: DEBUG("Store BCD of V{0}[{1}][{2}]".format(hex(X),hex(VX),VX)) ##Debug
                 data = str(VX)
                 if len(data) == 1:
                     data = "00"+data
@@ -324,155 +931,84 @@ class CPU():
                 self.memory[self.I]     = int(data[0])
                 self.memory[self.I + 1] = int(data[1])
                 self.memory[self.I + 2] = int(data[2])
-                DEBUG(str(self.memory[self.I]) +" :: "+ str(self.memory[self.I + 1]) +" :: "+ str(self.memory[self.I + 2]))
+                if DEBUGGING: DEBUG(str(self.memory[self.I]) +" :: "+ str(self.memory[self.I + 1]) +" :: "+ str(self.memory[self.I + 2]))
                 self.PC += 2;
             elif NN == 0x55: #FX55: Stores V0-VX in memory starting with I. I += (X + 1)
-                DEBUG("Write {0} to disk".format("V{0}[{1}]".format(hex(i),hex(self.V[i])) for i in range(X))) ##Debug
+                if DEBUGGING: DEBUG("Write {0} to disk".format("V{0}[{1}]".format(hex(i),hex(self.V[i])) for i in range(X))) ##Debug
                 for i in range(X+1):
                     self.memory[self.I + i] = self.V[i]
                 self.I = self.I+X+1
                 self.PC += 2
             elif NN == 0x65: #FX65: Fills V0-VX from memory stating with I. I += (X + 1)
-                DEBUG("Read {0} data from disk".format(hex(X)))
-                DEBUG(str(self.memory[self.I]) +" :: "+ str(self.memory[self.I + 1]) +" :: "+ str(self.memory[self.I + 2]))
+                if DEBUGGING: DEBUG("Read {0} data from disk".format(hex(X)))
+                if DEBUGGING: DEBUG(str(self.memory[self.I]) +" :: "+ str(self.memory[self.I + 1]) +" :: "+ str(self.memory[self.I + 2]))
                 for i in range(X+1):
                     self.V[i] = self.memory[self.I + i]
                 self.I = self.I+X+1
                 self.PC += 2
             else:
-                DEBUG("Opcode Unknown")
+                if DEBUGGING: DEBUG("Opcode Unknown")
                 self.PC += 2
         else:
-            DEBUG("Unknown opcode :: {0}".format(opcode))
+            if DEBUGGING: DEBUG("Unknown opcode :: {0}".format(opcode))
             self.PC += 2
 
-        #Timers
-        if self.delay_timer > 0:
-            if self.instructions_executed == 0:
+        #Timers count down at 60Hz of emulated time
+        if self.timer_phase < 60:
+            if self.delay_timer > 0:
                 self.delay_timer -= 1
-        if self.sound_timer > 0:
-            print("BEEP!")
-            if self.instructions_executed == 0:
+            if self.sound_timer > 0:
                 self.sound_timer -= 1
+        self.timer_phase += 60
+        if self.timer_phase >= self.clock_rate:
+            self.timer_phase -= self.clock_rate
         #key_pressed flag is reset
-        self.key_pressed = 0
-        #Count amount of instructions executed
-        self.instructions_executed += 1
-        if self.instructions_executed == 14:
-            self.instructions_executed = 0
+        self.key_pressed = NO_KEY
 
-def main(name):
+def main(name, ips=840, turbo=False, seed=None, record=None, frames=None):
+    """
+    Run the ROM at name in a window. If record is a path, the session's
+    input is logged there for Replay.replay. If frames is a path, every
+    frame shown is logged there (see Frames.py).
+    """
+    from Display import Beeper, Renderer
+    from Input import PygameInput
+    from Scheduler import Scheduler
     #Initialize pygame
     pygame.init()
     #64x32 resolution. Each CHIP-8 pixel is a 10x10 PC pixel
     screen = pygame.display.set_mode((640, 320))
     pygame.display.set_caption(name)
-    clock = pygame.time.Clock()
+    renderer = Renderer(screen)
+    beeper = Beeper()
     #Initalize CHIP-8
-    chip8 = CPU()
+    if record is not None and seed is None:
+        seed = random.getrandbits(63) #The log needs a known seed
+    chip8 = CPU(clock_rate=ips, seed=seed)
     chip8.initialize()
     chip8.loadFile(name)
-    while 1:
-        for event in pygame.event.get():
-            if event.type == KEYDOWN:
-                if event.key == K_1: #Key 1
-                    chip8.key_states[0x1] = 1
-                    chip8.key_pressed = 0x1
-                elif event.key == K_2: #Key 2
-                    chip8.key_states[0x2] = 1
-                    chip8.key_pressed = 0x2
-                elif event.key == K_3: #Key 3
-                    chip8.key_states[0x3] = 1
-                    chip8.key_pressed = 0x3
-                elif event.key == K_4: #Key C
-                    chip8.key_states[0xC] = 1
-                    chip8.key_pressed = 0xC
-                elif event.key == K_q: #Key 4
-                    chip8.key_states[0x4] = 1
-                    chip8.key_pressed = 0x4
-                elif event.key == K_w: #Key 5
-                    chip8.key_states[0x5] = 1
-                    chip8.key_pressed = 0x5
-                elif event.key == K_e: #Key 6
-                    chip8.key_states[0x6] = 1
-                    chip8.key_pressed = 0x6
-                elif event.key == K_r: #Key D
-                    chip8.key_states[0xD] = 1
-                    chip8.key_pressed = 0xD
-                elif event.key == K_a: #Key 7
-                    chip8.key_states[0x7] = 1
-                    chip8.key_pressed = 0x7
-                elif event.key == K_s: #Key 8
-                    chip8.key_states[0x8] = 1
-                    chip8.key_pressed = 0x8
-                elif event.key == K_d: #Key 9
-                    chip8.key_states[0x9] = 1
-                    chip8.key_pressed = 0x9
-                elif event.key == K_f: #Key E
-                    chip8.key_states[0xE] = 1
-                    chip8.key_pressed = 0xE
-                elif event.key == K_z: #Key A
-                    chip8.key_states[0xA] = 1
-                    chip8.key_pressed = 0xA
-                elif event.key == K_x: #Key 0
-                    chip8.key_states[0x0] = 1
-                    chip8.key_pressed = 0x0
-                elif event.key == K_c: #Key B
-                    chip8.key_states[0xB] = 1
-                    chip8.key_pressed = 0xB
-                elif event.key == K_v: #Key F
-                    chip8.key_states[0xF] = 1
-                    chip8.key_pressed = 0xF
-            elif event.type == KEYUP:
-                if event.key == K_1: #Key 1
-                    chip8.key_states[0x1] = 0
-                elif event.key == K_2: #Key 2
-                    chip8.key_states[0x2] = 0
-                elif event.key == K_3: #Key 3
-                    chip8.key_states[0x3] = 0
-                elif event.key == K_4: #Key C
-                    chip8.key_states[0xC] = 0
-                elif event.key == K_q: #Key 4
-                    chip8.key_states[0x4] = 0
-                elif event.key == K_w: #Key 5
-                    chip8.key_states[0x5] = 0
-                elif event.key == K_e: #Key 6
-                    chip8.key_states[0x6] = 0
-                elif event.key == K_r: #Key D
-                    chip8.key_states[0xD] = 0
-                elif event.key == K_a: #Key 7
-                    chip8.key_states[0x7] = 0
-                elif event.key == K_s: #Key 8
-                    chip8.key_states[0x8] = 0
-                elif event.key == K_d: #Key 9
-                    chip8.key_states[0x9] = 0
-                elif event.key == K_f: #Key E
-                    chip8.key_states[0xE] = 0
-                elif event.key == K_z: #Key A
-                    chip8.key_states[0xA] = 0
-                elif event.key == K_x: #Key 0
-                    chip8.key_states[0x0] = 0
-                elif event.key == K_c: #Key B
-                    chip8.key_states[0xB] = 0
-                elif event.key == K_v: #Key F
-                    chip8.key_states[0xF] = 0
-            elif event.type == pygame.QUIT:
-                pygame.quit()
-                return
-        if chip8.draw_graphics:
-            #Draw the graphics array
-            #DEBUG(chip8.graphics)
-            screen.fill((0,0,0))
-            for y in range(32):
-                for x in range(64):
-                    if chip8.graphics[y][x]:
-                        screen.fill((255, 255, 255), rect=(x*10, y*10, 10, 10))
-            pygame.display.flip()
-        state = chip8.emulateCycle()
-        if state == "Exit":
-            return
-        clock.tick(840) #currently clocked at 100%
-        
-main("clock.ch8")
+    scheduler = Scheduler(chip8, ips=ips, turbo=turbo, source=PygameInput(),
+                          on_frame=renderer.present, on_sound=beeper.play)
+    if record is not None:
+        from Replay import Recorder
+        recorder = Recorder(record, chip8, seed, name)
+        scheduler.on_input = recorder.hook(scheduler)
+    if frames is not None:
+        from Frames import FrameWriter
+        writer = FrameWriter(frames, chip8, name, scheduler.fps)
+        capture = writer.hook(scheduler)
+        def on_frame(cpu, force=False):
+            capture(cpu)
+            renderer.present(cpu, force)
+        scheduler.on_frame = on_frame
+    scheduler.run()
+    if record is not None:
+        recorder.close(scheduler.cycles)
+    if frames is not None:
+        writer.close(scheduler.frames)
+    pygame.quit()
+
+if __name__ == "__main__":
+    main("clock.ch8")
     
         
@@ -0,0 +1,110 @@
+# Display.py<--Chip8Emulator
+"""
+pygame renderer for the Chip-8 framebuffer.
+Frames are presented at most fps times a second, however fast the CPU
+runs. Each present diffs the packed framebuffer rows against the last
+frame shown, redraws the screen from one scaled 64x32 surface, and only
+pushes the rows that changed to the display.
+Beeper plays the tone for the sound timer.
+"""
+
+import time
+from array import array
+
+import pygame
+
+#Byte of 8 packed pixels -> 8 bytes of palette indexes, MSB first
+EXPAND = [bytes((byte >> (7 - bit)) & 1 for bit in range(8)) for byte in range(256)]
+EARLY = 0.25 #Part of a frame interval a present may come early and still be shown
+
+class Renderer():
+    def __init__(self, screen, fps=60, on=(255, 255, 255), off=(0, 0, 0)):
+        self.screen = screen
+        self.width, self.height = screen.get_size()
+        self.row_height = self.height // 32
+        self.interval = 1.0 / fps
+        self.palette = [off, on]
+        self.pixels = bytearray(64 * 32) #One palette index per Chip-8 pixel
+        self.shown = None #Rows on the display right now
+        self.next_present = 0.0
+
+    def present(self, cpu, force=False, now=None):
+        """
+        Show cpu's framebuffer if a frame is due, or force is set, and it
+        has changed since the last one. Returns True if the display was updated.
+        """
+        if now is None:
+            now = time.perf_counter()
+        if not force:
+            if now < self.next_present - self.interval * EARLY:
+                return False
+            #Keep to the schedule, so presents paced at fps by the caller all land
+            self.next_present += self.interval
+            if self.next_present < now: #Fell behind. Don't burst to catch up
+                self.next_present = now
+        rows = cpu.graphics
+        shown = self.shown
+        if shown is not None and rows == shown:
+            return False
+        changed = [y for y in range(32) if shown is None or rows[y] != shown[y]]
+        pixels = self.pixels
+        for y in changed:
+            row = rows[y]
+            pixels[y*64:y*64+64] = b"".join(EXPAND[(row >> shift) & 0xFF]
+                                            for shift in range(56, -8, -8))
+        self.shown = list(rows)
+        small = pygame.image.frombuffer(pixels, (64, 32), "P")
+        small.set_palette(self.palette)
+        scaled = pygame.transform.scale(small, (self.width, self.height))
+        rects = self.spans(changed)
+        for rect in rects:
+            self.screen.blit(scaled, rect, rect)
+        pygame.display.update(rects)
+        return True
+
+    def spans(self, changed):
+        "Merge runs of changed rows into screen rects."
+        rects = []
+        start = previous = None
+        for y in changed:
+            if previous is not None and y == previous + 1:
+                previous = y
+                continue
+            if start is not None:
+                rects.append(self.rowRect(start, previous))
+            start = previous = y
+        if start is not None:
+            rects.append(self.rowRect(start, previous))
+        return rects
+
+    def rowRect(self, first, last):
+        return pygame.Rect(0, first * self.row_height, self.width,
+                           (last - first + 1) * self.row_height)
+
+class Beeper():
+    "A square wave tone, played while the sound timer is running."
+    def __init__(self, frequency=440, volume=0.2):
+        self.sound = None
+        self.playing = False
+        try:
+            if not pygame.mixer.get_init():
+                pygame.mixer.init()
+            rate, size, channels = pygame.mixer.get_init()
+        except pygame.error: #No audio device. Stay silent
+            return
+        if size != -16: #Only signed 16 bit output is supported
+            return
+        half = max(1, rate // frequency // 2)
+        level = int(32767 * volume)
+        wave = array("h", ([level] * channels) * half + ([-level] * channels) * half)
+        self.sound = pygame.mixer.Sound(buffer=wave.tobytes())
+
+    def play(self, on):
+        "Start or stop the tone."
+        if self.sound is None or on == self.playing:
+            return
+        self.playing = on
+        if on:
+            self.sound.play(-1)
+        else:
+            self.sound.stop()
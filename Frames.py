@@ -0,0 +1,200 @@
+# Frames.py<--Chip8Emulator
+"""
+Frame export for headless runs.
+A FrameWriter snapshots the framebuffer once a frame and hands the
+snapshot to a background thread, which packs it at 1 bit a pixel (256
+bytes, the layout of CPU.framebuffer) and streams it to a frame log, so
+emulation never waits on the disk. Frames are deduplicated: a frame like
+the one before is not logged at all, and a frame seen before is logged
+as a reference to the first copy, found by its hash. A long session of
+mostly static screens costs a few bytes a second.
+readFrames reads a log back, and diffFrames finds the first frame where
+two logs differ, e.g. the same replay run by two engine versions.
+Usage: python Frames.py rom out.c8f [-f frames] [--replay log]
+       python Frames.py --diff a.c8f b.c8f
+"""
+
+import argparse
+import hashlib
+import queue
+import struct
+import sys
+import threading
+
+#magic, version, frames per second, clock_rate, sha256 of the ROM
+HEADER = struct.Struct("<4sHHI32s")
+#frame, id. A record with a new id is followed by the frame's rows
+RECORD = struct.Struct("<II")
+ROWS = struct.Struct(">32Q") #Row by row, leftmost pixel in the top bit
+MAGIC = b"C8FR"
+VERSION = 1
+END = 0xFFFFFFFF #id of the last record. Its frame is the frame count
+
+class FrameWriter():
+    """
+    Writes a frame log of cpu, which must have the ROM at rom loaded and
+    run at fps frames per second of emulated time.
+    """
+    def __init__(self, path, cpu, rom, fps=60):
+        from Replay import hashROM
+        self.file = open(path, "wb")
+        self.file.write(HEADER.pack(MAGIC, VERSION, fps, cpu.clock_rate, hashROM(rom)))
+        self.queue = queue.SimpleQueue() #Unbounded, so put never blocks
+        self.last = None #The last frame queued
+        self.ids = {} #Frame hash -> id, in order of first sight
+        self.records = 0
+        self.error = None
+        self.thread = threading.Thread(target=self.drain, daemon=True)
+        self.thread.start()
+
+    def capture(self, cpu, frame):
+        "Log cpu's framebuffer as frame number frame, if it has changed."
+        rows = cpu.graphics
+        if rows != self.last:
+            self.last = list(rows)
+            self.queue.put((frame, self.last))
+
+    def hook(self, scheduler):
+        "Return a Scheduler on_frame hook that logs each frame."
+        def captured(cpu, force=False):
+            self.capture(cpu, scheduler.frames - 1)
+        return captured
+
+    def drain(self):
+        "The writer thread: pack, deduplicate and write queued frames."
+        file = self.file
+        ids = self.ids
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                frame, rows = item
+                data = ROWS.pack(*rows)
+                digest = hashlib.blake2b(data, digest_size=16).digest()
+                id = ids.get(digest)
+                if id is None:
+                    id = ids[digest] = len(ids)
+                    file.write(RECORD.pack(frame, id) + data)
+                else:
+                    file.write(RECORD.pack(frame, id))
+                self.records += 1
+        except Exception as error: #Reported by close()
+            self.error = error
+
+    def close(self, frames):
+        "End the log after frames frames and wait for the writer to finish."
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is None:
+            self.file.write(RECORD.pack(frames, END))
+        self.file.close()
+        if self.error is not None:
+            raise self.error
+
+def readFrames(path):
+    """
+    Return (header fields, frame count, [(frame, rows), ...]) of a frame
+    log, listing each frame where the screen changed. rows is a tuple of
+    32 packed rows, as in CPU.graphics.
+    """
+    with open(path, "rb") as file:
+        data = file.read()
+    header = HEADER.unpack_from(data)
+    if header[0] != MAGIC or header[1] != VERSION:
+        raise ValueError("{0} is not a version {1} frame log".format(path, VERSION))
+    unique = []
+    changes = []
+    count = None
+    offset = HEADER.size
+    while offset + RECORD.size <= len(data):
+        frame, id = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        if id == END:
+            count = frame
+            break
+        if id == len(unique):
+            unique.append(ROWS.unpack_from(data, offset))
+            offset += ROWS.size
+        changes.append((frame, unique[id]))
+    if count is None: #Cut short. Keep what was written
+        count = changes[-1][0] + 1 if changes else 0
+    return header, count, changes
+
+def diffFrames(a, b):
+    """
+    Return the first frame number where the frame logs at a and b show
+    different screens, or where one ends before the other. None if they match.
+    """
+    count_a, changes_a = readFrames(a)[1:]
+    count_b, changes_b = readFrames(b)[1:]
+    shown_a = shown_b = None
+    i = j = 0
+    while i < len(changes_a) or j < len(changes_b):
+        frame = min(changes_a[i][0] if i < len(changes_a) else count_a,
+                    changes_b[j][0] if j < len(changes_b) else count_b)
+        if frame >= min(count_a, count_b):
+            break
+        if i < len(changes_a) and changes_a[i][0] == frame:
+            shown_a = changes_a[i][1]
+            i += 1
+        if j < len(changes_b) and changes_b[j][0] == frame:
+            shown_b = changes_b[j][1]
+            j += 1
+        if shown_a != shown_b:
+            return frame
+    if count_a != count_b:
+        return min(count_a, count_b)
+    return None
+
+def export(rom, path, frames, log=None):
+    """
+    Run the ROM at rom headlessly and unthrottled for frames 60Hz frames,
+    logging every frame to path. With log, input is played back from an
+    input log (see Replay.py) and the run stops where the log does.
+    Returns the frames run.
+    """
+    import Core
+    from Scheduler import Scheduler
+    source = None
+    seed, ips, legacy, wrap = 0, 840, 0, 0 #As Batch.loadCPU
+    if log is not None:
+        from Replay import ReplayInput
+        source = ReplayInput(log)
+        seed, ips, legacy, wrap = source.header[2:6]
+    cpu = Core.CPU(legacy=legacy, wrap=wrap, clock_rate=ips, seed=seed)
+    cpu.initialize()
+    cpu.loadFile(rom)
+    scheduler = Scheduler(cpu, ips=ips, turbo=True, source=source)
+    writer = FrameWriter(path, cpu, rom, scheduler.fps)
+    scheduler.on_frame = writer.hook(scheduler)
+    try:
+        scheduler.run(frames)
+    finally:
+        writer.close(scheduler.frames)
+    return scheduler.frames
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the frames of a headless Chip-8 run.")
+    parser.add_argument("files", nargs=2, help="rom out.c8f, or with --diff two frame logs")
+    parser.add_argument("-f", "--frames", type=int, default=3600, help="frames to run. Default: a minute")
+    parser.add_argument("--replay", help="input log to play back")
+    parser.add_argument("--diff", action="store_true", help="compare two frame logs")
+    args = parser.parse_args()
+    if args.diff:
+        frame = diffFrames(*args.files)
+        if frame is None:
+            print("identical")
+            return
+        print("frames differ from frame {0}".format(frame))
+        sys.exit(1)
+    import time
+    start = time.perf_counter()
+    frames = export(args.files[0], args.files[1], args.frames, args.replay)
+    elapsed = time.perf_counter() - start
+    header, count, changes = readFrames(args.files[1])
+    print("{0} frames in {1:.2f}s, {2} changes, {3} unique".format(
+        frames, elapsed, len(changes), len({rows for frame, rows in changes})))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+# Input.py<--Chip8Emulator
+"""
+Input sources for the Scheduler.
+A source feeds key events into the Scheduler's CPU. It has three methods:
+poll(scheduler) takes the input for one frame, and returns False to stop
+the run. wait(scheduler) blocks until input may have arrived, and is only
+called while the CPU is stopped on FX0A with nothing else to do, so a ROM
+sitting on a "press any key" screen uses no host CPU. pending(scheduler)
+returns True if the source will deliver more input without a human, so
+the Scheduler keeps emulated time moving instead of blocking.
+Replay.ReplayInput plays back a recorded input log.
+Server.RemoteInput takes keys from a network client.
+"""
+
+try:
+    import pygame
+except ImportError: #Only PygameInput needs pygame
+    pygame = None
+
+#Host key -> Chip-8 key. The keypad's 4x4 grid on the left of a QWERTY keyboard:
+# 1 2 3 C      1 2 3 4
+# 4 5 6 D  ->  q w e r
+# 7 8 9 E      a s d f
+# A 0 B F      z x c v
+KEYMAP = {"1": 0x1, "2": 0x2, "3": 0x3, "4": 0xC,
+          "q": 0x4, "w": 0x5, "e": 0x6, "r": 0xD,
+          "a": 0x7, "s": 0x8, "d": 0x9, "f": 0xE,
+          "z": 0xA, "x": 0x0, "c": 0xB, "v": 0xF}
+
+class PygameInput():
+    "Keys from the pygame window. keymap maps pygame key names to Chip-8 keys."
+    def __init__(self, keymap=KEYMAP):
+        self.keys = {getattr(pygame, "K_" + name): key for name, key in keymap.items()}
+        self.held = [] #Events taken by wait(), for the next poll()
+
+    def handle(self, cpu, event):
+        "Apply one pygame event to cpu. Returns False on quit."
+        if event.type == pygame.KEYDOWN:
+            key = self.keys.get(event.key)
+            if key is not None:
+                cpu.keyDown(key)
+        elif event.type == pygame.KEYUP:
+            key = self.keys.get(event.key)
+            if key is not None:
+                cpu.keyUp(key)
+        elif event.type == pygame.QUIT:
+            return False
+        return True
+
+    def poll(self, scheduler):
+        events = self.held + pygame.event.get()
+        self.held = []
+        for event in events:
+            if self.handle(scheduler.cpu, event) is False:
+                return False
+        return True
+
+    def wait(self, scheduler):
+        #The event is held, not applied: the Scheduler first idles away the
+        # frames that passed while it slept
+        self.held.append(pygame.event.wait())
+        return True
+
+    def pending(self, scheduler):
+        return False
+
+class ScriptedInput():
+    """
+    Keys from a script of (frame, key, down) events, applied at the start
+    of their frame. The run stops if the CPU waits for a key after the
+    script has run out.
+    """
+    def __init__(self, events):
+        self.events = sorted(events, key=lambda event: event[0])
+        self.next = 0 #Index of the next event to apply
+
+    def poll(self, scheduler):
+        events = self.events
+        while self.next < len(events) and events[self.next][0] <= scheduler.frames:
+            frame, key, down = events[self.next]
+            if down:
+                scheduler.cpu.keyDown(key)
+            else:
+                scheduler.cpu.keyUp(key)
+            self.next += 1
+        return True
+
+    def wait(self, scheduler):
+        return False #Nothing more will ever come
+
+    def pending(self, scheduler):
+        return self.next < len(self.events)
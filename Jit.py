@@ -0,0 +1,418 @@
+# Jit.py<--Chip8Emulator
+"""
+Basic block recompiler for the Chip-8 core.
+A block is the straight line code from an address up to and including the
+next jump, skip, call, return, FX0A or memory write (FX33/FX55). Each
+block is translated into Python source, compiled once with exec and cached
+by start address. Registers, I and the timers are held in locals for the
+length of the block and written back once at the end. preload() compiles
+a block at every basic block start Analysis.py finds, so a run finds its
+code compiled instead of discovering it as it goes.
+The result after every block is identical to running the same number of
+instructions through CPU.emulateCycle; Lockstep.py checks this.
+Usage: python Jit.py [cycles]
+"""
+
+import re
+import sys
+
+import Core
+
+MAX_BLOCK = 128 #Longest block, in instructions
+EPILOGUE = "#EPILOGUE {0} {1} {2} {3}" #count, PC, draw_graphics, reset key_pressed
+
+class Block():
+    __slots__ = ("run", "start", "end", "length")
+    def __init__(self, run, start, end, length):
+        self.run = run
+        self.start = start
+        self.end = end
+        self.length = length
+
+class Jit():
+    """
+    Runs a CPU through compiled blocks. Code is compiled for the CPU's
+    legacy flag at the time; after changing it, or after writing to memory
+    other than through the CPU (loadFile, restore), call flush().
+    """
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.blocks = {} #Start address -> Block
+        self.owners = {} #Address -> start addresses of blocks covering it
+        self.code_map = bytearray(4096) #1 where a compiled block lives
+        self.cycles = 0
+        self.namespace = {"drawSprite": Core.drawSprite,
+                          "BLANK_SCREEN": Core.BLANK_SCREEN,
+                          "STACK_SIZE": Core.STACK_SIZE, "DEBUG": Core.DEBUG,
+                          "code_map": self.code_map, "invalidate": self.invalidate}
+
+    def flush(self):
+        "Drop every compiled block."
+        self.blocks.clear()
+        self.owners.clear()
+        self.code_map[:] = bytes(4096)
+
+    def invalidate(self, low, high):
+        "Drop every compiled block covering any of addresses low..high-1."
+        victims = set()
+        for address in range(low, high):
+            victims.update(self.owners.get(address, ()))
+        for start in victims:
+            block = self.blocks.pop(start)
+            for address in range(block.start, block.end):
+                owners = self.owners[address]
+                owners.discard(start)
+                if not owners:
+                    del self.owners[address]
+                    self.code_map[address] = 0
+
+    def preload(self, analysis):
+        "Compile a block at each block start in analysis (see Analysis.py). Returns how many."
+        compiled = 0
+        for start in sorted(analysis.blocks):
+            if start not in self.blocks and self.compile(start) is not None:
+                compiled += 1
+        return compiled
+
+    def compile(self, start):
+        "Compile and cache the block at start. Returns None if it is empty."
+        source, length = translate(self.cpu, start)
+        if not length:
+            return None
+        memory = self.cpu.memory
+        writes = memory[start] & 0xF0 == 0xF0 and memory[start + 1] in (0x33, 0x55)
+        if length == 1 and not writes: #Nothing to hoist. The dispatch handler is faster
+            run = single
+        else:
+            namespace = dict(self.namespace)
+            exec(compile(source, "<block {0:03X}>".format(start), "exec"), namespace)
+            run = namespace["block"]
+        end = start + 2 * length
+        block = self.blocks[start] = Block(run, start, end, length)
+        for address in range(start, end):
+            self.owners.setdefault(address, set()).add(start)
+            self.code_map[address] = 1
+        return block
+
+    def step(self):
+        """
+        Run one block. Returns (instructions executed, state), where state
+        is "Exit" like CPU.emulateCycle, or None. The instruction that
+        exits is not counted as executed.
+        """
+        cpu = self.cpu
+        block = self.blocks.get(cpu.PC)
+        if block is None:
+            block = self.compile(cpu.PC)
+            if block is None: #Nothing compilable here. Let the CPU do it
+                return self.single()
+        executed = block.run(cpu)
+        if executed < 0: #Exited partway through
+            self.cycles -= executed + 1
+            return -executed - 1, "Exit"
+        self.cycles += executed
+        return executed, None
+
+    def single(self):
+        "Run one instruction through the CPU. Returns as step()."
+        if self.cpu.emulateCycle() == "Exit":
+            return 0, "Exit"
+        self.cycles += 1
+        return 1, None
+
+    def run(self, cycles, exact=False):
+        """
+        Run blocks until at least cycles instructions have executed, or the
+        CPU exits. Returns (instructions executed, state). With exact, the
+        tail that would overshoot is single stepped, so exactly cycles
+        instructions run.
+        """
+        if self.cpu.clock_rate <= 60:
+            raise ValueError("the JIT needs a clock_rate above 60")
+        blocks = self.blocks
+        cpu = self.cpu
+        executed = 0
+        while executed < cycles:
+            block = blocks.get(cpu.PC)
+            if block is None:
+                block = self.compile(cpu.PC)
+            if block is None or (exact and block.length > cycles - executed):
+                count, state = self.single()
+                executed += count
+                if state == "Exit":
+                    return executed, state
+                continue
+            count = block.run(cpu)
+            if count < 0:
+                executed += -count - 1
+                self.cycles += -count - 1
+                return executed, "Exit"
+            executed += count
+            self.cycles += count
+        return executed, None
+
+def single(cpu):
+    "Block runner for one instruction blocks."
+    return -1 if cpu.emulateCycle() == "Exit" else 1
+
+def translate(cpu, start):
+    """
+    Return (source, length) for the block at start. The generated function
+    block(cpu) returns the number of instructions it ran, or -(count + 1)
+    when the CPU exits after count instructions.
+    """
+    memory = cpu.memory
+    used = set() #Registers read or written
+    written = set()
+    body = []
+    address = start
+    length = 0
+    draws = 0 #1 if the last instruction run sets draw_graphics
+    end_pc = None #Expression for PC after the block
+    def v(i, write=False):
+        used.add(i)
+        if write:
+            written.add(i)
+        return "v{0:X}".format(i)
+    def ticks(k):
+        #Absolute tick count before instruction k. Differences between two
+        # of these count the timer ticks between them.
+        return "(p0 + {0}) // rate".format(60 * k - 60)
+    def exit(k, pc):
+        #Epilogue for an exit at instruction k. Nothing of that cycle runs.
+        return [EPILOGUE.format(k, pc, 0, int(k > 0)), "return {0}".format(-k - 1)]
+    while length < MAX_BLOCK and address + 1 < len(memory):
+        opcode = memory[address] << 8 | memory[address + 1]
+        nibb1 = opcode >> 12
+        X = (opcode & 0x0F00) >> 8
+        Y = (opcode & 0x00F0) >> 4
+        N = opcode & 0x000F
+        NN = opcode & 0x00FF
+        NNN = opcode & 0x0FFF
+        k = length
+        draws = 0
+        ends = True
+        nxt = address + 2
+        if nibb1 == 0x0:
+            if opcode == 0x0000 or X > 0:
+                ends = False
+            elif N == 0x0: #00E0
+                body.append("graphics[:] = BLANK_SCREEN")
+                draws = 1
+                ends = False
+            elif N == 0xE: #00EE
+                body.append("if not cpu.SP:")
+                body.append("    DEBUG('ERROR: Attempt to return from subroutine when no call was made.')")
+                body.extend("    " + line for line in exit(k, address))
+                body.append("cpu.SP -= 1")
+                body.append("PC = cpu.stack[cpu.SP]")
+                end_pc = "PC"
+            else: #Unknown 00XX. PC does not move
+                end_pc = str(address)
+        elif nibb1 == 0x1:
+            end_pc = str(NNN)
+        elif nibb1 == 0x2:
+            body.append("if cpu.SP == STACK_SIZE:")
+            body.append("    DEBUG('ERROR: Stack overflow.')")
+            body.extend("    " + line for line in exit(k, address))
+            body.append("cpu.stack[cpu.SP] = {0}".format(nxt))
+            body.append("cpu.SP += 1")
+            end_pc = str(NNN)
+        elif nibb1 in (0x3, 0x4):
+            test = "==" if nibb1 == 0x3 else "!="
+            body.append("PC = {0} if {1} {2} {3} else {4}".format(
+                address + 4, v(X), test, NN, nxt))
+            end_pc = "PC"
+        elif nibb1 in (0x5, 0x9):
+            test = "==" if nibb1 == 0x5 else "!="
+            body.append("PC = {0} if {1} {2} {3} else {4}".format(
+                address + 4, v(X), test, v(Y), nxt))
+            end_pc = "PC"
+        elif nibb1 == 0x6:
+            body.append("{0} = {1}".format(v(X, True), NN))
+            ends = False
+        elif nibb1 == 0x7: #Wraps by 255, not 256, like the interpreter
+            body.append("{0} += {1}".format(v(X, True), NN))
+            body.append("if {0} > 255: {0} -= 255".format(v(X)))
+            ends = False
+        elif nibb1 == 0x8:
+            ends = False
+            vx, vy, vf = v(X), v(Y), v(0xF)
+            if N == 0x0:
+                body.append("{0} = {1}".format(v(X, True), vy))
+            elif N in (0x1, 0x2, 0x3):
+                body.append("{0} {1}= {2}".format(v(X, True), "|&^"[N - 1], vy))
+            elif N in (0x4, 0x5, 0x7):
+                if N == 0x4:
+                    body.append("t = {0} + {1}".format(vx, vy))
+                    body.append("if t > 255: {0} = 1; t -= 255".format(v(0xF, True)))
+                    body.append("else: {0} = 0".format(vf))
+                else:
+                    body.append("t = {0} - {1}".format(*((vx, vy) if N == 0x5 else (vy, vx))))
+                    body.append("if t < 0: {0} = 0; t += 255".format(v(0xF, True)))
+                    body.append("else: {0} = 1".format(vf))
+                body.append("{0} = t".format(v(X, True)))
+            elif N == 0x6:
+                if cpu.legacy:
+                    body.append("t = {0}".format(vy))
+                    body.append("{0} = t & 1".format(v(0xF, True)))
+                    body.append("{0} = t >> 1".format(v(X, True)))
+                else:
+                    body.append("{0} = {1} & 1".format(v(0xF, True), vx))
+                    body.append("{0} = {0} >> 1".format(v(X, True)))
+            elif N == 0xE: #The interpreter's "MSB" is always 0
+                if cpu.legacy:
+                    body.append("t = {0}".format(vy))
+                    body.append("{0} = 0".format(v(0xF, True)))
+                    body.append("{0} = t << 1".format(v(X, True)))
+                else:
+                    body.append("{0} = 0".format(v(0xF, True)))
+                    body.append("{0} = {0} << 1".format(v(X, True)))
+                body.append("if {0} > 255: raise ValueError('byte must be in range(0, 256)')".format(vx))
+        elif nibb1 == 0xA:
+            body.append("I = {0}".format(NNN))
+            ends = False
+        elif nibb1 == 0xB:
+            body.append("PC = {0} + {1}".format(NNN, v(0)))
+            body.append("if PC > 0xFFF: PC -= 0xFFF")
+            end_pc = "PC"
+        elif nibb1 == 0xC:
+            body.append("{0} = cpu.rng.getrandbits(8) & {1}".format(v(X, True), NN))
+            ends = False
+        elif nibb1 == 0xD:
+            body.append("{0} = drawSprite(cpu, {1}, {2}, I, {3})".format(
+                v(0xF, True), v(X), v(Y), N))
+            draws = 1
+            ends = False
+        elif nibb1 == 0xE and NN in (0x9E, 0xA1):
+            test = "" if NN == 0x9E else "not "
+            body.append("PC = {0} if {1}cpu.key_states[{2}] else {3}".format(
+                address + 4, test, v(X), nxt))
+            end_pc = "PC"
+        elif nibb1 == 0xF and NN == 0x07:
+            body.append("{0} = dt - ({1} - dref)".format(v(X, True), ticks(k)))
+            body.append("if {0} < 0: {0} = 0".format(v(X)))
+            ends = False
+        elif nibb1 == 0xF and NN == 0x0A:
+            if k == 0: #key_pressed is cleared by every cycle before this one
+                body.append("if cpu.key_pressed != {0}:".format(Core.NO_KEY))
+                body.append("    {0} = cpu.key_pressed".format(v(X, True)))
+                body.append("    PC = {0}".format(nxt))
+                body.append("else: PC = {0}".format(address))
+                end_pc = "PC"
+            else:
+                end_pc = str(address)
+        elif nibb1 == 0xF and NN in (0x15, 0x18):
+            timer = "dt" if NN == 0x15 else "st"
+            body.append("{0} = {1}".format(timer, v(X)))
+            #Ticks from this instruction on count against the new value
+            body.append("{0}ref = {1}".format(timer[0], ticks(k)))
+            ends = False
+        elif nibb1 == 0xF and NN == 0x1E:
+            body.append("if I + {0} > 0xFFF: I = {0} - (0xFFF - I); {1} = 1".format(
+                v(X), v(0xF, True)))
+            body.append("else: I += {0}".format(v(X)))
+            ends = False
+        elif nibb1 == 0xF and NN == 0x29:
+            body.append("I = {0} * 5".format(v(X)))
+            ends = False
+        elif nibb1 == 0xF and NN == 0x33:
+            body.append("if I + 3 > 4096: raise IndexError('bytearray index out of range')")
+            body.append("memory[I] = {0} // 100".format(v(X)))
+            body.append("memory[I + 1] = {0} // 10 % 10".format(v(X)))
+            body.append("memory[I + 2] = {0} % 10".format(v(X)))
+            body.append("if 1 in code_map[I:I+3]: invalidate(I, I + 3)")
+            end_pc = str(nxt)
+        elif nibb1 == 0xF and NN == 0x55:
+            regs = ", ".join(v(i) for i in range(X + 1))
+            body.append("if I + {0} > 4096: raise IndexError('bytearray index out of range')".format(X + 1))
+            body.append("memory[I:I+{0}] = bytes(({1},))".format(X + 1, regs))
+            body.append("if 1 in code_map[I:I+{0}]: invalidate(I, I + {0})".format(X + 1))
+            body.append("I += {0}".format(X + 1))
+            end_pc = str(nxt)
+        elif nibb1 == 0xF and NN == 0x65:
+            regs = ", ".join(v(i, True) for i in range(X + 1))
+            body.append("if I + {0} > 4096: raise IndexError('bytearray index out of range')".format(X + 1))
+            body.append("{0}, = memory[I:I+{1}]".format(regs, X + 1))
+            body.append("I += {0}".format(X + 1))
+            ends = False
+        else: #Unknown opcode. Skipped
+            ends = False
+        length += 1
+        address = nxt
+        if ends:
+            break
+    if not length:
+        return "", 0
+    if end_pc is None:
+        end_pc = str(address)
+    body.append(EPILOGUE.format(length, end_pc, draws, 1))
+    body.append("return {0}".format(length))
+    text = "\n".join(body)
+    uses = lambda name: re.search(r"\b{0}\b".format(name), text) is not None
+    timers = uses("dt") or uses("st")
+    lines = ["def block(cpu):",
+             "    V = cpu.V",
+             "    p0 = cpu.timer_phase",
+             "    rate = cpu.clock_rate"]
+    for name in ("memory", "graphics", "I"):
+        if uses(name):
+            lines.append("    {0} = cpu.{0}".format(name))
+    if timers:
+        lines.extend(["    dt = cpu.delay_timer",
+                      "    st = cpu.sound_timer",
+                      "    dref = sref = (p0 - 60) // rate"])
+    for i in sorted(used):
+        lines.append("    v{0:X} = V[{0}]".format(i))
+    for line in body:
+        match = re.match(r"( *)#EPILOGUE (\d+) (\S+) (\d) (\d)$", line)
+        if match is None:
+            lines.append("    " + line)
+            continue
+        indent, count, pc, draws, reset_key = match.groups()
+        lines.extend("    " + indent + line for line in epilogue(
+            int(count), pc, draws, reset_key == "1", sorted(written),
+            re.search(r"\bI (\+)?= ", text) is not None, timers))
+    return "\n".join(lines) + "\n", length
+
+def epilogue(count, pc, draws, reset_key, written, writes_I, timers):
+    "Lines that store the locals back after count instructions."
+    lines = ["V[{0}] = v{0:X}".format(i) for i in written]
+    if writes_I:
+        lines.append("cpu.I = I")
+    if count and timers: #The block tracks dt and st itself
+        lines.extend(["t = (p0 + {0}) // rate".format(60 * count - 60),
+                      "d = dt - (t - dref)",
+                      "cpu.delay_timer = d if d > 0 else 0",
+                      "d = st - (t - sref)",
+                      "cpu.sound_timer = d if d > 0 else 0"])
+    elif count: #Count down only if a tick fell inside the block
+        lines.extend(["t = (p0 + {0}) // rate - (p0 - 60) // rate".format(60 * count - 60),
+                      "if t:",
+                      "    d = cpu.delay_timer - t",
+                      "    cpu.delay_timer = d if d > 0 else 0",
+                      "    d = cpu.sound_timer - t",
+                      "    cpu.sound_timer = d if d > 0 else 0"])
+    if count:
+        lines.append("cpu.timer_phase = (p0 + {0}) % rate".format(60 * count))
+    lines.append("cpu.draw_graphics = {0}".format(draws))
+    lines.append("cpu.PC = {0}".format(pc))
+    if reset_key:
+        lines.append("cpu.key_pressed = {0}".format(Core.NO_KEY))
+    return lines
+
+def main(cycles):
+    import glob
+    import os
+    from Batch import PROGRAMS
+    from Lockstep import lockstep
+    for path in sorted(glob.glob(os.path.join(PROGRAMS, "*.ch8"))):
+        divergence = lockstep(path, "dispatch", "jit", cycles)["divergence"]
+        if divergence is None:
+            print("{0:<18}ok".format(os.path.basename(path)))
+        else:
+            print("{0:<18}cycle {1}, PC={2:03X}: {3}".format(os.path.basename(path),
+                  divergence["cycle"], divergence["PC"], ", ".join(divergence["diff"])))
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
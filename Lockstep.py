@@ -0,0 +1,559 @@
+# Lockstep.py<--Chip8Emulator
+"""
+Differential testing of engines and quirk settings.
+lockstep() runs one ROM on two sides, each an engine with its own quirk
+settings, from the same seed and through the same input log, and stops
+at the first instruction after which they disagree. It reports the
+cycle, the PC and opcode of that instruction, and what differs.
+Each engine is stepped its own way: the jit a compiled block at a time
+(preloaded from the ROM's Analysis), run a Scheduler frame's batch at a
+time, fast-forwarding as it goes, the rest an instruction at a time. The
+side with the coarser steps leads, the other runs as many instructions,
+and they are compared after each step. When a step diverges, both replay
+it an instruction at a time to find the culprit. If that does not
+diverge, the leader's own way of running it is wrong, and the whole
+step is reported.
+Sides are given as "engine[,quirk[=0|1]]...", e.g. "dispatch",
+"jit,legacy" or "dispatch,fixed". Engines are interpret
+(CPU.interpretCycle), dispatch (CPU.emulateCycle), run (CPU.run, which
+fast-forwards idle loops), jit (Jit.py, exact) and vector (a one-machine
+VectorCPU). Quirks are the CPU's legacy and wrap flags, and fixed, which
+swaps in textbook arithmetic for the core's odd ops: 7XNN/8XY4 wrap by
+256 not 255, 8XY5/8XY7 borrow by 256, and 8XYE sets VF to the MSB and
+drops bits shifted out, where the core always clears VF and faults.
+With every set above 1 the sides run stretches of that many cycles their
+fastest way and only compare a hash of their state. After a mismatch
+both go back to the last agreeing check and step through the stretch as
+above. If stepping finds nothing, the stretch itself is reported.
+A difference that heals before the sides are next compared, say a
+register overwritten straight after, is missed: inside a jit block or a
+run batch, or with every, inside a stretch.
+Usage: python Lockstep.py rom [-a side] [-b side] [-c cycles] [-n every] [--log input.log]
+       python Lockstep.py rom --check
+"""
+
+import argparse
+import hashlib
+import sys
+
+import Core
+from Analysis import disassemble
+from Replay import END, KEY_DOWN, KEY_PRESSED, hashROM, readLog
+from SaveState import loadState, saveState
+
+QUIRKS = ("legacy", "wrap", "fixed")
+ENGINES = ("interpret", "dispatch", "run", "jit", "vector")
+COARSE = ("run", "jit") #Engines whose own steps are more than one instruction
+CHECKPOINT = 1000 #Cycles between the checkpoints a diverging step is replayed from
+
+#The core's odd ops, done the textbook way, for the fixed quirk
+def op_7XNN(X, NN):
+    def op(cpu):
+        cpu.V[X] = (cpu.V[X] + NN) & 0xFF
+        cpu.PC += 2
+    return op
+
+def op_8XY4(X, Y):
+    def op(cpu):
+        V = cpu.V
+        total = V[X] + V[Y]
+        V[0xF] = total >> 8
+        V[X] = total & 0xFF
+        cpu.PC += 2
+    return op
+
+def op_8XY5(X, Y):
+    def op(cpu):
+        V = cpu.V
+        total = V[X] - V[Y]
+        V[0xF] = int(total >= 0)
+        V[X] = total & 0xFF
+        cpu.PC += 2
+    return op
+
+def op_8XY7(X, Y):
+    def op(cpu):
+        V = cpu.V
+        total = V[Y] - V[X]
+        V[0xF] = int(total >= 0)
+        V[X] = total & 0xFF
+        cpu.PC += 2
+    return op
+
+def op_8XYE(X, Y):
+    def op(cpu):
+        V = cpu.V
+        value = V[Y] if cpu.legacy else V[X]
+        V[0xF] = value >> 7
+        V[X] = (value << 1) & 0xFF
+        cpu.PC += 2
+    return op
+
+class FixedDispatch(Core.DispatchTable):
+    "The core's dispatch table, with the fixed quirk's handlers for 7XNN, 8XY4/5/7 and 8XYE."
+    def __missing__(self, opcode):
+        X = (opcode & 0x0F00) >> 8
+        Y = (opcode & 0x00F0) >> 4
+        if opcode >> 12 == 0x7:
+            handler = op_7XNN(X, opcode & 0xFF)
+        elif opcode >> 12 == 0x8 and opcode & 0xF in (0x4, 0x5, 0x7, 0xE):
+            handler = {0x4: op_8XY4, 0x5: op_8XY5, 0x7: op_8XY7, 0xE: op_8XYE}[opcode & 0xF](X, Y)
+        else:
+            handler = Core.DISPATCH[opcode]
+        self[opcode] = handler
+        return handler
+
+FIXED = FixedDispatch()
+
+class Side():
+    """
+    One side of a lockstep run: a CPU and the engine stepping it.
+    step(limit) runs one of the engine's own steps: a block for jit, a
+    frame's batch for run (so it fast-forwards as the Scheduler would),
+    else one instruction. run(cycles) runs a stretch the engine's fastest
+    way. Both return (instructions executed, outcome), outcome being None,
+    "exit", or "fault: error" for an exception. The instruction that exits
+    or faults is not counted. An engine that cannot tell where in a step
+    it faulted returns None instructions.
+    """
+    def __init__(self, spec, rom, seed=0, clock_rate=840, legacy=0, wrap=0):
+        self.spec = spec
+        name, *quirks = spec.split(",")
+        flags = {"legacy": legacy, "wrap": wrap, "fixed": 0}
+        for quirk in quirks:
+            quirk, equals, value = quirk.partition("=")
+            if quirk not in QUIRKS:
+                raise ValueError("unknown quirk {0!r}. Quirks: {1}".format(quirk, ", ".join(QUIRKS)))
+            flags[quirk] = int(value) if equals else 1
+        if name not in ENGINES:
+            raise ValueError("unknown engine {0!r}. Engines: {1}".format(name, ", ".join(ENGINES)))
+        if flags["fixed"] and name not in ("dispatch", "run"):
+            raise ValueError("the fixed quirk needs the dispatch or run engine")
+        self.engine = name
+        self.coarse = name in COARSE
+        self.unit = 1 #Instructions the last step tried to run
+        cpu = Core.CPU(legacy=flags["legacy"], wrap=flags["wrap"], clock_rate=clock_rate, seed=seed)
+        cpu.initialize()
+        cpu.loadFile(rom)
+        if flags["fixed"]:
+            cpu.dispatch = FIXED
+        self.cpu = cpu
+        self.batch = max(1, clock_rate // 60) #Instructions a Scheduler frame runs
+        self.jit = self.machines = self.analysis = None
+        if name == "jit":
+            from Analysis import analyzeFile
+            from Jit import Jit
+            self.jit = Jit(cpu)
+            self.analysis = analyzeFile(rom)
+            self.jit.preload(self.analysis)
+        elif name == "vector":
+            from Vector import VectorCPU
+            self.machines = VectorCPU.fromCPUs([cpu])
+            self.machines.rng[0] = cpu.rng
+
+    def state(self):
+        "Return a CPU holding this side's current state."
+        if self.machines is not None:
+            return self.machines.getCPU(0)
+        return self.cpu
+
+    def save(self):
+        "Return a checkpoint for load()."
+        return saveState(self.state())
+
+    def load(self, checkpoint):
+        "Go back to a checkpoint taken by save()."
+        cpu = self.cpu
+        loadState(cpu, checkpoint)
+        if self.jit is not None:
+            self.jit.flush()
+            self.jit.preload(self.analysis)
+        if self.machines is not None:
+            from Vector import RUNNING
+            self.machines.setCPU(0, cpu)
+            self.machines.rng[0] = cpu.rng
+            self.machines.status[0] = RUNNING
+
+    def key(self, key, down=None, pressed=False):
+        "Set key's held state to down, and/or report it as pressed this cycle."
+        if self.machines is not None:
+            if down is not None:
+                self.machines.key_states[0, key] = down
+            if pressed:
+                self.machines.key_pressed[0] = key
+            return
+        if down is not None:
+            self.cpu.key_states[key] = down
+        if pressed:
+            self.cpu.key_pressed = key
+
+    def step(self, limit):
+        "Run one of the engine's own steps, of at most limit instructions."
+        if self.engine == "jit":
+            jit = self.jit
+            PC = self.cpu.PC
+            block = jit.blocks.get(PC) or jit.compile(PC)
+            if block is None or block.length > limit: #The rest of the block runs next time
+                self.unit = 1
+                try:
+                    count, state = jit.single()
+                except Exception as error:
+                    return 0, "fault: {0!r}".format(error)
+            else:
+                self.unit = block.length
+                try:
+                    count, state = jit.step()
+                except Exception as error:
+                    return None, "fault: {0!r}".format(error) #Somewhere in the block
+            return count, "exit" if state == "Exit" else None
+        if self.engine == "run":
+            self.unit = min(limit, self.batch)
+            return self.run(self.unit)
+        self.unit = 1
+        return self.run(1)
+
+    def run(self, cycles):
+        "Run cycles instructions."
+        if self.engine == "jit":
+            try:
+                executed, state = self.jit.run(cycles, exact=True)
+            except Exception as error:
+                return None, "fault: {0!r}".format(error) #Somewhere in a block
+            return executed, "exit" if state == "Exit" else None
+        if self.engine == "vector":
+            from Vector import EXITED
+            machines = self.machines
+            executed = machines.run(cycles)
+            if executed == cycles:
+                return executed, None
+            return executed, "exit" if machines.status[0] == EXITED else "fault: vector"
+        if self.engine == "run":
+            try:
+                executed, state = self.cpu.run(cycles)
+            except Exception as error:
+                return None, "fault: {0!r}".format(error) #Somewhere in a fast-forward
+            return executed, "exit" if state == "Exit" else None
+        step = self.cpu.interpretCycle if self.engine == "interpret" else self.cpu.emulateCycle
+        for executed in range(cycles):
+            try:
+                if step() == "Exit":
+                    return executed, "exit"
+            except Exception as error:
+                return executed, "fault: {0!r}".format(error)
+        return cycles, None
+
+def stateHash(cpu):
+    "Return a digest of cpu's machine state, leaving out its configuration."
+    parts = [bytes(cpu.memory), bytes(cpu.V), cpu.stack[:cpu.SP].tobytes()]
+    parts.append(repr((cpu.I, cpu.PC, cpu.SP, cpu.delay_timer, cpu.sound_timer,
+                       cpu.timer_phase, tuple(cpu.graphics))).encode())
+    return hashlib.blake2b(b"".join(parts), digest_size=16).digest()
+
+def stateDiff(a, b):
+    "Return what differs between CPUs a and b, as {name: (a's value, b's value)}."
+    diff = {}
+    for name in ("I", "PC", "SP", "delay_timer", "sound_timer", "timer_phase"):
+        if getattr(a, name) != getattr(b, name):
+            diff[name] = (getattr(a, name), getattr(b, name))
+    for i in range(16):
+        if a.V[i] != b.V[i]:
+            diff["V{0:X}".format(i)] = (a.V[i], b.V[i])
+    if a.stack[:a.SP] != b.stack[:b.SP]:
+        diff["stack"] = (list(a.stack[:a.SP]), list(b.stack[:b.SP]))
+    addresses = [i for i in range(4096) if a.memory[i] != b.memory[i]]
+    if addresses:
+        diff["memory"] = {"{0:03X}".format(i): (a.memory[i], b.memory[i]) for i in addresses[:16]}
+    rows = [y for y in range(32) if a.graphics[y] != b.graphics[y]]
+    if rows:
+        diff["graphics"] = {y: ("{0:016X}".format(a.graphics[y]), "{0:016X}".format(b.graphics[y]))
+                            for y in rows}
+    return diff
+
+def sameState(a, b):
+    "Return True if CPUs a and b are in the same machine state."
+    return (a.PC == b.PC and a.V == b.V and a.I == b.I and a.SP == b.SP and
+            a.delay_timer == b.delay_timer and a.sound_timer == b.sound_timer and
+            a.timer_phase == b.timer_phase and a.graphics == b.graphics and
+            a.stack[:a.SP] == b.stack[:b.SP] and a.memory == b.memory)
+
+class Pair():
+    """
+    Two sides run together through an input log's events. The side with
+    the coarser steps leads: it takes one of its own steps, then the other
+    side runs as many instructions, so each engine is checked on the path
+    it really takes.
+    """
+    def __init__(self, left, right, events=()):
+        self.sides = (left, right)
+        self.leader = 1 if right.coarse and not left.coarse else 0
+        self.events = events
+        self.next_event = 0
+        self.cycle = 0
+
+    def feed(self):
+        "Put in the input for this cycle, as Replay.replay does. Returns False at the end of the log."
+        events = self.events
+        while self.next_event < len(events) and events[self.next_event][0] <= self.cycle:
+            at, kind, key = events[self.next_event]
+            self.next_event += 1
+            if kind == END:
+                return False
+            for side in self.sides:
+                if kind == KEY_PRESSED:
+                    side.key(key, pressed=True)
+                else:
+                    side.key(key, down=int(kind == KEY_DOWN))
+        return True
+
+    def limit(self, stop):
+        "Return stop, or the cycle of the next input if that comes first."
+        if self.next_event < len(self.events):
+            return min(stop, max(self.events[self.next_event][0], self.cycle + 1))
+        return stop
+
+    def save(self):
+        "Return a checkpoint for load()."
+        return self.cycle, self.next_event, [side.save() for side in self.sides]
+
+    def load(self, checkpoint):
+        "Go back to a checkpoint taken by save()."
+        self.cycle, self.next_event, saved = checkpoint
+        for side, state in zip(self.sides, saved):
+            side.load(state)
+
+    def where(self):
+        "Return (PC, opcode at PC) of the next instruction. opcode is None past the end of memory."
+        side = self.sides[self.leader]
+        if side.machines is not None:
+            PC = int(side.machines.PC[0])
+            memory = side.machines.memory[0]
+        else:
+            PC = side.cpu.PC
+            memory = side.cpu.memory
+        return PC, (int(memory[PC]) << 8 | int(memory[PC+1]) if PC < 4095 else None)
+
+    def step(self, limit, fine=False):
+        """
+        Take one step of the leader, of at most limit instructions, and run
+        the follower as far. With fine, both run one instruction. Returns
+        [(instructions executed, outcome), ...] in side order, and how many
+        instructions the step covered.
+        """
+        if fine:
+            return [side.run(1) for side in self.sides], 1
+        leader = self.sides[self.leader]
+        follower = self.sides[1 - self.leader]
+        executed, outcome = leader.step(limit)
+        #A leader that faulted somewhere in its step is followed through all of it
+        budget = leader.unit if executed is None else executed + (outcome is not None)
+        results = [(executed, outcome), follower.run(budget)]
+        if self.leader:
+            results.reverse()
+        return results, leader.unit
+
+    def agree(self, results, hashed=False):
+        """
+        Return True if the sides ran alike: the same outcome, as many
+        instructions, and the same state after. With hashed, states are
+        compared by stateHash.
+        """
+        (count_a, outcome_a), (count_b, outcome_b) = results
+        kind_a = outcome_a and outcome_a.split(":")[0]
+        kind_b = outcome_b and outcome_b.split(":")[0]
+        if kind_a != kind_b:
+            return False
+        if kind_a == "fault": #A faulting op may leave partial writes. Stopping together is enough
+            return True
+        if count_a != count_b:
+            return False
+        left, right = (side.state() for side in self.sides)
+        if hashed:
+            return stateHash(left) == stateHash(right)
+        return sameState(left, right)
+
+    def report(self, where, results, length):
+        "Return the divergence of a step of length instructions from where that ended in results."
+        PC, opcode = where
+        left, right = self.sides
+        return {"cycle": self.cycle, "PC": PC, "opcode": opcode,
+                "instruction": disassemble(opcode) if opcode is not None else None,
+                "length": length,
+                "executed": [executed for executed, outcome in results],
+                "outcomes": [outcome for executed, outcome in results],
+                "diff": stateDiff(left.state(), right.state())}
+
+    def walk(self, stop, checkpoint=None):
+        """
+        Step both sides to cycle stop, comparing them after every step.
+        Returns (divergence, stopped): the divergence or None, and "diverged",
+        "exit", "fault", "log" at the end of the input log, or None if
+        they got to stop. checkpoint is an earlier save() to replay from
+        when a divergence needs narrowing down. By default it is taken now.
+        """
+        if checkpoint is None:
+            checkpoint = self.save()
+        while self.cycle < stop:
+            if not self.feed():
+                return None, "log"
+            where = self.where()
+            results, length = self.step(self.limit(stop) - self.cycle)
+            if not self.agree(results):
+                return self.narrow(checkpoint, where, results, length), "diverged"
+            executed = results[self.leader][0]
+            self.cycle += results[1 - self.leader][0] if executed is None else executed
+            for executed, outcome in results:
+                if outcome is not None:
+                    return None, outcome.split(":")[0]
+            if self.cycle - checkpoint[0] >= CHECKPOINT:
+                checkpoint = self.save()
+        return None, None
+
+    def narrow(self, checkpoint, where, results, length):
+        """
+        Find the instruction in a diverging step of length instructions
+        from where. Both sides replay from checkpoint to the step, then run
+        it one instruction at a time. If that does not diverge, the fault is
+        in the leader's own way of running the step, and the whole step is
+        reported.
+        """
+        divergence = self.report(where, results, length)
+        if length == 1:
+            return divergence
+        target = self.cycle
+        self.load(checkpoint)
+        while self.cycle < target:
+            self.feed()
+            results, count = self.step(self.limit(target) - self.cycle)
+            executed = results[self.leader][0]
+            self.cycle += results[1 - self.leader][0] if executed is None else executed
+        for i in range(length):
+            self.feed()
+            where = self.where()
+            results, count = self.step(1, fine=True)
+            if not self.agree(results):
+                return self.report(where, results, 1)
+            if results[0][1] is not None:
+                break
+            self.cycle += 1
+        self.cycle = target
+        return divergence
+
+def lockstep(rom, a="dispatch", b="jit", cycles=100000, log=None, every=1):
+    """
+    Run the ROM at rom on sides a and b (see the module docstring) for up
+    to cycles instructions, replaying the input log at log if given.
+    Returns a report dict. Its "divergence" is None if the sides agreed
+    all the way, else the cycle, PC, opcode and state diff where they
+    first did not. Its "length" is 1 when that is one instruction, or the
+    instructions in the step or stretch where it showed if no single
+    instruction can be blamed.
+    """
+    events = []
+    config = {}
+    if log is not None:
+        header, events = readLog(log)
+        if hashROM(rom) != header[6]:
+            raise ValueError("{0} is not the ROM {1} was recorded with".format(rom, log))
+        config = dict(zip(("seed", "clock_rate", "legacy", "wrap"), header[2:6]))
+    pair = Pair(Side(a, rom, **config), Side(b, rom, **config), events)
+    if every == 1:
+        divergence, stopped = pair.walk(cycles)
+    else:
+        divergence = stopped = None
+        while pair.cycle < cycles and stopped is None:
+            if not pair.feed():
+                stopped = "log"
+                break
+            stop = pair.limit(min(pair.cycle + every, cycles))
+            checkpoint = pair.save()
+            where = pair.where()
+            results = [side.run(stop - pair.cycle) for side in pair.sides]
+            if results[0][1] is None and results[1][1] is None and pair.agree(results, True):
+                pair.cycle = stop
+                continue
+            #Something differs or stops in this stretch. Go back and step through it
+            stretch = pair.report(where, results, stop - pair.cycle)
+            agreed = pair.agree(results, True) #Before the states are replaced
+            pair.load(checkpoint)
+            divergence, stopped = pair.walk(stop, checkpoint)
+            if stopped is None and not agreed: #Stepping never diverged. The stretch did
+                divergence, stopped = stretch, "diverged"
+    return {"rom": rom, "a": a, "b": b, "cycles": pair.cycle, "stopped": stopped or "budget",
+            "divergence": divergence}
+
+def printReport(report):
+    divergence = report["divergence"]
+    if divergence is None:
+        print("{0} and {1} agree for {2} cycles ({3})".format(
+            report["a"], report["b"], report["cycles"], report["stopped"]))
+        return
+    if divergence["length"] == 1:
+        print("{0} and {1} diverge at cycle {2}, PC={3:03X} {4:04X} {5}".format(
+            report["a"], report["b"], divergence["cycle"], divergence["PC"],
+            divergence["opcode"] or 0, divergence["instruction"] or ""))
+    else:
+        print("{0} and {1} diverge in the {2} instructions from cycle {3}, PC={4:03X} {5:04X} {6}".format(
+            report["a"], report["b"], divergence["length"], divergence["cycle"], divergence["PC"],
+            divergence["opcode"] or 0, divergence["instruction"] or ""))
+        print("  stepping one instruction at a time does not reproduce it")
+    if divergence["outcomes"][0] != divergence["outcomes"][1]:
+        print("  outcome: {0} / {1}".format(*divergence["outcomes"]))
+    if divergence["executed"][0] != divergence["executed"][1]:
+        print("  instructions run: {0} / {1}".format(*divergence["executed"]))
+    for name, values in divergence["diff"].items():
+        print("  {0}: {1}".format(name, values))
+
+def selfCheck(rom):
+    """
+    Check that the harness reports bugs it cannot pin to one instruction.
+    CPU.run is patched to flip V0 after runs of more than limit
+    instructions: a run batch with a limit of 1, a whole stretch with 100.
+    Returns a list of what was missed.
+    """
+    missed = []
+    run = Core.CPU.run
+    for limit, every, length in ((1, 1, None), (100, 997, 997)):
+        def flipping(cpu, cycles):
+            result = run(cpu, cycles)
+            if cycles > limit:
+                cpu.V[0] ^= 1
+            return result
+        Core.CPU.run = flipping
+        try:
+            report = lockstep(rom, "dispatch", "run", 5000, every=every)
+        finally:
+            Core.CPU.run = run
+        divergence = report["divergence"]
+        if divergence is None or divergence["length"] == 1 or length not in (None, divergence["length"]):
+            missed.append("runs over {0} with every {1}: {2}".format(limit, every, report["stopped"]))
+    return missed
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a ROM on two engines or quirk settings and find where they differ.")
+    parser.add_argument("rom")
+    parser.add_argument("-a", default="dispatch", help="first side, e.g. dispatch or run,legacy")
+    parser.add_argument("-b", default="jit", help="second side")
+    parser.add_argument("-c", "--cycles", type=int, default=100000, help="cycles to run")
+    parser.add_argument("-n", "--every", type=int, default=1, help="compare state hashes every n cycles")
+    parser.add_argument("--log", help="input log to play back (see Replay.py)")
+    parser.add_argument("--check", action="store_true", help="check the harness on rom with injected bugs")
+    args = parser.parse_args()
+    debugging = Core.DEBUGGING
+    Core.DEBUGGING = 0
+    if args.check:
+        try:
+            missed = selfCheck(args.rom)
+        finally:
+            Core.DEBUGGING = debugging
+        print("\n".join(missed) or "ok")
+        sys.exit(1 if missed else 0)
+    try:
+        report = lockstep(args.rom, args.a, args.b, args.cycles, args.log, args.every)
+    finally:
+        Core.DEBUGGING = debugging
+    printReport(report)
+    if report["divergence"] is not None:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+# Profile.py<--Chip8Emulator
+"""
+Per-opcode profiling counters for the Chip-8 core.
+A Profiler counts every executed instruction by opcode family and by PC,
+and counts the instructions that drew to the screen. With timing on it
+also adds up the seconds spent in each family. Like Trace.py it works by
+swapping in its own dispatch table, so a CPU that is not being profiled
+runs exactly the same code as before and pays nothing.
+Usage: python Profile.py rom [cycles]
+"""
+
+import sys
+import time
+from array import array
+
+import Core
+
+def family(opcode):
+    "Return the name of opcode's family, e.g. 0xD125 -> 'DXYN'."
+    nibb1 = opcode >> 12
+    if nibb1 == 0x0:
+        if opcode == 0x00E0 or opcode == 0x00EE:
+            return "{0:04X}".format(opcode)
+        return "0NNN"
+    if nibb1 == 0x8:
+        return "8XY{0:X}".format(opcode & 0xF)
+    if nibb1 == 0xE or nibb1 == 0xF:
+        return "{0:X}X{1:02X}".format(nibb1, opcode & 0xFF)
+    return ("", "1NNN", "2NNN", "3XNN", "4XNN", "5XY0", "6XNN", "7XNN", "",
+            "9XY0", "ANNN", "BNNN", "CXNN", "DXYN")[nibb1]
+
+class ProfiledDispatch(Core.DispatchTable):
+    "A dispatch table whose handlers also update a Profiler's counters."
+    def __init__(self, profiler):
+        dict.__init__(self)
+        self.profiler = profiler
+
+    def __missing__(self, opcode):
+        handler = self[opcode] = self.profiler.wrap(opcode, Core.DISPATCH[opcode])
+        return handler
+
+class Profiler():
+    def __init__(self, timing=False):
+        self.timing = timing
+        self.names = [] #Family names, in order of first sight
+        self.index = {} #Family name -> position in names
+        self.counts = [] #Instructions run per family
+        self.seconds = [] #Seconds spent per family, when timing
+        self.pcs = array("I", bytes(4 * 4096)) #Instructions run per address
+        self.draws = 0 #Instructions that set draw_graphics
+        self.dispatch = ProfiledDispatch(self)
+
+    def attach(self, cpu):
+        "Start profiling cpu."
+        cpu.dispatch = self.dispatch
+
+    def detach(self, cpu):
+        "Stop profiling cpu."
+        cpu.dispatch = Core.DISPATCH
+
+    def clear(self):
+        for i in range(len(self.names)):
+            self.counts[i] = 0
+            self.seconds[i] = 0.0
+        self.pcs = array("I", bytes(4 * 4096))
+        self.draws = 0
+
+    def slot(self, name):
+        "Return the counter position of family name, adding it if new."
+        if name not in self.index:
+            self.index[name] = len(self.names)
+            self.names.append(name)
+            self.counts.append(0)
+            self.seconds.append(0.0)
+        return self.index[name]
+
+    def wrap(self, opcode, handler):
+        "Return handler, counting each call."
+        i = self.slot(family(opcode))
+        counts = self.counts
+        profiler = self
+        if not self.timing:
+            def counted(cpu):
+                counts[i] += 1
+                profiler.pcs[cpu.PC] += 1
+                state = handler(cpu)
+                if cpu.draw_graphics:
+                    profiler.draws += 1
+                return state
+            return counted
+        seconds = self.seconds
+        clock = time.perf_counter
+        def timed(cpu):
+            counts[i] += 1
+            profiler.pcs[cpu.PC] += 1
+            start = clock()
+            state = handler(cpu)
+            seconds[i] += clock() - start
+            if cpu.draw_graphics:
+                profiler.draws += 1
+            return state
+        return timed
+
+    def histogram(self):
+        "Return {family: instructions run}, most run first."
+        order = sorted(range(len(self.names)), key=lambda i: -self.counts[i])
+        return {self.names[i]: self.counts[i] for i in order if self.counts[i]}
+
+    def familySeconds(self):
+        "Return {family: seconds spent}, slowest first. Needs timing."
+        order = sorted(range(len(self.names)), key=lambda i: -self.seconds[i])
+        return {self.names[i]: self.seconds[i] for i in order if self.counts[i]}
+
+    def hotPCs(self, n=10):
+        "Return the n most run addresses as [(PC, instructions run), ...]."
+        pcs = self.pcs
+        hot = sorted((PC for PC in range(4096) if pcs[PC]), key=lambda PC: -pcs[PC])
+        return [(PC, pcs[PC]) for PC in hot[:n]]
+
+    def report(self, cpu=None):
+        """
+        Return the counters as a dict for JSON. Given cpu, draw frequency
+        is also given per second of emulated time.
+        """
+        total = sum(self.counts)
+        result = {"instructions": total,
+                  "histogram": self.histogram(),
+                  "hot_pcs": [["{0:03X}".format(PC), count] for PC, count in self.hotPCs()],
+                  "draws": self.draws}
+        if cpu is not None and total:
+            result["draws_per_second"] = self.draws * cpu.clock_rate / total
+        if self.timing:
+            result["family_seconds"] = self.familySeconds()
+            if "DXYN" in self.index:
+                draw = self.index["DXYN"]
+                if self.counts[draw]:
+                    result["DXYN_microseconds"] = 1e6 * self.seconds[draw] / self.counts[draw]
+        return result
+
+def main(path, cycles=20000):
+    from Batch import loadCPU, runCPU
+    cpu = loadCPU(path)
+    profiler = Profiler()
+    profiler.attach(cpu)
+    executed, reason = runCPU(cpu, cycles, fast_forward=False) #Count every instruction
+    report = profiler.report(cpu)
+    print("{0} instructions ({1}), {2} draws, {3:.1f} draws/s".format(
+        executed, reason, report["draws"], report.get("draws_per_second", 0)))
+    for name, count in report["histogram"].items():
+        print("{0:<6}{1:>10}{2:>8.2%}".format(name, count, count / report["instructions"]))
+    print("Hot PCs: " + " ".join("{0}:{1}".format(PC, count) for PC, count in report["hot_pcs"]))
+
+if __name__ == "__main__":
+    main(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 20000)
@@ -0,0 +1,141 @@
+# ROMStore.py<--Chip8Emulator
+"""
+A cache of validated ROMs, for starting many CPUs quickly.
+Each ROM file is read, size checked and hashed once. The store keeps one
+copy of each ROM by SHA-256, however many paths lead to it, as a boot
+image: the 4096 bytes of memory a freshly loaded CPU starts with, the
+fontset and the ROM in place. CPU.boot copies it in with one slice
+assignment, instead of initialize() and loadFile() going to the disk
+for every CPU.
+The index remembers the size, hash and quirk profile of every ROM file
+loaded, keyed by path and checked against the file's size and mtime. It
+can be saved as JSON, so later runs know a ROM set without reading it.
+Usage: python ROMStore.py [--index index.json] [rom ...]
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import sys
+
+import Core
+
+def quirkProfile(data):
+    """
+    Return the CPU quirk flags the ROM's code is sensitive to: "legacy" if
+    it shifts one register into another with 8XY6/8XYE. The ROM is read two
+    bytes at a time from the start, so this is a guess: data and misaligned
+    code are read as instructions too. Whether a ROM needs wrap depends on
+    the coordinates it draws at when it runs, so it is not guessed.
+    """
+    quirks = []
+    for address in range(0, len(data) - 1, 2):
+        high = data[address]
+        low = data[address + 1]
+        if high >> 4 == 0x8 and low & 0xF in (0x6, 0xE) and high & 0xF != low >> 4:
+            quirks.append("legacy")
+            break
+    return quirks
+
+class ROM():
+    "A validated ROM: its bytes, SHA-256, boot image and quirk profile."
+    __slots__ = ("data", "digest", "image", "quirks")
+    def __init__(self, data, name="ROM"):
+        if len(data) > Core.MAX_ROM_SIZE:
+            raise ValueError("{0} is {1} bytes. A ROM can be at most {2}".format(
+                name, len(data), Core.MAX_ROM_SIZE))
+        self.data = bytes(data)
+        self.digest = hashlib.sha256(self.data).hexdigest()
+        image = bytearray(4096)
+        image[:len(Core.CPU.font_set)] = Core.CPU.font_set
+        image[Core.PROGRAM_START:Core.PROGRAM_START+len(data)] = data
+        self.image = bytes(image)
+        self.quirks = quirkProfile(self.data)
+
+    def boot(self, cpu):
+        "Load this ROM into cpu, which must be fresh from CPU()."
+        cpu.boot(self.image)
+
+class ROMStore():
+    def __init__(self, index=None):
+        "index is the path of a JSON index to load, and to write on save()."
+        self.path = index
+        self.index = {} #Absolute path -> [size, mtime_ns, sha256, quirks]
+        self.pool = {} #sha256 -> ROM
+        if index is not None and os.path.exists(index):
+            with open(index) as file:
+                self.index = json.load(file)
+
+    def entry(self, path):
+        "Return path's index entry, or None if it is missing or stale."
+        path = os.path.abspath(path)
+        entry = self.index.get(path)
+        if entry is None:
+            return None
+        stat = os.stat(path)
+        if entry[0] != stat.st_size or entry[1] != stat.st_mtime_ns:
+            return None
+        return entry
+
+    def load(self, path):
+        """
+        Return the ROM at path. The file is only read if it is new or has
+        changed. Raises ValueError if it is too big to load.
+        """
+        entry = self.entry(path)
+        if entry is not None and entry[2] in self.pool:
+            return self.pool[entry[2]]
+        stat = os.stat(path)
+        with open(path, "rb") as file:
+            data = file.read()
+        rom = ROM(data, path)
+        rom = self.pool.setdefault(rom.digest, rom)
+        self.index[os.path.abspath(path)] = [stat.st_size, stat.st_mtime_ns, rom.digest, rom.quirks]
+        return rom
+
+    def info(self, path):
+        "Return {size, sha256, quirks} of the ROM at path, from the index if it can."
+        entry = self.entry(path)
+        if entry is None:
+            self.load(path)
+            entry = self.entry(path)
+        return {"size": entry[0], "sha256": entry[2], "quirks": entry[3]}
+
+    def boot(self, cpu, path):
+        "Load the ROM at path into cpu, which must be fresh from CPU()."
+        cpu.boot(self.load(path).image)
+
+    def save(self, path=None):
+        "Write the index as JSON. The file is replaced atomically."
+        path = path or self.path
+        temp = path + ".tmp"
+        with open(temp, "w") as file:
+            json.dump(self.index, file, indent=1)
+        os.replace(temp, path)
+
+def main():
+    from Batch import PROGRAMS
+    parser = argparse.ArgumentParser(description="Validate and index Chip-8 ROMs.")
+    parser.add_argument("roms", nargs="*", help="ROM files. Default: programs/*.ch8")
+    parser.add_argument("--index", help="JSON index to read and update")
+    args = parser.parse_args()
+    store = ROMStore(args.index)
+    bad = 0
+    for path in args.roms or sorted(glob.glob(os.path.join(PROGRAMS, "*.ch8"))):
+        try:
+            info = store.info(path)
+        except ValueError as error:
+            print(error)
+            bad += 1
+            continue
+        print("{0:<18}{1:>6}  {2:.12}  {3}".format(
+            os.path.basename(path), info["size"], info["sha256"], " ".join(info["quirks"])))
+    if args.index:
+        store.save()
+    if bad:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
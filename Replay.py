@@ -0,0 +1,167 @@
+# Replay.py<--Chip8Emulator
+"""
+Input recording and deterministic replay.
+A Recorder logs every change to the CPU's key_states, and every
+key_pressed, with the cycle it happened before. The log also holds the
+CPU's RNG seed, clock rate and quirk flags and a hash of the ROM, so
+replay() can rebuild the run headlessly, at full speed, and end with the
+same framebuffer bit for bit. Idle loops are fast-forwarded, and a CPU
+stuck waiting on FX0A is idled straight to the next event. ReplayInput plays a log back through a Scheduler.
+Usage: python Replay.py log rom [--jit]
+"""
+
+import hashlib
+import struct
+import sys
+
+import Core
+
+#magic, version, seed, clock_rate, legacy, wrap, sha256 of the ROM
+HEADER = struct.Struct("<4sHQIBB32s")
+#cycle, kind, key
+EVENT = struct.Struct("<QBB")
+MAGIC = b"C8IN"
+VERSION = 1
+KEY_UP = 0
+KEY_DOWN = 1
+KEY_PRESSED = 2 #key_pressed was set
+END = 3 #The recording stopped here
+CHUNK = 1024 #Instructions replayed between checks for a stuck CPU
+
+def hashROM(path):
+    with open(path, "rb") as file:
+        return hashlib.sha256(file.read()).digest()
+
+class Recorder():
+    """
+    Writes an input log for cpu, which must have been made with the given
+    seed and have the ROM at rom loaded.
+    """
+    def __init__(self, path, cpu, seed, rom):
+        self.file = open(path, "wb")
+        self.file.write(HEADER.pack(MAGIC, VERSION, seed, cpu.clock_rate,
+                                    cpu.legacy, cpu.wrap, hashROM(rom)))
+        self.keys = bytearray(cpu.key_states)
+
+    def record(self, cycle, cpu):
+        "Log what changed in cpu's input since the last call."
+        keys = cpu.key_states
+        if keys != self.keys:
+            for key in range(16):
+                if keys[key] != self.keys[key]:
+                    self.file.write(EVENT.pack(cycle, KEY_DOWN if keys[key] else KEY_UP, key))
+            self.keys[:] = keys
+        if cpu.key_pressed != Core.NO_KEY:
+            self.file.write(EVENT.pack(cycle, KEY_PRESSED, cpu.key_pressed))
+
+    def hook(self, scheduler):
+        "Return a Scheduler on_input hook that records the frame's input."
+        def recorded(cpu):
+            self.record(scheduler.cycles, cpu)
+        return recorded
+
+    def close(self, cycle):
+        "End the log at cycle."
+        self.file.write(EVENT.pack(cycle, END, 0))
+        self.file.close()
+
+def readLog(path):
+    "Return (header fields, [(cycle, kind, key), ...]) of an input log."
+    with open(path, "rb") as file:
+        data = file.read()
+    header = HEADER.unpack_from(data)
+    if header[0] != MAGIC or header[1] != VERSION:
+        raise ValueError("{0} is not a version {1} input log".format(path, VERSION))
+    return header, list(EVENT.iter_unpack(data[HEADER.size:]))
+
+def replay(log, rom, jit=False):
+    """
+    Rerun the session recorded in log against the ROM at rom, headless and
+    unthrottled. Returns (cpu, cycles run).
+    """
+    header, events = readLog(log)
+    magic, version, seed, clock_rate, legacy, wrap, rom_hash = header
+    if hashROM(rom) != rom_hash:
+        raise ValueError("{0} is not the ROM {1} was recorded with".format(rom, log))
+    cpu = Core.CPU(legacy=legacy, wrap=wrap, clock_rate=clock_rate, seed=seed)
+    cpu.initialize()
+    cpu.loadFile(rom)
+    if jit:
+        from Jit import Jit
+        engine = Jit(cpu)
+        def run(cycles):
+            return engine.run(cycles, exact=True)
+    else:
+        run = cpu.run
+    def advance(cycles):
+        "Run cycles instructions. A CPU found stuck is idled instead."
+        done = 0
+        while done < cycles:
+            if cpu.stuck(): #Nothing changes until the next event
+                cpu.idle(cycles - done)
+                return cycles, None
+            count, state = run(min(CHUNK, cycles - done))
+            done += count
+            if state == "Exit":
+                return done, state
+        return done, None
+    cycle = 0
+    for at, kind, key in events:
+        if at > cycle:
+            count, state = advance(at - cycle)
+            cycle += count
+            if state == "Exit":
+                break
+        if kind == KEY_DOWN:
+            cpu.key_states[key] = 1
+        elif kind == KEY_UP:
+            cpu.key_states[key] = 0
+        elif kind == KEY_PRESSED:
+            cpu.key_pressed = key
+        elif kind == END:
+            break
+    return cpu, cycle
+
+class ReplayInput():
+    """
+    An input source (see Input.py) playing back the log at path. Events
+    are applied at the first frame that starts at or after their cycle, so
+    the Scheduler must run at the recorded ips for an exact replay.
+    """
+    def __init__(self, path):
+        self.header, self.events = readLog(path)
+        self.next = 0
+
+    def poll(self, scheduler):
+        cpu = scheduler.cpu
+        events = self.events
+        while self.next < len(events) and events[self.next][0] <= scheduler.cycles:
+            at, kind, key = events[self.next]
+            self.next += 1
+            if kind == KEY_DOWN:
+                cpu.key_states[key] = 1
+            elif kind == KEY_UP:
+                cpu.key_states[key] = 0
+            elif kind == KEY_PRESSED:
+                cpu.key_pressed = key
+            elif kind == END:
+                return False
+        return True
+
+    def wait(self, scheduler):
+        return False #The log has run out
+
+    def pending(self, scheduler):
+        return self.next < len(self.events)
+
+def main(log, rom, jit=False):
+    import time
+    start = time.perf_counter()
+    cpu, cycles = replay(log, rom, jit)
+    elapsed = time.perf_counter() - start
+    print("{0} cycles in {1:.2f}s".format(cycles, elapsed))
+    print("framebuffer {0}".format(hashlib.sha1(cpu.framebuffer()).hexdigest()))
+    print("PC={0:03X} I={1:03X} V={2}".format(cpu.PC, cpu.I, bytes(cpu.V).hex()))
+
+if __name__ == "__main__":
+    main(sys.argv[1], sys.argv[2], "--jit" in sys.argv[3:])
@@ -0,0 +1,161 @@
+# SaveState.py<--Chip8Emulator
+"""
+Save states and rewind for the Chip-8 core.
+saveState/loadState turn a CPU's whole state into one fixed size blob of
+bytes and back, held keys and the CXNN generator included, so a seeded
+run carries on from a loaded state exactly as it would have. RewindBuffer keeps the last depth frames of a running
+CPU: a full blob every keyframe_interval frames, and in between only the
+XOR of each blob against the one before, stored as runs of non-zero bytes.
+A frame that only moves a sprite and a few registers costs tens of bytes
+instead of 7KB.
+"""
+
+import os
+import re
+import struct
+from array import array
+from collections import deque
+
+#magic, version, legacy, wrap, clock_rate, memory, V, I, PC, stack, SP,
+# delay timer, sound timer, timer phase, framebuffer rows, key states,
+# key pressed, then the generator: its version, Mersenne Twister words
+# and position, and whether it holds a gauss value, and the value
+STATE = struct.Struct("<4sHBBI4096s16sHH16HBBBI32Q16sbB625IBd")
+MAGIC = b"C8SS"
+VERSION = 2
+NONZERO = re.compile(b"[^\x00]+")
+
+def saveState(cpu):
+    "Return cpu's state as bytes."
+    version, words, gauss = cpu.rng.getstate()
+    return STATE.pack(MAGIC, VERSION, cpu.legacy, cpu.wrap, cpu.clock_rate,
+                      bytes(cpu.memory), bytes(cpu.V), cpu.I, cpu.PC, *cpu.stack,
+                      cpu.SP, cpu.delay_timer, cpu.sound_timer, cpu.timer_phase,
+                      *cpu.graphics, bytes(cpu.key_states), cpu.key_pressed,
+                      version, *words, gauss is not None, gauss or 0.0)
+
+def loadState(cpu, data):
+    "Put cpu into the state saved in data by saveState."
+    fields = STATE.unpack(data)
+    if fields[0] != MAGIC or fields[1] != VERSION:
+        raise ValueError("not a version {0} save state".format(VERSION))
+    cpu.legacy, cpu.wrap, cpu.clock_rate = fields[2:5]
+    memory, V, I, PC = fields[5:9]
+    stack = array("H", fields[9:25])
+    SP, delay_timer, sound_timer, timer_phase = fields[25:29]
+    cpu.restore((memory, V, I, PC, stack.tobytes(), SP, delay_timer,
+                 sound_timer, fields[29:61], timer_phase))
+    cpu.key_states[:] = fields[61]
+    cpu.key_pressed = fields[62]
+    has_gauss, gauss = fields[689:691]
+    cpu.rng.setstate((fields[63], fields[64:689], gauss if has_gauss else None))
+
+def writeState(cpu, path):
+    "Save cpu's state to path. The file is replaced atomically."
+    temp = path + ".tmp"
+    with open(temp, "wb") as file:
+        file.write(saveState(cpu))
+    os.replace(temp, path)
+
+def readState(cpu, path):
+    "Load cpu's state from a file written by writeState."
+    with open(path, "rb") as file:
+        loadState(cpu, file.read())
+
+def diffStates(old, new):
+    "Return the XOR delta from state old to new as [(offset, bytes), ...]."
+    delta = (int.from_bytes(old, "little") ^ int.from_bytes(new, "little")).to_bytes(STATE.size, "little")
+    return [(run.start(), run.group()) for run in NONZERO.finditer(delta)]
+
+def applyDelta(old, delta):
+    "Return state old with a delta from diffStates applied."
+    state = bytearray(old)
+    for offset, run in delta:
+        end = offset + len(run)
+        state[offset:end] = (int.from_bytes(state[offset:end], "little") ^
+                             int.from_bytes(run, "little")).to_bytes(len(run), "little")
+    return bytes(state)
+
+class RewindBuffer():
+    """
+    The states of the last depth captured frames. Capture once a frame;
+    the oldest frames are evicted as new ones arrive.
+    """
+    def __init__(self, depth=600, keyframe_interval=60):
+        self.depth = depth
+        self.keyframe_interval = keyframe_interval
+        #Each entry is (True, full state) or (False, delta from the entry before)
+        self.frames = deque()
+        self.first = 0 #Frame number of frames[0]
+        self.last = None #Full state of the newest frame
+        self.since_key = 0 #Frames since the newest keyframe
+
+    def __len__(self):
+        return len(self.frames)
+
+    def capture(self, cpu):
+        "Store cpu's state as the newest frame. Returns its frame number."
+        state = saveState(cpu)
+        if self.last is None or self.since_key + 1 >= self.keyframe_interval:
+            self.frames.append((True, state))
+            self.since_key = 0
+        else:
+            self.frames.append((False, diffStates(self.last, state)))
+            self.since_key += 1
+        self.last = state
+        if len(self.frames) > self.depth:
+            self.evict()
+        return self.first + len(self.frames) - 1
+
+    def evict(self):
+        "Drop the oldest frame, making the next one a keyframe if needed."
+        keyframe, state = self.frames.popleft()
+        self.first += 1
+        if self.frames and not self.frames[0][0]:
+            self.frames[0] = (True, applyDelta(state, self.frames[0][1]))
+
+    def state(self, frame):
+        "Return the full saved state of frame number frame."
+        index = frame - self.first
+        if not 0 <= index < len(self.frames):
+            raise IndexError("frame {0} is not held".format(frame))
+        key = index
+        while not self.frames[key][0]:
+            key -= 1
+        state = self.frames[key][1]
+        for i in range(key + 1, index + 1):
+            state = applyDelta(state, self.frames[i][1])
+        return state
+
+    def seek(self, cpu, frame):
+        "Put cpu into the state of frame number frame."
+        loadState(cpu, self.state(frame))
+
+    def rewind(self, cpu, frames=1):
+        """
+        Step cpu back frames frames from the newest, and forget the frames
+        after it, so capturing carries on from there.
+        """
+        newest = self.first + len(self.frames) - 1
+        target = max(self.first, newest - frames)
+        state = self.state(target)
+        while self.first + len(self.frames) - 1 > target:
+            self.frames.pop()
+        self.last = state
+        self.since_key = 0
+        for keyframe, data in reversed(self.frames):
+            if keyframe:
+                break
+            self.since_key += 1
+        loadState(cpu, state)
+        return target
+
+    def nbytes(self):
+        "Approximate bytes held by stored frames."
+        total = 0
+        for keyframe, data in self.frames:
+            if keyframe:
+                total += len(data)
+            else:
+                total += sum(8 + len(run) for offset, run in data)
+        return total
@@ -0,0 +1,117 @@
+# Scheduler.py<--Chip8Emulator
+"""
+Paces a CPU in real time, or as fast as possible in turbo mode.
+Time is split into frames of 1/fps seconds. Each frame runs a batch of
+ips/fps instructions, then polls input, presents the display and updates
+the sound, then sleeps until the next frame is due. The CPU's 60Hz timers
+follow emulated time (see CPU.clock_rate), so they stay correct at any
+speed, and turbo mode is a true fast-forward.
+Batches run through CPU.run, which fast-forwards idle loops. While the
+CPU is stuck (waiting on FX0A for a key, or jumping to itself) whole
+batches are accounted for with CPU.idle, and once the sound has stopped
+the scheduler blocks in its input source until something happens.
+"""
+
+import time
+
+MAX_LAG = 0.25 #Seconds behind schedule before giving up on catching up
+
+class Scheduler():
+    def __init__(self, cpu, ips=840, fps=60, turbo=False, source=None,
+                 on_input=None, on_frame=None, on_sound=None):
+        """
+        source is an input source (see Input.py), polled once a frame.
+        on_input(cpu) is called once a frame after it; returning False stops the run.
+        on_frame(cpu, force) is called once a frame to present the display.
+        force is True when the scheduler is about to block, and a display
+        that skips frames to keep its rate must show this one.
+        on_sound(on) is called when the sound timer starts or stops.
+        """
+        self.cpu = cpu
+        self.ips = ips
+        self.fps = fps
+        self.turbo = turbo
+        self.source = source
+        self.on_input = on_input
+        self.on_frame = on_frame
+        self.on_sound = on_sound
+        self.frames = 0
+        self.cycles = 0 #Instructions run so far, idled ones included
+        self.carry = 0 #Instructions owed to the next frame, in 1/fps units
+        self.sounding = False
+        cpu.clock_rate = ips
+
+    def poll(self):
+        "Take this frame's input. Returns False to stop the run."
+        if self.source is not None and self.source.poll(self) is False:
+            return False
+        if self.on_input is not None and self.on_input(self.cpu) is False:
+            return False
+        return True
+
+    def present(self, force=False):
+        "Show the frame and start or stop the tone."
+        cpu = self.cpu
+        if self.on_frame is not None:
+            self.on_frame(cpu, force)
+        if self.on_sound is not None and (cpu.sound_timer > 0) != self.sounding:
+            self.sounding = not self.sounding
+            self.on_sound(self.sounding)
+
+    def idleFrame(self):
+        "Run one frame of a stuck CPU."
+        batch, self.carry = divmod(self.ips + self.carry, self.fps)
+        self.cpu.idle(batch)
+        self.cycles += batch
+        self.frames += 1
+
+    def canBlock(self):
+        "True if nothing can happen until the input source delivers a key."
+        return (self.source is not None and self.cpu.sound_timer == 0 and
+                self.cpu.stuck() and not self.source.pending(self))
+
+    def run(self, frames=None):
+        """
+        Run until input says stop, the CPU exits, or frames more frames
+        have run. Returns "quit", "exit" or "frames".
+        """
+        cpu = self.cpu
+        ips = self.ips
+        fps = self.fps
+        period = 1.0 / fps
+        end = None if frames is None else self.frames + frames
+        next_frame = time.perf_counter()
+        while end is None or self.frames < end:
+            if not self.poll():
+                return "quit"
+            if cpu.stuck(): #The batch would only spin. Skip the spinning
+                self.idleFrame()
+            else:
+                batch, self.carry = divmod(ips + self.carry, fps)
+                executed, state = cpu.run(batch)
+                self.cycles += executed
+                if state == "Exit":
+                    return "exit"
+                self.frames += 1
+            block = self.canBlock()
+            self.present(block) #The last frame before blocking must be seen
+            if block:
+                if self.source.wait(self) is False:
+                    return "quit"
+                if not self.turbo: #Emulated time kept going while we slept
+                    now = time.perf_counter()
+                    while (now - next_frame > period and
+                           (end is None or self.frames < end)):
+                        self.idleFrame()
+                        next_frame += period
+                    next_frame = now
+                continue
+            if self.turbo:
+                continue
+            next_frame += period
+            delay = next_frame - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -MAX_LAG: #Too far behind. Drop the lost time
+                next_frame = time.perf_counter()
+        return "frames"
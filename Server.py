@@ -0,0 +1,409 @@
+# Server.py<--Chip8Emulator
+"""
+Serves Chip-8 sessions to many network clients from one process.
+Each client opens a session on a ROM from the server's ROM directory,
+then sends key events and receives framebuffer deltas: the frame number,
+a mask of the rows that changed since the last frame it was sent, and
+those rows, zlib compressed when that is smaller. Clients that fall
+behind have frames held back. The next delta sent covers them.
+One asyncio task paces every session at 60 frames a second. On each tick
+it runs a frame of each session through the session's Scheduler, in
+turbo mode so it never sleeps, yielding to the event loop every SLICE
+sessions so I/O keeps flowing. A session whose frames take longer than
+HEAVY seconds is moved to a process pool, if there is one: its state
+goes out as a save state, a worker runs the frame, and the new state
+comes back. Clients connect over TCP on localhost, or a Unix socket.
+Client is a minimal client, used by the load test.
+Usage: python Server.py [--port 8888 | --unix path] [-j processes] [--roms dir]
+       python Server.py --bench sessions [--seconds 10] [-j processes]
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import multiprocessing
+import os
+import random
+import struct
+import time
+import zlib
+
+import Core
+from Batch import PROGRAMS
+from ROMStore import ROMStore
+from SaveState import loadState, saveState
+from Scheduler import MAX_LAG, Scheduler
+
+MESSAGE = struct.Struct("<BH") #kind, payload length. The payload follows
+OPEN = struct.Struct("<IQ") #ips, seed. The ROM's name follows
+FRAME = struct.Struct("<II") #frame, bit y set if row y changed. The rows follow
+#Message kinds, client to server
+OPEN_SESSION = 1
+KEY = 2 #Payload: key, 1 for down or 0 for up
+#Server to client
+FRAME_RAW = 3
+FRAME_ZLIB = 4 #As FRAME_RAW, with the rows zlib compressed
+EXIT = 5 #The session has ended. Payload: why
+ERROR = 6 #The request was refused. Payload: why
+
+PORT = 8888
+FPS = 60
+SLICE = 32 #Sessions run between yields to the event loop
+HEAVY = 0.002 #Seconds a frame may take before the session moves to the pool
+MAX_BUFFER = 64 * 1024 #Unsent bytes at which a client's frames are held back
+MAX_IPS = 1000000
+
+def message(kind, payload=b""):
+    return MESSAGE.pack(kind, len(payload)) + payload
+
+async def readMessage(reader):
+    "Return (kind, payload) of the next message. Raises IncompleteReadError at EOF."
+    kind, size = MESSAGE.unpack(await reader.readexactly(MESSAGE.size))
+    return kind, await reader.readexactly(size)
+
+class RemoteInput():
+    "Keys from a network client. An input source (see Input.py), fed by Server."
+    def __init__(self):
+        self.events = [] #(key, down), in order of arrival
+        self.connected = True
+
+    def poll(self, scheduler):
+        cpu = scheduler.cpu
+        for key, down in self.events:
+            if down:
+                cpu.keyDown(key)
+            else:
+                cpu.keyUp(key)
+        self.events = []
+        return self.connected
+
+    def wait(self, scheduler):
+        return True #The server never blocks. A stuck session idles a frame a tick
+
+    def pending(self, scheduler):
+        return bool(self.events)
+
+def runFrame(job):
+    "Run one frame of a session in a pool process. See Session.runRemote."
+    state, events, carry, ips = job
+    cpu = Core.CPU()
+    loadState(cpu, state)
+    source = RemoteInput()
+    source.events = events
+    scheduler = Scheduler(cpu, ips, FPS, turbo=True, source=source)
+    scheduler.carry = carry
+    try:
+        outcome = scheduler.run(1)
+    except Exception as error:
+        outcome = "fault: {0!r}".format(error)
+    return saveState(cpu), scheduler.carry, scheduler.cycles, outcome
+
+class Session():
+    "One client's CPU, the Scheduler running it, and the client's connection."
+    def __init__(self, writer, cpu, ips):
+        self.writer = writer
+        self.input = RemoteInput()
+        self.scheduler = Scheduler(cpu, ips, FPS, turbo=True, source=self.input,
+                                   on_frame=self.present)
+        self.shown = None #Rows the client has
+        self.cost = 0.0 #Seconds per frame, averaged
+        self.remote = False #Frames run in the process pool
+        self.busy = False #A frame is running in the pool
+        self.closed = False
+
+    def present(self, cpu, force=False):
+        "Send the client the rows that changed since its last frame."
+        rows = cpu.graphics
+        shown = self.shown
+        if rows == shown or self.closed:
+            return
+        writer = self.writer
+        if writer.transport.get_write_buffer_size() > MAX_BUFFER:
+            return #The client is behind. The next delta will cover this frame
+        mask = 0
+        data = []
+        for y in range(32):
+            if shown is None or rows[y] != shown[y]:
+                mask |= 1 << y
+                data.append(rows[y].to_bytes(8, "big"))
+        self.shown = list(rows)
+        data = b"".join(data)
+        kind = FRAME_RAW
+        if len(data) > 64:
+            packed = zlib.compress(data, 1)
+            if len(packed) < len(data):
+                data, kind = packed, FRAME_ZLIB
+        writer.write(message(kind, FRAME.pack(self.scheduler.frames, mask) + data))
+
+    def run(self):
+        "Run one frame here."
+        start = time.perf_counter()
+        try:
+            outcome = self.scheduler.run(1)
+        except Exception as error: #A crashing ROM ends its own session only
+            outcome = "fault: {0!r}".format(error)
+        self.cost += (time.perf_counter() - start - self.cost) * 0.1
+        if outcome != "frames":
+            self.end(outcome)
+
+    async def runRemote(self, pool):
+        "Run one frame in pool. A pool that fails ends the session."
+        scheduler = self.scheduler
+        cpu = scheduler.cpu
+        events, self.input.events = self.input.events, []
+        job = (saveState(cpu), events, scheduler.carry, scheduler.ips)
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(pool, runFrame, job)
+        except Exception as error: #A broken pool, or a job that would not pickle
+            self.end("fault: {0!r}".format(error))
+            return
+        finally:
+            self.busy = False
+        if self.closed:
+            return
+        state, scheduler.carry, cycles, outcome = result
+        loadState(cpu, state)
+        scheduler.cycles += cycles
+        scheduler.frames += 1
+        if outcome != "frames":
+            self.end(outcome)
+        else:
+            self.present(cpu)
+
+    def end(self, reason):
+        "Tell the client why its session ended, and hang up."
+        if self.closed:
+            return
+        self.closed = True
+        if reason != "quit" and not self.writer.is_closing():
+            self.writer.write(message(EXIT, reason.encode()))
+        self.writer.close()
+
+class Server():
+    def __init__(self, roms=PROGRAMS, processes=0):
+        "roms is the directory sessions pick ROMs from. processes sizes the pool for heavy sessions."
+        self.roms = roms
+        self.store = ROMStore()
+        self.sessions = []
+        self.pool = None
+        if processes: #Spawned, not forked: a forked worker would hold every open client socket
+            self.pool = concurrent.futures.ProcessPoolExecutor(
+                processes, mp_context=multiprocessing.get_context("spawn"))
+        self.remote = set() #Tasks running frames in the pool
+        self.ticks = 0
+        self.late = 0 #Ticks that started behind schedule
+
+    def open(self, writer, payload):
+        "Start the session asked for by an OPEN_SESSION payload. Returns it, or an error string."
+        if len(payload) < OPEN.size:
+            return "bad OPEN_SESSION"
+        ips, seed = OPEN.unpack_from(payload)
+        if not FPS < ips <= MAX_IPS:
+            return "ips must be above {0} and at most {1}".format(FPS, MAX_IPS)
+        name = os.path.basename(payload[OPEN.size:].decode("utf-8", "replace")) #No paths out of roms
+        path = os.path.join(self.roms, name)
+        if not os.path.isfile(path):
+            return "no ROM named {0!r}".format(name)
+        cpu = Core.CPU(clock_rate=ips, seed=seed)
+        try:
+            self.store.boot(cpu, path)
+        except ValueError as error:
+            return str(error)
+        session = Session(writer, cpu, ips)
+        self.sessions.append(session)
+        return session
+
+    async def handle(self, reader, writer):
+        "Serve one client connection."
+        session = None
+        try:
+            kind, payload = await readMessage(reader)
+            if kind != OPEN_SESSION:
+                session = "expected OPEN_SESSION"
+            else:
+                session = self.open(writer, payload)
+            if isinstance(session, str):
+                writer.write(message(ERROR, session.encode()))
+                session = None
+                return
+            while not session.closed:
+                kind, payload = await readMessage(reader)
+                if kind == KEY and len(payload) == 2 and payload[0] < 16:
+                    session.input.events.append((payload[0], payload[1]))
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass #The client hung up, or the server is shutting down
+        finally:
+            if session is not None:
+                session.input.connected = False
+                session.end("quit")
+            elif not writer.is_closing():
+                writer.close()
+
+    async def tick(self):
+        "Run one frame of every session."
+        pool = self.pool
+        for i, session in enumerate(self.sessions):
+            if session.closed:
+                continue
+            if session.remote:
+                if not session.busy:
+                    session.busy = True #Now, not when the task starts
+                    task = asyncio.ensure_future(session.runRemote(pool))
+                    self.remote.add(task)
+                    task.add_done_callback(self.remote.discard)
+            else:
+                session.run()
+                if pool is not None and session.cost > HEAVY:
+                    session.remote = True
+            if i % SLICE == SLICE - 1:
+                await asyncio.sleep(0)
+        self.sessions = [session for session in self.sessions if not session.closed]
+        self.ticks += 1
+
+    async def pace(self):
+        "Tick FPS times a second, forever."
+        loop = asyncio.get_running_loop()
+        period = 1.0 / FPS
+        next_tick = loop.time()
+        while True:
+            await self.tick()
+            next_tick += period
+            delay = next_tick - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            self.late += 1
+            if delay < -MAX_LAG: #Too far behind. Drop the lost time
+                next_tick = loop.time()
+            await asyncio.sleep(0)
+
+    async def serve(self, host="127.0.0.1", port=PORT, path=None):
+        "Listen on host:port, or on the Unix socket at path, and run until cancelled."
+        if path is not None:
+            listener = await asyncio.start_unix_server(self.handle, path)
+        else:
+            listener = await asyncio.start_server(self.handle, host, port)
+        self.listener = listener
+        async with listener:
+            await self.pace()
+
+    def close(self):
+        for task in list(self.remote):
+            task.cancel()
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+
+class Client():
+    "A connection to a Server. Keeps a copy of its session's framebuffer."
+    def __init__(self):
+        self.rows = [0] * 32
+        self.frame = 0 #Number of the last frame received
+        self.frames = 0 #Frames received
+        self.received = 0 #Bytes received
+        self.ended = None #Why the session ended, once it has
+
+    async def connect(self, rom, ips=840, seed=0, host="127.0.0.1", port=PORT, path=None):
+        "Open a session on the server's ROM named rom."
+        if path is not None:
+            self.reader, self.writer = await asyncio.open_unix_connection(path)
+        else:
+            self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.writer.write(message(OPEN_SESSION, OPEN.pack(ips, seed) + rom.encode()))
+        self.task = asyncio.ensure_future(self.receive())
+
+    async def receive(self):
+        try:
+            while True:
+                kind, payload = await readMessage(self.reader)
+                self.received += MESSAGE.size + len(payload)
+                if kind in (FRAME_RAW, FRAME_ZLIB):
+                    self.frame, mask = FRAME.unpack_from(payload)
+                    data = payload[FRAME.size:]
+                    if kind == FRAME_ZLIB:
+                        data = zlib.decompress(data)
+                    offset = 0
+                    for y in range(32):
+                        if mask >> y & 1:
+                            self.rows[y] = int.from_bytes(data[offset:offset+8], "big")
+                            offset += 8
+                    self.frames += 1
+                elif kind in (EXIT, ERROR):
+                    self.ended = payload.decode()
+                    return
+        except (asyncio.IncompleteReadError, ConnectionError):
+            if self.ended is None:
+                self.ended = "disconnected"
+
+    def key(self, key, down):
+        self.writer.write(message(KEY, bytes((key, int(down)))))
+
+    async def close(self):
+        self.writer.close()
+        await self.task
+
+async def bench(sessions, seconds=10.0, processes=0):
+    """
+    Load test on localhost: a server and sessions clients in this process,
+    on the ROMs in programs/ in turn, pressing random keys. Returns stats.
+    """
+    server = Server(processes=processes)
+    listener = await asyncio.start_server(server.handle, "127.0.0.1", 0)
+    port = listener.sockets[0].getsockname()[1]
+    pacer = asyncio.ensure_future(server.pace())
+    roms = sorted(name for name in os.listdir(PROGRAMS) if name.endswith(".ch8"))
+    clients = []
+    for i in range(sessions):
+        client = Client()
+        await client.connect(roms[i % len(roms)], seed=i, port=port)
+        clients.append(client)
+    rng = random.Random(0)
+    start = time.perf_counter()
+    ticks = server.ticks
+    late = server.late
+    cycles = sum(session.scheduler.cycles for session in server.sessions)
+    while time.perf_counter() - start < seconds:
+        await asyncio.sleep(0.05)
+        for client in rng.sample(clients, max(1, len(clients) // 10)):
+            client.key(rng.randrange(16), rng.random() < 0.5)
+    elapsed = time.perf_counter() - start
+    stats = {"sessions": len(server.sessions),
+             "ticks_per_second": (server.ticks - ticks) / elapsed,
+             "late_ticks": server.late - late,
+             "instructions_per_second": (sum(session.scheduler.cycles for session in server.sessions) - cycles) / elapsed,
+             "remote_sessions": sum(session.remote for session in server.sessions),
+             "frames_received": sum(client.frames for client in clients),
+             "bytes_received": sum(client.received for client in clients),
+             "ended": sum(client.ended is not None for client in clients)}
+    for client in clients:
+        await client.close()
+    pacer.cancel()
+    listener.close()
+    await listener.wait_closed()
+    server.close()
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve Chip-8 sessions over a socket.")
+    parser.add_argument("--port", type=int, default=PORT, help="TCP port on localhost")
+    parser.add_argument("--unix", help="listen on this Unix socket instead")
+    parser.add_argument("--roms", default=PROGRAMS, help="directory of ROMs clients can open")
+    parser.add_argument("-j", "--processes", type=int, default=0, help="pool size for heavy sessions. Default: no pool")
+    parser.add_argument("--bench", type=int, metavar="SESSIONS", help="run a load test with this many sessions instead")
+    parser.add_argument("--seconds", type=float, default=10.0, help="length of the load test")
+    args = parser.parse_args()
+    if args.bench:
+        stats = asyncio.run(bench(args.bench, args.seconds, args.processes))
+        for name, value in stats.items():
+            print("{0:<24}{1:.1f}".format(name, value) if isinstance(value, float) else
+                  "{0:<24}{1}".format(name, value))
+        return
+    server = Server(args.roms, args.processes)
+    try:
+        asyncio.run(server.serve(port=args.port, path=args.unix))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+# Trace.py<--Chip8Emulator
+"""
+Instruction tracing for the Chip-8 core.
+A Tracer records one fixed size binary record per executed instruction into
+a preallocated ring buffer. Nothing is formatted while the emulator runs:
+the buffer is dumped to a file and decoded offline with readTrace.
+Tracing is switched on per CPU by swapping in the tracer's dispatch table,
+so an untraced CPU runs exactly the same code as before.
+Usage: python Trace.py file.trace
+"""
+
+import struct
+import sys
+from collections import namedtuple
+
+import Core
+
+#Record: cycle, PC, opcode, I, delay timer, sound timer, V0..VF.
+#All values are as they stand after the instruction has run. Register
+# deltas are recovered by comparing neighbouring records.
+RECORD = struct.Struct("<IHHHBB16s")
+#File header: magic, version, record size, capacity, records written
+HEADER = struct.Struct("<4sHHII")
+MAGIC = b"C8TR"
+VERSION = 1
+
+TraceRecord = namedtuple("TraceRecord",
+    "cycle PC opcode I delay_timer sound_timer V deltas")
+
+class TracedDispatch(Core.DispatchTable):
+    "A dispatch table whose handlers also write a trace record."
+    def __init__(self, tracer):
+        dict.__init__(self)
+        self.tracer = tracer
+
+    def __missing__(self, opcode):
+        handler = self[opcode] = self.tracer.wrap(opcode, Core.DISPATCH[opcode])
+        return handler
+
+class Tracer():
+    def __init__(self, capacity=1 << 16):
+        self.capacity = capacity
+        self.buffer = bytearray(capacity * RECORD.size)
+        self.count = 0 #Records written since the last clear
+        self.dispatch = TracedDispatch(self)
+
+    def attach(self, cpu):
+        "Start tracing cpu."
+        cpu.dispatch = self.dispatch
+
+    def detach(self, cpu):
+        "Stop tracing cpu."
+        cpu.dispatch = Core.DISPATCH
+
+    def clear(self):
+        self.count = 0
+
+    def wrap(self, opcode, handler):
+        "Return handler, recording a trace record after each call."
+        pack_into = RECORD.pack_into
+        buffer = self.buffer
+        capacity = self.capacity
+        size = RECORD.size
+        tracer = self
+        def traced(cpu):
+            PC = cpu.PC
+            state = handler(cpu)
+            n = tracer.count
+            pack_into(buffer, (n % capacity) * size, n & 0xFFFFFFFF, PC, opcode,
+                      cpu.I, cpu.delay_timer, cpu.sound_timer, cpu.V)
+            tracer.count = n + 1
+            return state
+        return traced
+
+    def records(self):
+        "Return the raw records held, oldest first."
+        size = RECORD.size
+        if self.count <= self.capacity:
+            return bytes(self.buffer[:self.count * size])
+        split = (self.count % self.capacity) * size
+        return bytes(self.buffer[split:] + self.buffer[:split])
+
+    def dump(self, path):
+        "Write the held records to path."
+        with open(path, "wb") as file:
+            file.write(HEADER.pack(MAGIC, VERSION, RECORD.size, self.capacity, self.count))
+            file.write(self.records())
+
+def readTrace(path):
+    """
+    Yield the TraceRecords in a dumped trace, oldest first. deltas maps
+    each register that changed since the previous record to (old, new).
+    The oldest record has no previous record, so its deltas are empty.
+    """
+    with open(path, "rb") as file:
+        magic, version, size, capacity, count = HEADER.unpack(file.read(HEADER.size))
+        if magic != MAGIC or version != VERSION or size != RECORD.size:
+            raise ValueError("{0} is not a version {1} trace".format(path, VERSION))
+        data = file.read()
+    previous = None
+    for cycle, PC, opcode, I, delay, sound, V in RECORD.iter_unpack(data):
+        deltas = {}
+        if previous is not None:
+            for i in range(16):
+                if previous[i] != V[i]:
+                    deltas[i] = (previous[i], V[i])
+        previous = V
+        yield TraceRecord(cycle, PC, opcode, I, delay, sound, V, deltas)
+
+def main(path):
+    for record in readTrace(path):
+        changes = " ".join("V{0:X}:{1:02X}->{2:02X}".format(i, old, new)
+                           for i, (old, new) in sorted(record.deltas.items()))
+        print("{0:>8} {1:03X}: {2:04X}  I={3:03X} DT={4:<3} {5}".format(
+            record.cycle, record.PC, record.opcode, record.I,
+            record.delay_timer, changes))
+
+if __name__ == "__main__":
+    main(sys.argv[1])
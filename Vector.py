@@ -0,0 +1,515 @@
+# Vector.py<--Chip8Emulator
+"""
+Batched Chip-8 engine. A VectorCPU holds the state of any number of
+machines as NumPy arrays and steps them all together: every step fetches
+one opcode per machine, groups the machines by opcode family and runs
+each family as a handful of array operations. Each machine behaves
+exactly like a Core.CPU stepped with emulateCycle, down to the odd
+arithmetic, the quirk flags and what is left behind when an instruction
+raises. Per machine cost falls with the number of machines, so this is
+for fuzzing and validating ROMs by the thousand, not for playing.
+Usage: python Vector.py rom [machines] [cycles]
+"""
+
+import random
+import sys
+
+try:
+    import numpy as np
+except ImportError as error: #Only this module needs numpy
+    raise ImportError("Vector.py needs numpy") from error
+
+import Core
+
+RUNNING = 0
+EXITED = 1 #emulateCycle returned "Exit": a bad return or a stack overflow
+FAULTED = 2 #emulateCycle raised
+
+#Opcode families, in handler order. SKIP is every opcode that only
+# advances PC (0000, 0NNN and unknown opcodes). STALL is an unknown 00XX,
+# which does not even do that.
+FAMILIES = ("SKIP", "STALL", "00E0", "00EE", "1NNN", "2NNN", "3XNN", "4XNN",
+            "5XY0", "6XNN", "7XNN", "8XY0", "8XY1", "8XY2", "8XY3", "8XY4",
+            "8XY5", "8XY6", "8XY7", "8XYE", "9XY0", "ANNN", "BNNN", "CXNN",
+            "DXYN", "EX9E", "EXA1", "FX07", "FX0A", "FX15", "FX18", "FX1E",
+            "FX29", "FX33", "FX55", "FX65")
+
+def familyTable():
+    "Return opcode -> index into FAMILIES for all 64K opcodes, as decodeOpcode decodes them."
+    family = FAMILIES.index
+    opcode = np.arange(1 << 16)
+    nibb1 = opcode >> 12
+    X = (opcode >> 8) & 0xF
+    N = opcode & 0xF
+    NN = opcode & 0xFF
+    table = np.full(1 << 16, family("SKIP"), np.uint8)
+    zero = (nibb1 == 0x0) & (opcode != 0) & (X == 0)
+    table[zero] = family("STALL")
+    table[zero & (N == 0x0)] = family("00E0")
+    table[zero & (N == 0xE)] = family("00EE")
+    for nibble, name in ((0x1, "1NNN"), (0x2, "2NNN"), (0x3, "3XNN"), (0x4, "4XNN"),
+                         (0x5, "5XY0"), (0x6, "6XNN"), (0x7, "7XNN"), (0x9, "9XY0"),
+                         (0xA, "ANNN"), (0xB, "BNNN"), (0xC, "CXNN"), (0xD, "DXYN")):
+        table[nibb1 == nibble] = family(name)
+    for n in (0x0, 0x1, 0x2, 0x3, 0x4, 0x5, 0x6, 0x7, 0xE):
+        table[(nibb1 == 0x8) & (N == n)] = family("8XY{0:X}".format(n))
+    for nn in (0x9E, 0xA1):
+        table[(nibb1 == 0xE) & (NN == nn)] = family("EX{0:02X}".format(nn))
+    for nn in (0x07, 0x0A, 0x15, 0x18, 0x1E, 0x29, 0x33, 0x55, 0x65):
+        table[(nibb1 == 0xF) & (NN == nn)] = family("FX{0:02X}".format(nn))
+    return table
+
+FAMILY = familyTable()
+
+class VectorCPU():
+    """
+    count Chip-8 machines. Machine i's state is row i of each array. legacy,
+    wrap and clock_rate may be given per machine; seeds gives each machine
+    the seed of its own CXNN generator, as CPU(seed=...) does.
+    """
+    def __init__(self, count, legacy=0, wrap=0, clock_rate=840, seeds=None):
+        self.count = count
+        self.legacy = np.zeros(count, bool)
+        self.legacy[:] = legacy
+        self.wrap = np.zeros(count, bool)
+        self.wrap[:] = wrap
+        self.clock_rate = np.zeros(count, np.int64)
+        self.clock_rate[:] = clock_rate
+        self.timer_phase = np.zeros(count, np.int64)
+        self.memory = np.zeros((count, 4096), np.uint8)
+        self.flat_memory = self.memory.reshape(-1) #For fetching with take()
+        self.row_start = np.arange(count, dtype=np.int64) * 4096
+        self.machines = np.arange(count)
+        self.graphics = np.zeros((count, 32), np.uint64) #Rows packed as in Core
+        self.draw_graphics = np.zeros(count, np.uint8)
+        self.V = np.zeros((count, 16), np.uint8)
+        self.I = np.zeros(count, np.int64)
+        self.PC = np.full(count, 0x200, np.int64)
+        self.delay_timer = np.zeros(count, np.int64)
+        self.sound_timer = np.zeros(count, np.int64)
+        self.stack = np.zeros((count, Core.STACK_SIZE), np.uint16)
+        self.SP = np.zeros(count, np.int64)
+        self.key_states = np.zeros((count, 16), np.uint8)
+        self.key_pressed = np.full(count, Core.NO_KEY, np.int64)
+        if seeds is None:
+            seeds = [None] * count
+        self.rng = [random.Random(seed) for seed in seeds]
+        self.status = np.zeros(count, np.uint8) #RUNNING, EXITED or FAULTED
+        self.cycles = np.zeros(count, np.int64) #Instructions completed
+        self.handlers = [getattr(self, "op_" + name) for name in FAMILIES]
+
+    @classmethod
+    def fromCPUs(cls, cpus):
+        "Return a VectorCPU with one machine per CPU, copying their state."
+        machines = cls(len(cpus), seeds=[0] * len(cpus))
+        for i, cpu in enumerate(cpus):
+            machines.setCPU(i, cpu)
+        return machines
+
+    def initialize(self):
+        #Load Fontset into every machine
+        self.memory[:, :len(Core.CPU.font_set)] = np.frombuffer(Core.CPU.font_set, np.uint8)
+
+    def loadFile(self, name):
+        "Load the ROM at name into every machine."
+        with open(name, "rb") as file:
+            data = file.read()
+        self.memory[:, 0x200:0x200+len(data)] = np.frombuffer(data, np.uint8)
+
+    def setCPU(self, i, cpu):
+        "Copy cpu's state into machine i. The machine shares cpu's generator."
+        self.legacy[i] = cpu.legacy
+        self.wrap[i] = cpu.wrap
+        self.clock_rate[i] = cpu.clock_rate
+        self.timer_phase[i] = cpu.timer_phase
+        self.memory[i] = np.frombuffer(bytes(cpu.memory), np.uint8)
+        self.graphics[i] = cpu.graphics
+        self.draw_graphics[i] = cpu.draw_graphics
+        self.V[i] = np.frombuffer(bytes(cpu.V), np.uint8)
+        self.I[i] = cpu.I
+        self.PC[i] = cpu.PC
+        self.delay_timer[i] = cpu.delay_timer
+        self.sound_timer[i] = cpu.sound_timer
+        self.stack[i] = cpu.stack
+        self.SP[i] = cpu.SP
+        self.key_states[i] = np.frombuffer(bytes(cpu.key_states), np.uint8)
+        self.key_pressed[i] = cpu.key_pressed
+        self.rng[i] = cpu.rng
+        self.status[i] = RUNNING
+
+    def getCPU(self, i):
+        "Return a Core.CPU holding machine i's state. It shares the machine's generator."
+        cpu = Core.CPU(legacy=int(self.legacy[i]), wrap=int(self.wrap[i]),
+                       clock_rate=int(self.clock_rate[i]))
+        cpu.restore((self.memory[i].tobytes(), self.V[i].tobytes(), int(self.I[i]),
+                     int(self.PC[i]), self.stack[i].tobytes(), int(self.SP[i]),
+                     int(self.delay_timer[i]), int(self.sound_timer[i]),
+                     [int(row) for row in self.graphics[i]], int(self.timer_phase[i])))
+        cpu.draw_graphics = int(self.draw_graphics[i])
+        cpu.key_states[:] = self.key_states[i].tobytes()
+        cpu.key_pressed = int(self.key_pressed[i])
+        cpu.rng = self.rng[i]
+        return cpu
+
+    def framebuffer(self, i):
+        "Return machine i's framebuffer packed into 256 bytes, as CPU.framebuffer."
+        return self.graphics[i].astype(">u8").tobytes()
+
+    def running(self):
+        "Return the indexes of the machines still running."
+        return np.flatnonzero(self.status == RUNNING)
+
+    def step(self):
+        "Run one instruction on every running machine. Returns how many completed one."
+        everyone = not self.status.any()
+        if everyone: #The common case: whole arrays, no gathering
+            m = self.machines
+        else:
+            m = self.running()
+            if not m.size:
+                return 0
+        self.draw_graphics[m] = 0
+        PC = self.PC[m]
+        off_end = PC >= 4095 #The fetch would run off the end of memory
+        if off_end.any():
+            self.status[m[off_end]] = FAULTED
+            m = m[~off_end]
+            PC = PC[~off_end]
+            everyone = False
+        address = self.row_start[m] + PC
+        opcode = self.flat_memory.take(address).astype(np.int64) << 8 | self.flat_memory.take(address + 1)
+        family = FAMILY[opcode]
+        present = np.flatnonzero(np.bincount(family, minlength=len(FAMILIES))).tolist()
+        if len(present) == 1: #Every machine runs the same kind of instruction
+            self.handlers[present[0]](m, opcode)
+        else:
+            order = np.argsort(family, kind="stable")
+            bounds = np.searchsorted(family[order], present + [len(FAMILIES)]).tolist()
+            for f, start, end in zip(present, bounds, bounds[1:]):
+                group = order[start:end]
+                self.handlers[f](m[group], opcode[group])
+        if everyone and not self.status.any():
+            self.tickTimers()
+            return self.count
+        m = m[self.status[m] == RUNNING]
+        self.tickTimers(m)
+        return m.size
+
+    def tickTimers(self, m=None):
+        "Finish a step for machines m (default all): timers, key_pressed, cycles."
+        if m is None:
+            m = slice(None)
+        #Timers count down at 60Hz of emulated time
+        phase = self.timer_phase[m]
+        tick = phase < 60
+        self.delay_timer[m] -= tick & (self.delay_timer[m] > 0)
+        self.sound_timer[m] -= tick & (self.sound_timer[m] > 0)
+        phase += 60
+        clock_rate = self.clock_rate[m]
+        self.timer_phase[m] = np.where(phase >= clock_rate, phase - clock_rate, phase)
+        self.key_pressed[m] = Core.NO_KEY
+        self.cycles[m] += 1
+
+    def run(self, cycles):
+        "Step cycles times, or until no machine is running. Returns the steps taken."
+        for i in range(cycles):
+            if not self.step():
+                return i
+        return cycles
+
+    #Family handlers. m holds the machines running the family this step,
+    # opcode the opcode each one fetched.
+    def advance(self, m, skip=None):
+        "PC += 2, or += 4 where skip is set."
+        if skip is None:
+            self.PC[m] += 2
+        else:
+            self.PC[m] += np.where(skip, 4, 2)
+
+    def op_SKIP(self, m, opcode):
+        self.advance(m)
+
+    def op_STALL(self, m, opcode):
+        pass
+
+    def op_00E0(self, m, opcode):
+        self.graphics[m] = 0
+        self.draw_graphics[m] = 1
+        self.advance(m)
+
+    def op_00EE(self, m, opcode):
+        empty = self.SP[m] == 0
+        self.status[m[empty]] = EXITED
+        m = m[~empty]
+        self.SP[m] -= 1
+        self.PC[m] = self.stack[m, self.SP[m]]
+
+    def op_1NNN(self, m, opcode):
+        self.PC[m] = opcode & 0xFFF
+
+    def op_2NNN(self, m, opcode):
+        full = self.SP[m] == Core.STACK_SIZE
+        self.status[m[full]] = EXITED
+        m = m[~full]
+        self.stack[m, self.SP[m]] = self.PC[m] + 2
+        self.SP[m] += 1
+        self.PC[m] = opcode[~full] & 0xFFF
+
+    def op_3XNN(self, m, opcode):
+        self.advance(m, self.V[m, opcode >> 8 & 0xF] == opcode & 0xFF)
+
+    def op_4XNN(self, m, opcode):
+        self.advance(m, self.V[m, opcode >> 8 & 0xF] != opcode & 0xFF)
+
+    def op_5XY0(self, m, opcode):
+        self.advance(m, self.V[m, opcode >> 8 & 0xF] == self.V[m, opcode >> 4 & 0xF])
+
+    def op_9XY0(self, m, opcode):
+        self.advance(m, self.V[m, opcode >> 8 & 0xF] != self.V[m, opcode >> 4 & 0xF])
+
+    def op_6XNN(self, m, opcode):
+        self.V[m, opcode >> 8 & 0xF] = opcode & 0xFF
+        self.advance(m)
+
+    def op_7XNN(self, m, opcode):
+        X = opcode >> 8 & 0xF
+        total = self.V[m, X] + (opcode & 0xFF)
+        #Core's rollover subtracts 255, not 256
+        self.V[m, X] = np.where(total > 0xFF, total - 0xFF, total)
+        self.advance(m)
+
+    def op_8XY0(self, m, opcode):
+        self.V[m, opcode >> 8 & 0xF] = self.V[m, opcode >> 4 & 0xF]
+        self.advance(m)
+
+    def op_8XY1(self, m, opcode):
+        X = opcode >> 8 & 0xF
+        self.V[m, X] |= self.V[m, opcode >> 4 & 0xF]
+        self.advance(m)
+
+    def op_8XY2(self, m, opcode):
+        X = opcode >> 8 & 0xF
+        self.V[m, X] &= self.V[m, opcode >> 4 & 0xF]
+        self.advance(m)
+
+    def op_8XY3(self, m, opcode):
+        X = opcode >> 8 & 0xF
+        self.V[m, X] ^= self.V[m, opcode >> 4 & 0xF]
+        self.advance(m)
+
+    def op_8XY4(self, m, opcode):
+        X = opcode >> 8 & 0xF
+        total = self.V[m, X].astype(np.int64) + self.V[m, opcode >> 4 & 0xF]
+        carry = total > 0xFF
+        self.V[m, 0xF] = carry
+        self.V[m, X] = np.where(carry, total - 0xFF, total)
+        self.advance(m)
+
+    def subtract(self, m, X, total):
+        "VX = total, less 255 on borrow, with VF unset on borrow."
+        borrow = total < 0
+        self.V[m, 0xF] = ~borrow
+        self.V[m, X] = np.where(borrow, total + 0xFF, total)
+        self.advance(m)
+
+    def op_8XY5(self, m, opcode):
+        X = opcode >> 8 & 0xF
+        self.subtract(m, X, self.V[m, X].astype(np.int64) - self.V[m, opcode >> 4 & 0xF])
+
+    def op_8XY7(self, m, opcode):
+        X = opcode >> 8 & 0xF
+        self.subtract(m, X, self.V[m, opcode >> 4 & 0xF].astype(np.int64) - self.V[m, X])
+
+    def op_8XY6(self, m, opcode):
+        X = opcode >> 8 & 0xF
+        Y = opcode >> 4 & 0xF
+        legacy = self.legacy[m]
+        old, new = m[legacy], m[~legacy]
+        VY = self.V[old, Y[legacy]]
+        self.V[old, 0xF] = VY & 1
+        self.V[old, X[legacy]] = VY >> 1
+        X = X[~legacy]
+        self.V[new, 0xF] = self.V[new, X] & 1
+        self.V[new, X] >>= 1 #Reread, for X == F
+        self.advance(m)
+
+    def op_8XYE(self, m, opcode):
+        X = opcode >> 8 & 0xF
+        VY = self.V[m, opcode >> 4 & 0xF].astype(np.int64)
+        self.V[m, 0xF] = 0
+        VX = self.V[m, X].astype(np.int64) #Reread, for X == F
+        shifted = np.where(self.legacy[m], VY, VX) << 1
+        #Core stores the unmasked shift, which raises above 255
+        overflow = shifted > 0xFF
+        self.status[m[overflow]] = FAULTED
+        fine = ~overflow
+        m = m[fine]
+        self.V[m, X[fine]] = shifted[fine]
+        self.advance(m)
+
+    def op_ANNN(self, m, opcode):
+        self.I[m] = opcode & 0xFFF
+        self.advance(m)
+
+    def op_BNNN(self, m, opcode):
+        address = (opcode & 0xFFF) + self.V[m, 0x0]
+        self.PC[m] = np.where(address > 0xFFF, address - 0xFFF, address)
+
+    def op_CXNN(self, m, opcode):
+        #Each machine draws from its own generator, in Python
+        rng = self.rng
+        values = [rng[i].getrandbits(8) for i in m.tolist()]
+        self.V[m, opcode >> 8 & 0xF] = np.array(values, np.int64) & opcode & 0xFF
+        self.advance(m)
+
+    def op_DXYN(self, m, opcode):
+        N = opcode & 0xF
+        I = self.I[m]
+        short = I + N > 4096 #The sprite runs off the end of memory
+        self.status[m[short]] = FAULTED
+        fine = ~short
+        m, opcode, N, I = m[fine], opcode[fine], N[fine], I[fine]
+        VX = self.V[m, opcode >> 8 & 0xF].astype(np.int64)
+        VY = self.V[m, opcode >> 4 & 0xF].astype(np.int64)
+        wrap = self.wrap[m]
+        #All lines of all sprites at once: one row per machine, one column
+        # per sprite line. A machine's lines land on different framebuffer
+        # rows, so the scatter back never collides.
+        line = np.arange(int(N.max()) if N.size else 0)
+        y = VY[:, None] + line
+        draw = (line < N[:, None]) & (wrap[:, None] | (y < 32))
+        rows, lines = np.nonzero(draw)
+        machines = m[rows]
+        sprite = self.flat_memory.take(self.row_start[machines] + I[rows] + lines).astype(np.uint64)
+        #Wrapped sprites rotate into place. Clipped sprites shift into
+        # place, with the right hand part shifted out
+        VX = np.where(wrap, VX & 63, VX)
+        left = np.where(wrap, 56, np.maximum(56 - VX, 0)).astype(np.uint64)[rows]
+        right = np.where(wrap, VX, np.minimum(np.maximum(VX - 56, 0), 63)).astype(np.uint64)[rows]
+        bits = sprite << left >> right
+        rotate = (wrap & (VX > 0))[rows]
+        if rotate.any():
+            back = ((64 - VX) & 63).astype(np.uint64)[rows]
+            bits |= np.where(rotate, sprite << np.uint64(56) << back, 0).astype(np.uint64)
+        y = y[rows, lines]
+        y = np.where(wrap[rows], y & 31, y)
+        address = machines * 32 + y
+        flat = self.graphics.reshape(-1)
+        row = flat.take(address)
+        flat.put(address, row ^ bits)
+        collision = np.zeros(m.size, bool)
+        collision[rows[(row & bits) != 0]] = True
+        self.V[m, 0xF] = collision
+        self.draw_graphics[m] = 1
+        self.advance(m)
+
+    def keyCheck(self, m, opcode, pressed):
+        key = self.V[m, opcode >> 8 & 0xF]
+        bad = key > 0xF #Core raises IndexError on a key past F
+        self.status[m[bad]] = FAULTED
+        fine = ~bad
+        m = m[fine]
+        self.advance(m, (self.key_states[m, key[fine]] != 0) == pressed)
+
+    def op_EX9E(self, m, opcode):
+        self.keyCheck(m, opcode, True)
+
+    def op_EXA1(self, m, opcode):
+        self.keyCheck(m, opcode, False)
+
+    def op_FX07(self, m, opcode):
+        self.V[m, opcode >> 8 & 0xF] = self.delay_timer[m]
+        self.advance(m)
+
+    def op_FX0A(self, m, opcode):
+        #Machines with no key pressed wait on this instruction
+        key = self.key_pressed[m]
+        pressed = key != Core.NO_KEY
+        m = m[pressed]
+        self.V[m, opcode[pressed] >> 8 & 0xF] = key[pressed]
+        self.advance(m)
+
+    def op_FX15(self, m, opcode):
+        self.delay_timer[m] = self.V[m, opcode >> 8 & 0xF]
+        self.advance(m)
+
+    def op_FX18(self, m, opcode):
+        self.sound_timer[m] = self.V[m, opcode >> 8 & 0xF]
+        self.advance(m)
+
+    def op_FX1E(self, m, opcode):
+        VX = self.V[m, opcode >> 8 & 0xF].astype(np.int64)
+        I = self.I[m]
+        rollover = I + VX > 0xFFF
+        self.I[m] = np.where(rollover, VX - (0xFFF - I), I + VX)
+        self.V[m[rollover], 0xF] = 1
+        self.advance(m)
+
+    def op_FX29(self, m, opcode):
+        self.I[m] = self.V[m, opcode >> 8 & 0xF].astype(np.int64) * 5
+        self.advance(m)
+
+    def op_FX33(self, m, opcode):
+        VX = self.V[m, opcode >> 8 & 0xF]
+        I = self.I[m]
+        #Core writes the digits in order, so a store past the end of memory
+        # keeps the digits before it, then raises
+        for offset, digit in enumerate((VX // 100, VX // 10 % 10, VX % 10)):
+            inside = I + offset < 4096
+            self.memory[m[inside], I[inside] + offset] = digit[inside]
+        past = I + 2 >= 4096
+        self.status[m[past]] = FAULTED
+        self.advance(m[~past])
+
+    def op_FX55(self, m, opcode):
+        X = opcode >> 8 & 0xF
+        I = self.I[m]
+        for i in range(16):
+            store = (i <= X) & (I + i < 4096)
+            self.memory[m[store], I[store] + i] = self.V[m[store], i]
+        self.finishBlock(m, X, I)
+
+    def op_FX65(self, m, opcode):
+        X = opcode >> 8 & 0xF
+        I = self.I[m]
+        for i in range(16):
+            load = (i <= X) & (I + i < 4096)
+            self.V[m[load], i] = self.memory[m[load], I[load] + i]
+        self.finishBlock(m, X, I)
+
+    def finishBlock(self, m, X, I):
+        "End FX55/FX65: I += X + 1, or fault where the block ran off the end of memory."
+        past = I + X + 1 > 4096
+        self.status[m[past]] = FAULTED
+        fine = ~past
+        m = m[fine]
+        self.I[m] = I[fine] + X[fine] + 1
+        self.advance(m)
+
+def main(path, count=1000, cycles=2000):
+    import time
+    from Batch import loadCPU
+    machines = VectorCPU(count, seeds=range(count))
+    machines.initialize()
+    machines.loadFile(path)
+    start = time.perf_counter()
+    machines.run(cycles)
+    elapsed = time.perf_counter() - start
+    total = int(machines.cycles.sum())
+    print("{0} machines, {1} instructions in {2:.2f}s: {3:.0f}/s".format(
+        count, total, elapsed, total / elapsed))
+    cpu = loadCPU(path)
+    step = cpu.emulateCycle
+    start = time.perf_counter()
+    try:
+        for i in range(cycles):
+            if step() == "Exit":
+                break
+    except Exception:
+        pass
+    single = (i + 1) / (time.perf_counter() - start)
+    print("One CPU: {0:.0f}/s. Speedup per machine: {1:.1f}x".format(
+        single, total / elapsed / single))
+
+if __name__ == "__main__":
+    main(sys.argv[1], *(int(arg) for arg in sys.argv[2:4]))